@@ -0,0 +1,75 @@
+"""
+    Compare preamble-only scanning in latex_reader with parsing the whole LaTeX source.
+
+    Usage: python benchmarks/bench_preamble.py [pages]
+"""
+
+from __future__ import annotations
+
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from typing import List
+
+from pylatexenc.latexwalker import LatexWalker
+
+from pandocmath import latex_reader
+from pandocmath.latex_reader import db, metadata_from_nodes, read_metadata_from_file
+
+PREAMBLE : str = r"""\documentclass{article}
+\usepackage{amsmath, amsthm}
+
+\theoremstyle{definition}
+\newtheorem{definition}{Definition}[section]
+\newtheorem{theorem}[definition]{Theorem}
+
+\numberwithin{equation}{section}
+
+\begin{document}
+"""
+
+def generate_latex(pages: int) -> str:
+
+    body : List[str] = []
+    for page in range(pages):
+        body.append('\\section{Section %d}\n' % page)
+        body.append('\\begin{theorem}\\label{thm%d} Let $x_{%d} \\in \\mathbb{R}$. Then\n' % (page, page))
+        body.append('\\begin{equation}\\label{eq%d} \\int_0^1 f(x)\\,dx = \\frac{1}{2} \\end{equation}\n' % page)
+        body.append('\\end{theorem}\n')
+        body.append('\\begin{proof} By \\ref{thm%d}, \\emph{trivially}. \\end{proof}\n' % page)
+        body.append('Some filler text about the result. ' * 40 + '\n\n')
+    return PREAMBLE + ''.join(body) + '\\end{document}\n'
+
+def full_walk(filename: str) -> dict:
+
+    with open(filename, "r") as file:
+        nodelist = LatexWalker(file.read(), latex_context=db).get_latex_nodes(pos=0)[0]
+    return metadata_from_nodes(nodelist)
+
+def timed(function, *args) -> float:
+
+    start : float = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+def main() -> None:
+
+    pages : int = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+
+    with tempfile.TemporaryDirectory() as directory:
+        filename : str = str(Path(directory) / 'thesis.tex')
+        Path(filename).write_text(generate_latex(pages))
+
+        full : float = timed(full_walk, filename)
+        latex_reader._preamble_cache.clear()
+        latex_reader._metadata_cache.clear()
+        preamble : float = timed(read_metadata_from_file, filename)
+        memoised : float = timed(read_metadata_from_file, filename)
+
+    print('pages=%d  full walk %.3fs  preamble scan %.4fs  memoised %.5fs  speedup %.0fx'
+        % (pages, full, preamble, memoised, full / preamble))
+
+if __name__ == '__main__':
+    main()
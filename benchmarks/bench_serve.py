@@ -0,0 +1,65 @@
+"""
+    Latency of cold filter runs (`pandoc-math html`) against runs through
+    `pandoc-math serve` and `pandoc-math-client`.
+
+    Usage: python benchmarks/bench_serve.py [runs] [sections]
+"""
+
+from __future__ import annotations
+
+import io
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import panflute as pf
+
+from typing import Dict, List
+
+sys.path.insert(0, str(Path(__file__).parent))
+from generate import generate_document
+
+def time_runs(command: List[str], document: bytes, env: Dict[str, str], runs: int) -> List[float]:
+
+    times : List[float] = []
+    for _ in range(runs):
+        start : float = time.perf_counter()
+        subprocess.run(command, input=document, env=env, capture_output=True, check=True)
+        times.append(time.perf_counter() - start)
+    return times
+
+def main() -> None:
+
+    runs : int = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    sections : int = int(sys.argv[2]) if len(sys.argv) > 2 else 2
+
+    with io.StringIO() as output:
+        pf.dump(generate_document(sections=sections, theorems=5, equations=5, references=5), output)
+        document : bytes = output.getvalue().encode('utf-8')
+
+    with tempfile.TemporaryDirectory() as directory:
+        env : Dict[str, str] = dict(os.environ, PANDOC_VERSION='3.1.6.1',
+            PANDOC_MATH_SOCKET=str(Path(directory) / 'serve.sock'))
+
+        cold : List[float] = time_runs([sys.executable, '-m', 'pandocmath.pandocmath', 'html'], document, env, runs)
+
+        daemon : subprocess.Popen = subprocess.Popen([sys.executable, '-m', 'pandocmath.pandocmath', 'serve', '-j', '2'],
+            env=env, stderr=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+        try:
+            while not os.path.exists(env['PANDOC_MATH_SOCKET']):
+                time.sleep(0.05)
+            client : List[str] = [sys.executable, '-m', 'pandocmath.client', 'html']
+            time_runs(client, document, env, 2)  # let the workers start
+            served : List[float] = time_runs(client, document, env, runs)
+        finally:
+            daemon.terminate()
+            daemon.wait()
+
+    print('%d runs, %d bytes of JSON: cold filter median %.1f ms, served median %.1f ms'
+        % (runs, len(document), sorted(cold)[runs // 2] * 1000, sorted(served)[runs // 2] * 1000))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""
+    Memory and throughput of the streaming filter mode against loading the whole document.
+
+    Each mode runs in its own process so peak RSS can be compared (Unix only).
+
+    Usage: python benchmarks/bench_streaming.py [sections]
+"""
+
+from __future__ import annotations
+
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import panflute as pf
+
+sys.path.insert(0, str(Path(__file__).parent))
+from generate import generate_document
+
+MODES = {
+    'load/dump': 'from pandocmath.filter import filter_json\n'
+        'sys.stdout.write(filter_json(open(sys.argv[1], encoding="utf-8").read()))',
+    'streaming': 'from pandocmath.streaming import filter_stream\n'
+        'filter_stream(open(sys.argv[1], encoding="utf-8"), sys.stdout)',
+}
+
+def run(mode: str, filename: str) -> tuple:
+
+    code : str = 'import sys, logging\nlogging.disable(logging.INFO)\n' + MODES[mode]
+    start : float = time.perf_counter()
+    process : subprocess.Popen = subprocess.Popen([sys.executable, '-c', code, filename], stdout=subprocess.DEVNULL)
+    _, status, usage = os.wait4(process.pid, 0)
+    elapsed : float = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode:
+        raise RuntimeError('%s failed' % mode)
+    # ru_maxrss is in kilobytes on Linux, bytes on macOS
+    scale : int = 1 if sys.platform == 'darwin' else 1024
+    return elapsed, usage.ru_maxrss * scale
+
+def generate(filename: str, sections: int) -> None:
+
+    with open(filename, 'w', encoding='utf-8') as file:
+        pf.dump(generate_document(sections=sections, references=2, filler_words=400), file)
+
+def main() -> None:
+
+    if sys.argv[1:2] == ['--generate']:
+        generate(sys.argv[2], int(sys.argv[3]))
+        return
+
+    sections : int = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+
+    with tempfile.TemporaryDirectory() as directory:
+        filename : str = str(Path(directory) / 'document.json')
+        # Generate in a child process so the forked benchmark processes start small
+        subprocess.run([sys.executable, __file__, '--generate', filename, str(sections)], check=True)
+        size : int = os.path.getsize(filename)
+
+        for mode in MODES:
+            elapsed, rss = run(mode, filename)
+            print('%-10s %6.1f MB JSON  %6.2fs  %6.1f MB/s  peak RSS %7.1f MB'
+                % (mode, size / 1e6, elapsed, size / 1e6 / elapsed, rss / 1e6))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+"""
+    Compare the single-pass dispatch engine with the previous two-walk filter pipeline.
+
+    Usage: python benchmarks/bench_traversal.py [sections]
+"""
+
+from __future__ import annotations
+
+import logging
+import sys
+import time
+from pathlib import Path
+
+import panflute as pf
+
+sys.path.insert(0, str(Path(__file__).parent))
+from generate import generate_document
+
+from pandocmath.filter import action, action1, action2, prepare, finalize
+
+def run(actions, sections: int) -> float:
+
+    doc : pf.Doc = generate_document(sections=sections)
+    start : float = time.perf_counter()
+    pf.run_filters(actions, prepare=prepare, finalize=finalize, doc=doc)
+    return time.perf_counter() - start
+
+def main() -> None:
+
+    sections : int = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    repeats : int = 3
+    # The filter's info logs would dominate the timings
+    logging.disable(logging.INFO)
+
+    two_walk : float = min(run((action1, action2), sections) for _ in range(repeats))
+    single : float = min(run((action,), sections) for _ in range(repeats))
+
+    print('sections=%d  two-walk %.3fs  single-pass %.3fs  speedup %.2fx'
+        % (sections, two_walk, single, two_walk / single))
+
+if __name__ == '__main__':
+    main()
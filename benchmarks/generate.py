@@ -0,0 +1,105 @@
+"""
+    Synthetic pandoc documents and LaTeX sources for benchmarking the pandoc-math filter.
+
+    Every size parameter is per section and independent of the others, so each dimension of a
+    document can be scaled on its own.
+"""
+
+from __future__ import annotations
+
+import panflute as pf
+
+from typing import List
+
+QED_SYMBOL : str = '\xa0' + chr(9723)
+
+def theorem_metadata(theorem_types: int = 3) -> dict:
+    """
+        amsthm_settings metadata declaring `theorem_types` environments sharing one section counter.
+    """
+
+    theorems : List[dict] = [{'env_name': 'theorem', 'text': 'Theorem', 'parent_counter': 'section'}]
+    for i in range(1, theorem_types):
+        theorems.append({'env_name': 'thm%d' % i, 'text': 'Theorem%d' % i, 'shared_counter': 'theorem'})
+
+    return {'amsthm_settings': {'plain': theorems, 'number_within': True}}
+
+def filler(words: int) -> pf.Para:
+
+    inlines : List[pf.Inline] = []
+    for i in range(words):
+        if inlines:
+            inlines.append(pf.Space())
+        inlines.append(pf.Str('word%d' % i))
+    return pf.Para(*inlines)
+
+def generate_document(sections: int = 50, theorems: int = 20, equations: int = 20, references: int = 20,
+    theorem_types: int = 3, filler_words: int = 40, proofs: int | None = None) -> pf.Doc:
+    """
+        Build a document with `sections` sections, each holding the given number of theorems,
+        proofs (by default one after each theorem), labelled equations and references to theorems.
+    """
+
+    if proofs is None:
+        proofs = theorems
+
+    blocks : List[pf.Block] = []
+    for s in range(sections):
+        blocks.append(pf.Header(pf.Str('Section'), pf.Space(), pf.Str(str(s)), level=1))
+        for t in range(max(theorems, proofs)):
+            if t < theorems:
+                env_name : str = 'theorem' if t % theorem_types == 0 else 'thm%d' % (t % theorem_types)
+                blocks.append(pf.Div(
+                    pf.Para(pf.Strong(pf.Str('Theorem')), pf.Space(), pf.Str('Statement.')),
+                    identifier='thm-%d-%d' % (s, t), classes=[env_name]))
+            if t < proofs:
+                blocks.append(pf.Div(
+                    pf.Para(pf.Emph(pf.Str('Proof.')), pf.Space(), pf.Str('Trivial.'), pf.Str(QED_SYMBOL)),
+                    classes=['proof']))
+            blocks.append(filler(filler_words))
+        for e in range(equations):
+            blocks.append(pf.Para(pf.Math('x_{%d} = y^{%d} \\label{eq-%d-%d}' % (e, e, s, e), format='DisplayMath')))
+            blocks.append(pf.Para(pf.Math('a + b', format='InlineMath'), pf.Space(), pf.Str('unlabelled.')))
+        for r in range(references):
+            target : str = 'thm-%d-%d' % (s, r % max(theorems, 1))
+            blocks.append(pf.Para(pf.Str('By'), pf.Space(),
+                pf.Link(pf.Str('[%s]' % target), url='#' + target,
+                    attributes={'reference-type': 'ref', 'reference': target})))
+
+    doc : pf.Doc = pf.Doc(*blocks, metadata=theorem_metadata(theorem_types))
+    doc.format = 'html'
+    return doc
+
+def generate_latex(sections: int = 50, theorems: int = 20, equations: int = 20, references: int = 20,
+    theorem_types: int = 3, filler_words: int = 40, proofs: int | None = None) -> str:
+    """
+        The LaTeX counterpart of `generate_document`, with a preamble declaring the theorem types.
+    """
+
+    if proofs is None:
+        proofs = theorems
+
+    preamble : List[str] = ['\\documentclass{article}\n', '\\usepackage{amsmath, amsthm}\n\n',
+        '\\newtheorem{theorem}{Theorem}[section]\n']
+    for i in range(1, theorem_types):
+        preamble.append('\\newtheorem{thm%d}[theorem]{Theorem%d}\n' % (i, i))
+    preamble.append('\n\\numberwithin{equation}{section}\n\n\\begin{document}\n')
+
+    text : str = ' '.join('word%d' % i for i in range(filler_words))
+    body : List[str] = []
+    for s in range(sections):
+        body.append('\\section{Section %d}\n' % s)
+        for t in range(max(theorems, proofs)):
+            if t < theorems:
+                env_name : str = 'theorem' if t % theorem_types == 0 else 'thm%d' % (t % theorem_types)
+                body.append('\\begin{%s}\\label{thm-%d-%d} Statement. \\end{%s}\n' % (env_name, s, t, env_name))
+            if t < proofs:
+                body.append('\\begin{proof} Trivial. \\end{proof}\n')
+            body.append(text + '\n\n')
+        for e in range(equations):
+            body.append('\\begin{equation}\\label{eq-%d-%d} x_{%d} = y^{%d} \\end{equation}\n' % (s, e, e, e))
+            body.append('$a + b$ unlabelled.\n\n')
+        for r in range(references):
+            body.append('By \\ref{thm-%d-%d}.\n\n' % (s, r % max(theorems, 1)))
+
+    return ''.join(preamble) + ''.join(body) + '\\end{document}\n'
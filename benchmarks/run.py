@@ -0,0 +1,171 @@
+"""
+    Benchmark harness reporting the time and peak memory of each stage of the pandoc-math filter
+    on a synthetic document.
+
+    Stages: metadata (reading amsthm settings from the LaTeX preamble), load (pandoc JSON to
+    panflute), prepare, walk (amsthm_numbering), resolve (resolve_ref on queued links),
+    finalize and dump (panflute to pandoc JSON).
+
+    Usage:
+        python benchmarks/run.py --sections 200 --theorems 10 --json results.json
+        python benchmarks/run.py --sections 200 --theorems 10 --baseline results.json
+
+    With --baseline, the command exits with status 1 if any stage is slower than the baseline
+    by more than --tolerance (default 25%).
+"""
+
+from __future__ import annotations
+
+import argparse
+import gc
+import io
+import json
+import logging
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+import panflute as pf
+
+from typing import Callable, Dict, List
+
+sys.path.insert(0, str(Path(__file__).parent))
+from generate import generate_document, generate_latex
+
+from pandocmath.filter import action, finalize, prepare, resolve_links
+from pandocmath.latex_reader import get_metadata_from_latex
+
+STAGES : List[str] = ['metadata', 'load', 'prepare', 'walk', 'resolve', 'finalize', 'dump']
+
+def pipeline(latex_source: str, document: str) -> List[Callable[[dict], None]]:
+    """
+        The filter split into stages which pass their state along in a dict.
+    """
+
+    def metadata(state: dict) -> None:
+        get_metadata_from_latex(latex_source)
+
+    def load(state: dict) -> None:
+        state['doc'] = pf.load(io.StringIO(document))
+        state['doc'].format = 'html'
+
+    def prepare_stage(state: dict) -> None:
+        prepare(state['doc'])
+
+    def walk(state: dict) -> None:
+        state['doc'] = state['doc'].walk(action, state['doc'])
+
+    def resolve(state: dict) -> None:
+        resolve_links(state['doc'])
+        # Already resolved, so finalize doesn't repeat the work
+        state['doc']._amsthm_settings.links = []
+
+    def finalize_stage(state: dict) -> None:
+        finalize(state['doc'])
+
+    def dump(state: dict) -> None:
+        with io.StringIO() as output:
+            pf.dump(state['doc'], output)
+
+    return [metadata, load, prepare_stage, walk, resolve, finalize_stage, dump]
+
+def measure_times(stages: List[Callable[[dict], None]]) -> List[float]:
+
+    times : List[float] = []
+    state : dict = {}
+    for stage in stages:
+        gc.collect()
+        start : float = time.perf_counter()
+        stage(state)
+        times.append(time.perf_counter() - start)
+    return times
+
+def measure_memory(stages: List[Callable[[dict], None]]) -> List[int]:
+    """
+        Peak traced memory allocated during each stage, above what was allocated before it.
+    """
+
+    peaks : List[int] = []
+    state : dict = {}
+    tracemalloc.start()
+    try:
+        for stage in stages:
+            gc.collect()
+            tracemalloc.clear_traces()
+            before, _ = tracemalloc.get_traced_memory()
+            stage(state)
+            _, peak = tracemalloc.get_traced_memory()
+            peaks.append(max(peak - before, 0))
+    finally:
+        tracemalloc.stop()
+    return peaks
+
+def run(sizes: Dict[str, int], repeat: int = 3) -> Dict[str, dict]:
+    """
+        Best time over `repeat` runs and peak memory of each stage for a document of the given sizes.
+    """
+
+    doc : pf.Doc = generate_document(**sizes)
+    with io.StringIO() as output:
+        pf.dump(doc, output)
+        document : str = output.getvalue()
+    del doc
+    latex_source : str = generate_latex(**sizes)
+
+    times : List[List[float]] = [measure_times(pipeline(latex_source, document)) for _ in range(repeat)]
+    peaks : List[int] = measure_memory(pipeline(latex_source, document))
+
+    return {name: {'seconds': min(run_times[i] for run_times in times), 'peak_bytes': peaks[i]}
+        for i, name in enumerate(STAGES)}
+
+def regressions(results: Dict[str, dict], baseline: Dict[str, dict], tolerance: float) -> List[str]:
+
+    slower : List[str] = []
+    for name, result in results.items():
+        if name in baseline and result['seconds'] > baseline[name]['seconds'] * (1 + tolerance):
+            slower.append('%s: %.4fs vs %.4fs' % (name, result['seconds'], baseline[name]['seconds']))
+    return slower
+
+def main(argv: List[str] | None = None) -> int:
+    parser : argparse.ArgumentParser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sections', type=int, default=50)
+    parser.add_argument('--theorems', type=int, default=20, help='theorems per section')
+    parser.add_argument('--theorem-types', type=int, default=3)
+    parser.add_argument('--proofs', type=int, default=None, help='proofs per section (default: one per theorem)')
+    parser.add_argument('--equations', type=int, default=20, help='labelled equations per section')
+    parser.add_argument('--references', type=int, default=20, help='references per section')
+    parser.add_argument('--filler-words', type=int, default=40)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--json', default=None, help='write the results to this file')
+    parser.add_argument('--baseline', default=None, help='results file to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    args : argparse.Namespace = parser.parse_args(argv)
+
+    # The filter logs every theorem type it reads at INFO level
+    logging.disable(logging.INFO)
+
+    sizes : Dict[str, int] = {'sections': args.sections, 'theorems': args.theorems,
+        'theorem_types': args.theorem_types, 'proofs': args.proofs, 'equations': args.equations,
+        'references': args.references, 'filler_words': args.filler_words}
+    results : Dict[str, dict] = run(sizes, args.repeat)
+
+    print('%-10s %10s %12s' % ('stage', 'time (s)', 'peak (MB)'))
+    for name, result in results.items():
+        print('%-10s %10.4f %12.2f' % (name, result['seconds'], result['peak_bytes'] / 1024 / 1024))
+    print('%-10s %10.4f' % ('total', sum(result['seconds'] for result in results.values())))
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump({'sizes': sizes, 'stages': results}, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            slower : List[str] = regressions(results, json.load(file)['stages'], args.tolerance)
+        for line in slower:
+            print('regression ' + line)
+        return 1 if slower else 0
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
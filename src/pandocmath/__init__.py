@@ -1,3 +1,19 @@
 from pandocmath._version import __version__
 
-import pandocmath.pandocmath
+import importlib
+
+# Submodules are imported on first access, so that light entry points such as the
+# filter client don't pay for importing panflute
+_SUBMODULES = ['aio', 'ams', 'assets', 'build', 'bundle', 'cache', 'client', 'conversion', 'engine',
+    'filter', 'label_index', 'latex_reader', 'logs', 'pandoc_info', 'pandocmath', 'parallel', 'prerender',
+    'profiling', 'server', 'streaming', 'watch']
+
+# Public functions, imported from their submodule on first access
+_EXPORTS = {'convert': 'conversion'}
+
+def __getattr__(name):
+    if name in _SUBMODULES:
+        return importlib.import_module(__name__ + '.' + name)
+    if name in _EXPORTS:
+        return getattr(importlib.import_module(__name__ + '.' + _EXPORTS[name]), name)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
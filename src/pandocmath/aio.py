@@ -0,0 +1,220 @@
+"""
+    asyncio API for hosting pandoc-math in a service, converting many documents on one event loop.
+
+        scheduler = Scheduler(max_concurrency=4, max_pending=32, timeout=60)
+        result = await scheduler.submit('upload.tex', 'upload.html')
+
+    pandoc runs through asyncio.create_subprocess_exec and the filter runs in an executor, so the
+    event loop is never blocked. Jobs that time out or are cancelled kill their pandoc process.
+    Filtering can't be interrupted, so a job whose filter is already running when it times out
+    keeps its scheduler slot until the filter finishes. What the filter logs is added to the
+    result's stderr, and still reaches the usual logging handlers. On Windows with Python 3.7,
+    importing this module switches to the proactor event loop, which can run subprocesses.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import functools
+import os
+import sys
+from concurrent.futures import Executor
+from pathlib import Path
+
+from typing import Any, List, Sequence, Set, Tuple
+
+from pandocmath.conversion import ConversionResult, conversion_metadata, filter_latex_json, \
+    reader_command, writer_command
+from pandocmath.logs import captured_logs
+
+if sys.platform == 'win32' and sys.version_info < (3, 8) and \
+        isinstance(asyncio.get_event_loop_policy(), asyncio.WindowsSelectorEventLoopPolicy):
+    # Before Python 3.8 the default event loop on Windows can't run subprocesses
+    asyncio.set_event_loop_policy(asyncio.WindowsProactorEventLoopPolicy())
+
+class SchedulerFull(Exception):
+    """
+        Raised by Scheduler.submit(wait=False) when the queue of pending jobs is full.
+    """
+
+async def run_process(command: List[str], cwd: str, input: bytes | None = None) -> Tuple[int, bytes, bytes]:
+    """
+        Run a command to completion, killing it if the awaiting task is cancelled or times out.
+    """
+
+    process : asyncio.subprocess.Process = await asyncio.create_subprocess_exec(*command, cwd=cwd,
+        stdin=asyncio.subprocess.PIPE if input is not None else asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    try:
+        stdout, stderr = await process.communicate(input)
+    except BaseException:
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        raise
+    return process.returncode, stdout, stderr
+
+def filter_job(json_text: str, metadata: dict) -> Tuple[bytes, str]:
+    """
+        Run the filter, returning the filtered JSON and what it logged. Only records from this
+        thread are collected, since other jobs may be filtering at the same time.
+    """
+
+    with captured_logs() as log:
+        filtered : bytes = filter_latex_json(json_text, metadata)
+    return filtered, log.getvalue()
+
+async def run_to_completion(future: asyncio.Future) -> Any:
+    """
+        Await work running in an executor. The work can't be interrupted, so if the awaiting task
+        is cancelled, it only stops once the work has.
+    """
+
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        while not future.done():
+            try:
+                await asyncio.wait([future])
+            except asyncio.CancelledError:
+                pass
+        if not future.cancelled():
+            # Nobody is waiting for the result any more
+            future.exception()
+        raise
+
+async def _convert(source: Path, output: Path, metadata: dict | None, metadata_file: Path | None,
+        pandoc: str | Sequence[str], executor: Executor | None) -> ConversionResult:
+
+    loop : asyncio.AbstractEventLoop = asyncio.get_running_loop()
+    metadata = await run_to_completion(loop.run_in_executor(executor,
+        functools.partial(conversion_metadata, source, metadata, metadata_file)))
+
+    returncode, document, stderr = await run_process(reader_command(source, pandoc), str(source.parent))
+    if returncode != 0:
+        return ConversionResult(source, output, returncode, stderr=stderr.decode('utf-8'))
+
+    filtered, log = await run_to_completion(loop.run_in_executor(executor, filter_job, document.decode('utf-8'), metadata))
+
+    returncode, stdout, write_stderr = await run_process(writer_command(output, pandoc), str(source.parent), filtered)
+    return ConversionResult(source, output, returncode, stdout.decode('utf-8'),
+        stderr.decode('utf-8') + log + write_stderr.decode('utf-8'))
+
+def start_conversion(source: Path, output: Path | None = None, metadata: dict | None = None,
+        metadata_file: Path | None = None, pandoc: str | Sequence[str] = 'pandoc',
+        executor: Executor | None = None) -> asyncio.Task:
+    """
+        Start converting a document in a task of its own.
+    """
+
+    source = Path(source).resolve()
+    if output is None:
+        output = Path(source.stem + '.html')
+    output = Path(output).resolve()
+
+    return asyncio.ensure_future(_convert(source, output, metadata, metadata_file, pandoc, executor))
+
+async def wait_conversion(job: asyncio.Task, timeout: float | None = None) -> ConversionResult:
+    """
+        Wait at most `timeout` seconds for a conversion started by `start_conversion`. On timeout
+        or cancellation the job is cancelled and the caller returns at once, while the job
+        finishes whatever filtering is already running.
+    """
+
+    try:
+        return await asyncio.wait_for(asyncio.shield(job), timeout)
+    except BaseException:
+        job.cancel()
+        raise
+
+async def convert(source: Path, output: Path | None = None, metadata: dict | None = None,
+        metadata_file: Path | None = None, pandoc: str | Sequence[str] = 'pandoc',
+        timeout: float | None = None, executor: Executor | None = None) -> ConversionResult:
+    """
+        Asynchronous `pandocmath.convert`. Raises asyncio.TimeoutError after `timeout` seconds.
+
+        The filter runs in `executor`, by default the event loop's thread pool; pass a
+        ProcessPoolExecutor to keep CPU-heavy filtering off the service's process.
+    """
+
+    return await wait_conversion(start_conversion(source, output, metadata, metadata_file, pandoc, executor), timeout)
+
+class Scheduler:
+    """
+        Bounds the number of conversions running at once (`max_concurrency`) and waiting to run
+        (`max_pending`). Create it inside the running event loop.
+    """
+
+    def __init__(self, max_concurrency: int | None = None, max_pending: int = 64, pandoc: str | Sequence[str] = 'pandoc',
+            timeout: float | None = None, executor: Executor | None = None) -> None:
+        self.max_concurrency : int = max_concurrency or os.cpu_count() or 1
+        self.pandoc = pandoc
+        self.timeout = timeout
+        self.executor = executor
+        self.running : int = 0
+        self.pending : int = 0
+        self._admitted : asyncio.Semaphore = asyncio.Semaphore(self.max_concurrency + max_pending)
+        self._slots : asyncio.Semaphore = asyncio.Semaphore(self.max_concurrency)
+        self._tasks : Set[asyncio.Task] = set()
+        self._jobs : Set[asyncio.Task] = set()
+
+    async def submit(self, source: Path, output: Path | None = None, metadata: dict | None = None,
+            metadata_file: Path | None = None, timeout: float | None = None, wait: bool = True) -> ConversionResult:
+        """
+            Convert a document once a slot is free. If the queue is full, wait for room, or raise
+            SchedulerFull if `wait` is False so the caller can shed load.
+        """
+
+        if not wait and self._admitted.locked():
+            raise SchedulerFull('%d conversions running and %d pending' % (self.running, self.pending))
+
+        task : asyncio.Task = asyncio.current_task()
+        self._tasks.add(task)
+        try:
+            await self._admitted.acquire()
+            self.pending += 1
+            try:
+                await self._slots.acquire()
+            except BaseException:
+                self._admitted.release()
+                raise
+            finally:
+                self.pending -= 1
+
+            self.running += 1
+            try:
+                job : asyncio.Task = start_conversion(source, output, metadata, metadata_file, self.pandoc, self.executor)
+            except BaseException:
+                self._release()
+                raise
+            self._jobs.add(job)
+            job.add_done_callback(self._finished)
+            return await wait_conversion(job, self.timeout if timeout is None else timeout)
+        finally:
+            self._tasks.discard(task)
+
+    def _finished(self, job: asyncio.Task) -> None:
+
+        # The slot is only freed once the job has stopped, not when its caller gave up on it
+        self._jobs.discard(job)
+        if not job.cancelled():
+            job.exception()
+        self._release()
+
+    def _release(self) -> None:
+
+        self.running -= 1
+        self._slots.release()
+        self._admitted.release()
+
+    async def cancel_all(self) -> None:
+        """
+            Cancel every submitted job, killing running pandoc processes, and wait for them to stop.
+        """
+
+        tasks : List[asyncio.Task] = [task for task in self._tasks if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        # Including jobs whose callers have given up on them, e.g. after a timeout
+        await asyncio.gather(*list(self._jobs), return_exceptions=True)
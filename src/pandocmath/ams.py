@@ -59,12 +59,15 @@ SOFTWARE.
 
 from __future__ import annotations
 
-from dataclasses import dataclass
 import logging
 import panflute as pf
 import re
+from collections import Counter
+from types import MappingProxyType
 
-from typing import Dict, List
+from typing import Dict, List, Mapping, Tuple
+
+from pandocmath.profiling import counting
 
 logger = logging.getLogger(__name__)
 
@@ -72,47 +75,128 @@ logger = logging.getLogger(__name__)
 AMSTHM_STYLES = ["plain", "definition", "remark"]
 MAX_SECTION_DEPTH = 3
 LEVEL_TO_SECTION = {1: "section", 2: "subsection", 3: "subsubsection"}
+SECTION_TO_LEVEL = {section: level for level, section in LEVEL_TO_SECTION.items()}
 
 # Type Aliases
 THEOREM_DATA = Dict[str,str]
 
-@dataclass
+QED_SYMBOL : str = chr(9723)
+# What \qedhere becomes in an equation inside a proof
+QED_TAG : str = "\\tag*{" + QED_SYMBOL + "}"
+
+# Patterns used on every labelled Math element
+LABEL : re.Pattern = re.compile(r'\\label\{([^{}]*)\}')
+# Row breaks of an aligned environment, and the groups and environments nested in its rows.
+# Groups without nested braces, like the argument of \label, are matched whole
+ROW_TOKEN : re.Pattern = re.compile(r'\\\\|\\(?:begin|end)\{[^{}]*\}|\{(?:[^{}\\]|\\[^{}])*\}|\\[{}]|[{}]')
+# Rows MathJax doesn't number, or numbers with the author's own tag
+UNNUMBERED : re.Pattern = re.compile(r'\\(?:notag|nonumber|tag)(?![A-Za-z])')
+
+# Math element with a \\label, waiting to be numbered with the rest of its section
+PendingEquation = pf.Math
+
 class AmsTheorem:
-    style: str
-    env_name: str
-    text: str
-    parent_counter: str | None = None
-    shared_counter: str | None = None
-    numbered: bool = True
+    """
+        A theorem environment. `counter` is the id of the counter it is numbered by, or None if unnumbered.
+    """
+
+    __slots__ = ('style', 'env_name', 'text', 'parent_counter', 'shared_counter', 'numbered', 'counter')
+
+    def __init__(self, style: str, env_name: str, text: str, parent_counter: str | None = None,
+            shared_counter: str | None = None, numbered: bool = True) -> None:
+        self.style = style
+        self.env_name = env_name
+        self.text = text
+        self.parent_counter = parent_counter
+        self.shared_counter = shared_counter
+        self.numbered = numbered
+        self.counter : int | None = None
+
+    def __repr__(self) -> str:
+        return 'AmsTheorem(style=%r, env_name=%r, text=%r, parent_counter=%r, shared_counter=%r, numbered=%r)' \
+            % (self.style, self.env_name, self.text, self.parent_counter, self.shared_counter, self.numbered)
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, AmsTheorem):
+            return NotImplemented
+        return (self.style, self.env_name, self.text, self.parent_counter, self.shared_counter, self.numbered) \
+            == (other.style, other.env_name, other.text, other.parent_counter, other.shared_counter, other.numbered)
+
+    __hash__ = None
 
 class AmsthmSettings:
 
     theorems: Dict[str, AmsTheorem]
+    theorem_lookup : Mapping[str, AmsTheorem]
     section_counters :List[int]
-    theorem_counters : Dict[str, int]
+    counter_ids : Dict[str, int]
+    counter_names : List[str]
+    counter_values : List[int]
+    counter_parents : Dict[str, str]
+    counter_parent_level : List[int]
+    counter_parent_id : List[int]
+    section_resets : Dict[int, Tuple[int, ...]]
+    counter_resets : List[Tuple[int, ...]]
     identifiers : Dict[str, str]
+    equations : Dict[str, str]
+    pending_equations : List[PendingEquation]
+    links : List[pf.Link]
+    maths : List[pf.Math] | None
+    xypic : bool
+    qed_proofs : set[int]
     number_within: bool = False
     equation_counter : int
+    regex_calls : Counter | None
 
-    def __init__(self, doc: pf.Doc = None) -> None:
+    def __init__(self, doc: pf.Doc = None, settings: dict | None = None) -> None:
         self.theorems = {}
         self.section_counters = [0]*3
-        self.theorem_counters = {}
+        self.counter_ids = {}
+        self.counter_names = []
+        self.counter_parents = {}
         self.identifiers = {}
+        self.equations = {}
+        self.pending_equations = []
+        self.links = []
+        self.maths = None
+        self.xypic = False
+        self.qed_proofs = set()
         self.equation_counter = 1
-        if doc:
+        # Set by a profiled run to count regex calls
+        self.regex_calls = None
+        if settings is not None:
+            self.read_settings(settings)
+        elif doc:
             self.read_metadata(doc)
 
         # Add the pre-defined proof environment to theorems
         proof : AmsTheorem = AmsTheorem("proof", "proof", "Proof", numbered=False)
         self.theorems['proof'] = proof
 
+        self.build_counter_index()
+
+    def declare_counter(self, name: str) -> int:
+        """
+            Intern a theorem counter name, returning its index into `counter_values`.
+        """
+
+        counter : int | None = self.counter_ids.get(name)
+        if counter is None:
+            counter = self.counter_ids[name] = len(self.counter_names)
+            self.counter_names.append(name)
+        return counter
+
     def read_metadata(self, doc: pf.Doc) -> None:
         """
             Read amsthm_settings metadata to setup options on theorem styles and counters.
         """
 
-        metadata: Dict[str, dict] = doc.get_metadata("amsthm_settings")
+        self.read_settings(doc.get_metadata("amsthm_settings", {}))
+
+    def read_settings(self, metadata: Dict[str, dict]) -> None:
+        """
+            Setup theorem styles and counters from an amsthm_settings dictionary, e.g. from a settings bundle.
+        """
 
         numberwithin : bool | None = metadata.get('number_within')
         if numberwithin:
@@ -132,127 +216,420 @@ class AmsthmSettings:
 
                     # NewTheorem environment has shared counter
                     if shared_counter is not None:
-                        self.theorem_counters[shared_counter] = 0
+                        self.declare_counter(shared_counter)
                         if parent_counter is not None:
                             logger.warning("AmsTheorem %s has both a parent and shared counter.", env_name)
 
-                    # Create AmsTheorem dataclass and add to list of theorems
+                    # Create AmsTheorem and add to list of theorems
                     new_theorem : AmsTheorem = AmsTheorem(style, env_name, text, parent_counter, shared_counter, numbered)
                     self.theorems[env_name] = new_theorem
                     logger.info('Added new AmsTheorem: %s.', new_theorem.text)
 
+        # Every numbered theorem without a shared counter has a counter of its own
+        for env_name, theorem in self.theorems.items():
+            if theorem.numbered and theorem.shared_counter is None:
+                self.declare_counter(env_name)
+                if theorem.parent_counter is not None:
+                    self.counter_parents[env_name] = theorem.parent_counter
+        for theorem in self.theorems.values():
+            if theorem.shared_counter is not None:
+                self.declare_counter(theorem.shared_counter)
+
+        # \numberwithin{counter}{parent} for theorem counters
+        counter_parents : Dict[str, str] = metadata.get('counter_parents') or {}
+        for counter, parent in counter_parents.items():
+            if counter in self.counter_ids:
+                self.counter_parents[counter] = parent
+            else:
+                logger.warning("Cannot number %s within %s: no such theorem counter.", counter, parent)
 
+    def build_counter_index(self) -> None:
+        """
+            Precompute which theorem counters are reset by each section level and by each
+            theorem counter, following dependency chains like theorem -> subsection -> section,
+            and the frozen class name to theorem lookup used to classify Divs.
+        """
 
-def replace_qed_here(elem: pf.Element, doc: pf.Doc) -> None:
+        for counter, parent in list(self.counter_parents.items()):
+            if parent not in SECTION_TO_LEVEL and parent not in self.counter_ids:
+                logger.warning("Unknown parent counter %s for %s. Ignoring...", parent, counter)
+                del self.counter_parents[counter]
+
+        # Break chains that loop back on themselves so numbers stay finite
+        for counter in list(self.counter_parents):
+            ancestor : str | None = self.counter_parents.get(counter)
+            visited : set = set()
+            while ancestor is not None and ancestor != counter and ancestor not in visited:
+                visited.add(ancestor)
+                ancestor = self.counter_parents.get(ancestor)
+            if ancestor == counter:
+                logger.warning("Counter %s is numbered within itself. Ignoring its parent...", counter)
+                del self.counter_parents[counter]
+
+        children : Dict[str, List[str]] = {}
+        for counter, parent in self.counter_parents.items():
+            children.setdefault(parent, []).append(counter)
+
+        # A new section also resets its subsections, and so everything numbered within them
+        for level in range(MAX_SECTION_DEPTH, 1, -1):
+            children.setdefault(LEVEL_TO_SECTION[level - 1], []).append(LEVEL_TO_SECTION[level])
+
+        def dependents(counter: str) -> Tuple[int, ...]:
+            found : List[int] = []
+            pending : List[str] = list(children.get(counter, ()))
+            while pending:
+                child : str = pending.pop()
+                child_id : int | None = self.counter_ids.get(child)
+                if child_id in found:
+                    continue
+                if child_id is not None:
+                    found.append(child_id)
+                pending.extend(children.get(child, ()))
+            return tuple(found)
+
+        self.counter_values = [0] * len(self.counter_names)
+        self.section_resets = {level: dependents(LEVEL_TO_SECTION[level]) for level in LEVEL_TO_SECTION}
+        self.counter_resets = [dependents(name) for name in self.counter_names]
+
+        # How each counter is printed: after the section numbers down to a level, or after another counter
+        self.counter_parent_level = [SECTION_TO_LEVEL.get(self.counter_parents.get(name), 0)
+            for name in self.counter_names]
+        self.counter_parent_id = [self.counter_ids.get(self.counter_parents.get(name), -1)
+            for name in self.counter_names]
+
+        for theorem in self.theorems.values():
+            counter_name : str | None = theorem.shared_counter
+            if counter_name is None and theorem.env_name in self.counter_ids:
+                counter_name = theorem.env_name
+            theorem.counter = self.counter_ids.get(counter_name)
+        self.theorem_lookup = MappingProxyType(dict(self.theorems))
+
+    def counter_number(self, counter: int) -> str:
+        """
+            The printed value of a theorem counter, prefixed by its parent, e.g. '2.1.3'.
+        """
+
+        value : str = str(self.counter_values[counter])
+        level : int = self.counter_parent_level[counter]
+        if level:
+            return '.'.join(str(number) for number in self.section_counters[:level]) + '.' + value
+        parent : int = self.counter_parent_id[counter]
+        if parent >= 0:
+            return self.counter_number(parent) + '.' + value
+        return value
+
+    def step_counter(self, counter: int) -> None:
+
+        counter_values : List[int] = self.counter_values
+        counter_values[counter] += 1
+        for dependent in self.counter_resets[counter]:
+            counter_values[dependent] = 0
+
+    def start_section(self, level: int) -> None:
+        """
+            Step the counter of a section level and reset everything numbered within it.
+        """
+
+        # Add one to counter and reset deeper counters
+        self.section_counters[level - 1] += 1
+        for i in range(level, MAX_SECTION_DEPTH):
+            self.section_counters[i] = 0
+
+        # Reset theorem counters numbered within this section, directly or through a chain
+        counter_values : List[int] = self.counter_values
+        for theorem_counter in self.section_resets[level]:
+            counter_values[theorem_counter] = 0
+
+        # Reset equation counter on new section
+        if level == 1 and self.number_within:
+            self.equation_counter = 1
+
+    def classify(self, classes: List[str], warn: bool = True) -> AmsTheorem | None:
+        """
+            The theorem environment of a Div with these classes, or None if there are none or several.
+        """
+
+        # Probe the frozen lookup with each class, without building a set per Div
+        theorem_lookup : Mapping[str, AmsTheorem] = self.theorem_lookup
+        theorem_type : AmsTheorem | None = None
+        for class_name in classes:
+            found : AmsTheorem | None = theorem_lookup.get(class_name)
+            if found is not None and found is not theorem_type:
+                if theorem_type is not None:
+                    if warn:
+                        logger.warning("Multiple environments found: %s",
+                            {name for name in classes if name in theorem_lookup})
+                    return None
+                theorem_type = found
+        return theorem_type
+
+
+
+def enclosing_proof(elem: pf.Element) -> pf.Div | None:
     """
-        Helper function that replaces \\qedhere in proof environment.
+        Return the proof Div containing `elem`, following parent links up the tree.
     """
 
-    qed_symbol : str = chr(9723)
+    parent : pf.Element | None = elem.parent
+    while parent is not None and not isinstance(parent, pf.Doc):
+        if isinstance(parent, pf.Div) and 'proof' in parent.classes:
+            return parent
+        parent = parent.parent
+    return None
 
-    if isinstance(elem, pf.Math):
-        # Replace qedhere with equation tag containing '◻'
-        if "\\qedhere" in elem.text:
-            elem.text = elem.text.replace("\\qedhere","\\tag*{"+qed_symbol+"}")
+def replace_qed_here(elem: pf.Math, amsthm_settings: AmsthmSettings) -> None:
+    """
+        Replace \\qedhere in a Math element inside a proof with an equation tag containing '◻',
+        and remember the proof so that its closing '◻' is removed.
+    """
 
-    if isinstance(elem, pf.Str):
-        # Remove the original '◻' at the end of the proof
-        if qed_symbol in elem.text:
-            return []
+    proof : pf.Div | None = enclosing_proof(elem)
+    if proof is not None:
+        elem.text = elem.text.replace("\\qedhere", QED_TAG)
+        amsthm_settings.qed_proofs.add(id(proof))
 
+def remove_qed_symbol(proof: pf.Div) -> None:
+    """
+        Remove the '◻' pandoc appends to the last paragraph of a proof.
+    """
 
-def amsthm_numbering(elem: pf.Element, doc: pf.Doc) -> None:
+    if not proof.content:
+        return
+    last : pf.Block = proof.content[-1]
+    if not isinstance(last, (pf.Para, pf.Plain)):
+        return
+
+    inlines = last.content
+    if inlines and isinstance(inlines[-1], pf.Str) and QED_SYMBOL in inlines[-1].text:
+        inlines.pop()
+        while inlines and isinstance(inlines[-1], (pf.Space, pf.SoftBreak)):
+            inlines.pop()
+        if not inlines:
+            proof.content.pop()
+
+def aligned_rows(text: str, regex_calls: Counter | None = None) -> Tuple[List[Tuple[int, int]], int, int] | None:
     """
-        Action that re-numbers amsthm environments and numbers labelled equations.
+        The (start, end) offsets of the rows of the outermost aligned environment in `text`,
+        which is split at its own \\\\ but not at those of nested environments, followed by the
+        offsets of its \\begin and \\end. None if there is no complete aligned environment.
     """
 
-    amsthm_settings: AmsthmSettings = doc._amsthm_settings
+    begin : int = text.find('\\begin{aligned}')
+    if begin < 0:
+        return None
 
-    if isinstance(elem, pf.Header):
-        level : int = elem.level
-        section : str = LEVEL_TO_SECTION.get(level)
-        if level <= MAX_SECTION_DEPTH:
+    start : int = begin + len('\\begin{aligned}')
+    rows : List[Tuple[int, int]] = []
+
+    # Fast path without nested environments or escaped braces: if the pieces between the row
+    # breaks all have balanced braces, no break is inside a group and the pieces are the rows
+    end : int = text.find('\\end', start)
+    if end >= 0 and text.startswith('\\end{aligned}', end):
+        body : str = text[start:end]
+        if '\\begin' not in body and '\\{' not in body and '\\}' not in body:
+            piece : str
+            for piece in body.split('\\\\'):
+                if piece.count('{') != piece.count('}'):
+                    break
+                rows.append((start, start + len(piece)))
+                start += len(piece) + 2
+            else:
+                if len(rows) > 1 and not piece.strip():
+                    rows.pop()
+                return rows, begin, end
+            rows = []
+            start = begin + len('\\begin{aligned}')
+
+    depth : int = 0
+    for match in counting(ROW_TOKEN, __name__ + '.ROW_TOKEN', regex_calls).finditer(text, start):
+        token : str = match.group()
+        if token == '\\\\':
+            if depth == 0:
+                rows.append((start, match.start()))
+                start = match.end()
+        elif token == '{' or token.startswith('\\begin'):
+            depth += 1
+        elif token.startswith('\\end'):
+            if depth == 0:
+                rows.append((start, match.start()))
+                # A \\ after the last row doesn't start another one
+                if len(rows) > 1 and not text[start:match.start()].strip():
+                    rows.pop()
+                return rows, begin, match.start()
+            depth -= 1
+        elif token == '}':
+            depth = max(depth - 1, 0)
+    return None
+
+def outside_aligned(text: str, begin: int, end: int) -> bool:
+    """
+        Whether `text` has a \\label before the \\begin{aligned} at `begin` or after the
+        \\end{aligned} at `end`. Like \\label in an equation around aligned, it labels the
+        whole block, which gets one number.
+    """
+
+    return text.find('\\label{', 0, begin) >= 0 or text.find('\\label{', end) >= 0
+
+def numbered_rows(text: str) -> List[Tuple[int, int]]:
+    """
+        The (start, end) offsets of the parts of a labelled equation that get a number: every
+        row of an aligned environment labelled inside, which becomes align, or else the whole
+        equation, unless marked \\notag or \\nonumber or given its own \\tag.
+    """
 
+    aligned = aligned_rows(text)
+    if aligned is None or outside_aligned(text, aligned[1], aligned[2]):
+        return [] if UNNUMBERED.search(text) else [(0, len(text))]
+    return [(start, end) for start, end in aligned[0] if UNNUMBERED.search(text, start, end) is None]
 
-            # Add one to counter and reset deeper counters
-            amsthm_settings.section_counters[level - 1] += 1
-            for i in range(elem.level, MAX_SECTION_DEPTH):
-                amsthm_settings.section_counters[i] = 0
+def labelled_equations(text: str) -> int:
+    """
+        How many equation numbers `number_equations` uses for a Math element with this text.
+    """
 
-            #### If any theorem counters have section:level as parent, reset
-            for theorem_counter in amsthm_settings.theorem_counters:
-                if amsthm_settings.theorems[theorem_counter].parent_counter == section:
-                    amsthm_settings.theorem_counters[theorem_counter] = 0
+    if '\\label' not in text or LABEL.search(text) is None:
+        return 0
+    return len(numbered_rows(text))
 
-            # Reset equation counter on new section
-            if section == 'section':
-                amsthm_settings.equation_counter = 1
+def collect_equation(elem: pf.Math, amsthm_settings: AmsthmSettings) -> None:
+    """
+        Queue an equation that may be labelled to be numbered with the rest of its section,
+        leaving unlabelled Math untouched without any regex work.
+    """
 
+    if '\\label' in elem.text:
+        amsthm_settings.pending_equations.append(elem)
 
-    elif isinstance(elem, pf.Math):
+def number_equations(amsthm_settings: AmsthmSettings) -> None:
+    """
+        Number the equations queued since the start of the section, record their labels in
+        `equations` and rewrite each Math element once.
 
-        if re.findall(r'\\label{.*}', elem.text):
+        Every row MathJax would number gets a \\tag, labelled or not, so that the numbers shown
+        are the ones static references use.
+    """
 
-            if re.search(r'\\begin{aligned}', elem.text):
-                # MathJax doesn't number 'aligned' environments, so change to 'align'
-                elem.text = re.sub(r'\\begin{aligned}', r'\\begin{align}', elem.text)
-                elem.text = re.sub(r'\\end{aligned}', r'\\end{align}', elem.text)
+    pending : List[PendingEquation] = amsthm_settings.pending_equations
+    if not pending:
+        return
+
+    prefix : str = '%d.' % amsthm_settings.section_counters[0] if amsthm_settings.number_within else ''
+    counter : int = amsthm_settings.equation_counter
+    equations : Dict[str, str] = amsthm_settings.equations
+    regex_calls : Counter | None = amsthm_settings.regex_calls
+    label = counting(LABEL, __name__ + '.LABEL', regex_calls)
+    unnumbered = counting(UNNUMBERED, __name__ + '.UNNUMBERED', regex_calls)
+
+    for elem in pending:
+        text : str = elem.text
+        aligned = aligned_rows(text, regex_calls) if '\\begin{aligned}' in text else None
+        if aligned is not None and outside_aligned(text, aligned[1], aligned[2]):
+            aligned = None
+
+        if aligned is None:
+            # Only the names are needed, which findall collects without match objects
+            names : List[str] = label.findall(text)
+            if not names or unnumbered.search(text) is not None:
+                continue
+            number : str = prefix + str(counter)
+            counter += 1
+            for name in names:
+                equations[name] = number
+            # Put Math inside \begin{equation} tags, with our number so that it matches static references
+            elem.text = '\\begin{equation}%s\\tag{%s}\\end{equation}' % (text, number)
+            continue
+
+        rows, begin, end = aligned
+        first : int = counter
+        labelled : bool = False
+        # MathJax doesn't number 'aligned' environments, so change to 'align', and tag each
+        # numbered row after its labels or else at its end, rebuilding the text once
+        pieces : List[str] = [text[:begin], '\\begin{align}']
+        last : int = begin + len('\\begin{aligned}')
+        # Most blocks have no unnumbered row, which one search over the block tells
+        any_unnumbered : bool = unnumbered.search(text, last, end) is not None
+        for start, row_end in rows:
+            if any_unnumbered and unnumbered.search(text, start, row_end) is not None:
+                continue
+            number = prefix + str(counter)
+            counter += 1
+            position : int = row_end
+            for match in label.finditer(text, start, row_end):
+                equations[match.group(1)] = number
+                position = match.end()
+                labelled = True
+            pieces.append(text[last:position])
+            pieces.append('\\tag{%s}' % number)
+            last = position
+        if not labelled and label.search(text, begin, end) is None:
+            # What looked like a label when it was queued isn't one, e.g. \labelsep
+            counter = first
+            continue
+        pieces.append(text[last:end])
+        pieces.append('\\end{align}')
+        pieces.append(text[end + len('\\end{aligned}'):])
+        elem.text = ''.join(pieces)
+
+    amsthm_settings.equation_counter = counter
+    pending.clear()
+
+def number_equation(elem: pf.Math, amsthm_settings: AmsthmSettings) -> None:
+    """
+        Number a single labelled equation straight away.
+    """
 
+    collect_equation(elem, amsthm_settings)
+    number_equations(amsthm_settings)
 
-                matches = re.finditer(r'\\label{.*}', elem.text)
-                offset_from_previously_added = 0
-                for match in matches:
-                    if amsthm_settings.number_within:
-                        equation_number : str = str(amsthm_settings.section_counters[0]) + '.' + str(amsthm_settings.equation_counter)
-                        # Calculate index of end of match, accounting for adding characters to elem.text previously
-                        index = match.end() + offset_from_previously_added
-                        elem.text = elem.text[:index] + '\\tag{'+equation_number+'}' + elem.text[index:]
-                        offset_from_previously_added += len('\\tag{'+equation_number+'}')
-                    amsthm_settings.equation_counter += 1
-            else:
-                # Put Math inside \begin{equation} tags so that MathJax automatically numbers the equation
-                current_text : str = elem.text
-                if amsthm_settings.number_within:
-                    equation_number : str = str(amsthm_settings.section_counters[0]) + '.' + str(amsthm_settings.equation_counter)
-                    elem.text = '\\begin{equation}' + current_text + '\\tag{'+equation_number+'}' + '\\end{equation}'
-                else:
-                    elem.text = '\\begin{equation}' + current_text +  '\\end{equation}'
+def equation_anchor(label: str) -> str:
+    """
+        The id MathJax gives the equation labelled `label`.
+    """
+
+    return 'mjx-eqn:' + label.replace(' ', '_')
+
+def amsthm_numbering(elem: pf.Element, doc: pf.Doc) -> None:
+    """
+        Action that re-numbers amsthm environments and numbers labelled equations.
+    """
+
+    amsthm_settings: AmsthmSettings = doc._amsthm_settings
+
+    if isinstance(elem, pf.Header):
+        if elem.level <= MAX_SECTION_DEPTH:
+            if elem.level == 1:
+                # The equations of the section just ended are numbered together
+                number_equations(amsthm_settings)
+            amsthm_settings.start_section(elem.level)
+
+    elif isinstance(elem, pf.Math):
 
-                amsthm_settings.equation_counter += 1
+        if '\\qedhere' in elem.text:
+            replace_qed_here(elem, amsthm_settings)
+        collect_equation(elem, amsthm_settings)
 
         return elem
 
     elif isinstance(elem, pf.Div):
-        environments: set[str] = set(amsthm_settings.theorems).intersection(elem.classes)
-        if environments:
-            if len(environments) != 1:
-                logger.warning("Multiple environments found: %s", environments)
-                return None
-            env_name : str = environments.pop()
-
-            if env_name == 'proof':
-                # Move the qed symbol in the case the user writes \qedhere
-                if re.search(r'\\qedhere', str(elem.content)):
-                        elem.walk(replace_qed_here)
+        theorem_type : AmsTheorem | None = amsthm_settings.classify(elem.classes)
+        if theorem_type is not None:
+            if theorem_type.env_name == 'proof':
+                # The qed symbol was moved into an equation by \qedhere while walking the proof
+                if id(elem) in amsthm_settings.qed_proofs:
+                    remove_qed_symbol(elem)
             else:
-                theorem_type : AmsTheorem = amsthm_settings.theorems[env_name]
-                id : str = elem.identifier
+                identifier : str = elem.identifier
 
                 ## Update counters
-                thm_counter : str | None = theorem_type.shared_counter
+                thm_counter : int | None = theorem_type.counter
                 if thm_counter is not None:
-                    amsthm_settings.theorem_counters[thm_counter] += 1
-                elif env_name in amsthm_settings.theorem_counters:
-                    thm_counter = env_name
-                    amsthm_settings.theorem_counters[env_name] += 1
-
-                #################################################################
-                ## NEED: improve this section to make it more robust and readable.
-
-                theorem_number : str = str(amsthm_settings.section_counters[0]) + '.' + str(amsthm_settings.theorem_counters[thm_counter])
-                theorem_text : List[pf.Element] = [pf.Str(theorem_type.text), pf.Space, pf.Str(theorem_number)]
-
-                amsthm_settings.identifiers[id] = theorem_number
+                    amsthm_settings.step_counter(thm_counter)
+                    theorem_number : str = amsthm_settings.counter_number(thm_counter)
+                    theorem_text : List[pf.Element] = [pf.Str(theorem_type.text), pf.Space, pf.Str(theorem_number)]
+                    amsthm_settings.identifiers[identifier] = theorem_number
+                else:
+                    # Unnumbered theorem, e.g. \newtheorem*
+                    theorem_text = [pf.Str(theorem_type.text)]
 
                 if not isinstance(elem.content[0], pf.Para):
                     logger.warning("Theorem environment not wrapped in Para!")
@@ -264,17 +641,15 @@ def amsthm_numbering(elem: pf.Element, doc: pf.Doc) -> None:
 
 def link_to_ref_type(elem: pf.Link) -> tuple[str, str] | None:
     """
-        Takes a panflute Link element and returns its reference and reference-type.
+        Takes a panflute Link element and returns its reference and reference-type,
+        or None for an ordinary link.
     """
 
-    if not 'reference' in elem.attributes:
-        logger.warning("Link: %s has no reference. Ignoring...", elem)
+    reference : str | None = elem.attributes.get('reference', None)
+    if reference is None:
         return None
 
-    reference : pf.Str = elem.attributes.get('reference', None)
-    type = elem.attributes.get('reference-type', None)
-
-    return reference, type
+    return reference, elem.attributes.get('reference-type', None)
 
 
 def resolve_ref(elem: pf.Element, doc: pf.Doc) -> None:
@@ -284,11 +659,20 @@ def resolve_ref(elem: pf.Element, doc: pf.Doc) -> None:
 
     amsthm_settings: AmsthmSettings = doc._amsthm_settings
     if isinstance(elem, pf.Link):
-        ref, type = link_to_ref_type(elem)
+        reference : tuple[str, str] | None = link_to_ref_type(elem)
+        if reference is None:
+            return None
+        ref, type = reference
 
         if type == "eqref":
-            # Put \eqref inside Math tags, so that MathJax can see it
-            elem.content = [pf.Math("\\eqref{"+ref+"}",format='InlineMath')]
+            number : str | None = amsthm_settings.equations.get(ref)
+            if number is not None:
+                # Numbered by us, so the reference is static text
+                elem.content = [pf.Str('(%s)' % number)]
+                elem.url = '#' + equation_anchor(ref)
+            else:
+                # Put \eqref inside Math tags, so that MathJax can see it
+                elem.content = [pf.Math("\\eqref{"+ref+"}",format='InlineMath')]
             return elem
 
         elif type is not None and ref in amsthm_settings.identifiers:
@@ -297,6 +681,12 @@ def resolve_ref(elem: pf.Element, doc: pf.Doc) -> None:
                 elem.content = [pf.Str(amsthm_settings.identifiers[ref])]
                 return elem
 
+        elif type == "ref" and ref in amsthm_settings.equations:
+            # \ref to a labelled equation gives its number without parentheses
+            elem.content = [pf.Str(amsthm_settings.equations[ref])]
+            elem.url = '#' + equation_anchor(ref)
+            return elem
+
 ### TODO:
 #  - if it is a plain style, make it italic.
 #  - are styles exactly right? -- currently all the same.
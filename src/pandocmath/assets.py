@@ -0,0 +1,138 @@
+"""
+    Opt-in self-hosted MathJax assets, shared by every page in an output directory.
+
+    Instead of inlining the MathJax configuration into each page, the filter writes one script
+    holding the configuration and the MathJax loader to the assets directory, named by the hash
+    of its content, and points the page's `math` template variable at it, replacing the script
+    pandoc adds for --mathjax. Pages with the same needs share the same file, and since its name
+    changes whenever its content does, it can be served with long-lived cache headers. XyJax is
+    only loaded by pages whose maths use \\xymatrix or \\xy.
+
+    Enable with `pandoc-math-assets-dir` in the metadata or PANDOC_MATH_ASSETS in the environment,
+    and `pandoc-math-assets-url` for the URL pages load the directory from (by default the
+    directory as given). For air-gapped deployments, point `pandoc-math-mathjax` (or
+    PANDOC_MATH_MATHJAX) at a local MathJax component such as `es5/tex-svg.js`, and
+    `pandoc-math-xyjax` (or PANDOC_MATH_XYJAX) at XyJax's `xypic.js`: both are copied into
+    the assets directory and nothing is loaded from a CDN.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+from collections import Counter
+from pathlib import Path
+
+import panflute as pf
+
+from pandocmath.profiling import counting
+
+# Setup logging
+logger : logging.Logger = logging.getLogger(__name__)
+
+ASSETS_ENV : str = 'PANDOC_MATH_ASSETS'
+ASSETS_METADATA : str = 'pandoc-math-assets-dir'
+ASSETS_URL_METADATA : str = 'pandoc-math-assets-url'
+MATHJAX_ENV : str = 'PANDOC_MATH_MATHJAX'
+MATHJAX_METADATA : str = 'pandoc-math-mathjax'
+XYJAX_ENV : str = 'PANDOC_MATH_XYJAX'
+XYJAX_METADATA : str = 'pandoc-math-xyjax'
+
+# Assets directory next to the pages, as written by `build --assets`
+DEFAULT_DIRECTORY : str = 'pandoc-math-assets'
+
+MATHJAX_URL : str = 'https://cdn.jsdelivr.net/npm/mathjax@3/es5/tex-chtml-full.js'
+XYJAX_URL : str = 'https://cdn.jsdelivr.net/gh/sonoisa/XyJax-v3@3.0.1/build/'
+
+XYPIC : re.Pattern = re.compile(r'\\xy(?:matrix)?(?![A-Za-z])')
+
+def uses_xypic(text: str, regex_calls: Counter | None = None) -> bool:
+
+    return '\\xy' in text and counting(XYPIC, __name__ + '.XYPIC', regex_calls).search(text) is not None
+
+def assets_directory(doc: pf.Doc) -> str | None:
+    """
+        Where to write the MathJax assets, from the environment or the document metadata. None if not enabled.
+    """
+
+    return os.environ.get(ASSETS_ENV) or doc.get_metadata(ASSETS_METADATA, None) or None
+
+def write_asset(directory: Path, stem: str, content: bytes) -> str:
+    """
+        Write `content` to `<stem>-<hash>.js` in `directory` unless it is already there, returning the file name.
+    """
+
+    name : str = '%s-%s.js' % (stem, hashlib.sha256(content).hexdigest()[:16])
+    path : Path = directory / name
+    if not path.is_file():
+        directory.mkdir(parents=True, exist_ok=True)
+        # Other conversions may be writing the same file: write a copy and rename it into place
+        fd, temporary = tempfile.mkstemp(dir=str(directory), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as file:
+            file.write(content)
+        os.replace(temporary, path)
+    return name
+
+def mathjax_config(xypic_url: str | None = None) -> dict:
+    """
+        The MathJax configuration, loading XyJax from `xypic_url` if given.
+    """
+
+    config : dict = {'tex': {'macros': {'relax': ''}, 'tags': 'ams'}}
+    if xypic_url is not None:
+        config['loader'] = {'load': ['[pandoc-math]/' + xypic_url.rsplit('/', 1)[-1]],
+            'paths': {'pandoc-math': xypic_url.rsplit('/', 1)[0]}}
+        config['tex']['packages'] = {'[+]': ['xypic']}
+    return config
+
+def mathjax_bundle(directory: Path, url: str, xypic: bool, mathjax: str | None = None,
+        xyjax: str | None = None) -> str:
+    """
+        Write the MathJax script for a page to `directory` and return its URL.
+
+        The script sets the configuration, then runs the local MathJax component `mathjax`
+        or, without one, loads MathJax from the CDN.
+    """
+
+    url = url.rstrip('/')
+    xypic_url : str | None = None
+    if xypic:
+        if xyjax:
+            xypic_url = url + '/' + write_asset(directory, 'xypic', Path(xyjax).read_bytes())
+        else:
+            xypic_url = XYJAX_URL + 'xypic.js'
+
+    script : str = 'window.MathJax = %s;\n' % json.dumps(mathjax_config(xypic_url), sort_keys=True)
+    if mathjax:
+        script += Path(mathjax).read_text(encoding='utf-8')
+    else:
+        script += ("(function () {\n"
+            "  var script = document.createElement('script');\n"
+            "  script.src = %s;\n"
+            "  script.async = true;\n"
+            "  document.head.appendChild(script);\n"
+            "})();\n") % json.dumps(MATHJAX_URL)
+
+    return url + '/' + write_asset(directory, 'mathjax', script.encode('utf-8'))
+
+def use_mathjax_bundle(doc: pf.Doc, directory: str, xypic: bool) -> bool:
+    """
+        Write the page's MathJax bundle and load it in place of pandoc's MathJax script.
+        Returns False, after logging why, if the bundle could not be written.
+    """
+
+    url : str = doc.get_metadata(ASSETS_URL_METADATA, None) or directory
+    mathjax : str | None = os.environ.get(MATHJAX_ENV) or doc.get_metadata(MATHJAX_METADATA, None)
+    xyjax : str | None = os.environ.get(XYJAX_ENV) or doc.get_metadata(XYJAX_METADATA, None)
+    try:
+        script_url : str = mathjax_bundle(Path(directory), url, xypic, mathjax, xyjax)
+    except OSError as error:
+        logger.warning('Cannot write MathJax assets to %s, inlining the configuration instead: %s', directory, error)
+        return False
+
+    doc.metadata['math'] = pf.MetaInlines(pf.RawInline('<script defer src="%s"></script>' % script_url, format='html'))
+    return True
@@ -0,0 +1,121 @@
+from __future__ import annotations
+
+import argparse
+import logging
+import os
+import re
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+from typing import Dict, List, Tuple
+
+from pandocmath.conversion import ConversionResult, convert_file
+from pandocmath.label_index import resolve_files
+
+# Setup logging
+logger : logging.Logger = logging.getLogger(__name__)
+
+# Only files with a \documentclass are documents, the rest are \input into them
+DOCUMENTCLASS : re.Pattern = re.compile(r'^[ \t]*\\documentclass\b', re.MULTILINE)
+
+def is_root_document(path: Path) -> bool:
+
+    try:
+        with open(path, 'r', encoding='utf-8', errors='replace') as file:
+            return DOCUMENTCLASS.search(file.read()) is not None
+    except OSError:
+        return False
+
+def discover_documents(root: Path) -> List[Path]:
+    """
+        Find all LaTeX documents below `root`, skipping files that are only \\input by others.
+    """
+
+    return sorted(path for path in Path(root).rglob('*') if path.suffix.lower() == '.tex'
+        and path.is_file() and is_root_document(path))
+
+def _convert(source: Path, use_cache: bool, label_index: Path | None = None,
+        profile: bool = False, settings_bundle: Path | None = None,
+        assets: bool = False) -> Tuple[ConversionResult | None, float, str]:
+    # Runs in a worker process, so errors are returned rather than raised
+    start : float = time.perf_counter()
+    try:
+        result : ConversionResult = convert_file(source, source.with_suffix('.html'), use_cache, label_index, profile,
+            settings_bundle=settings_bundle, assets=assets)
+        return result, time.perf_counter() - start, ''
+    except Exception as error:
+        return None, time.perf_counter() - start, '%s: %s' % (type(error).__name__, error)
+
+def build(root: Path, jobs: int | None = None, use_cache: bool = True, label_index: Path | None = None,
+        profile: bool = False, settings_bundle: Path | None = None, assets: bool = False) -> int:
+    """
+        Convert every document below `root` to html next to its source using `jobs` worker processes.
+
+        Per-file status is printed as each conversion finishes. Returns the number of failed files.
+        With a `label_index`, references between the documents are resolved once all are converted.
+        With `profile`, a profile report is written next to each output.
+        With a `settings_bundle`, every document uses its amsthm settings instead of reading its preamble.
+        With `assets`, the pages of each directory share MathJax scripts in `pandoc-math-assets`.
+    """
+
+    documents : List[Path] = discover_documents(root)
+    if not documents:
+        logger.warning("No .tex documents found in %s", root)
+        return 0
+
+    jobs = max(1, min(jobs or os.cpu_count() or 1, len(documents)))
+    failed : int = 0
+    start : float = time.perf_counter()
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures : Dict[Future, Path] = {
+            executor.submit(_convert, path, use_cache, label_index, profile, settings_bundle, assets): path
+            for path in documents}
+        for future in as_completed(futures):
+            source : Path = futures[future]
+            result, elapsed, error = future.result()
+            if result is not None and result.ok:
+                status : str = '[cached]' if result.cached else '[ok]    '
+                print('%s %s (%.2fs)' % (status, source, elapsed), flush=True)
+            else:
+                failed += 1
+                print('[failed] %s (%.2fs)' % (source, elapsed), flush=True)
+                message : str = error or result.stderr.strip()
+                if message:
+                    print('    ' + message.replace('\n', '\n    '), flush=True)
+
+    print('%d of %d documents converted in %.2fs using %d jobs'
+        % (len(documents) - failed, len(documents), time.perf_counter() - start, jobs), flush=True)
+
+    if label_index is not None:
+        outputs : List[Path] = [path.with_suffix('.html') for path in documents if path.with_suffix('.html').is_file()]
+        print('%d cross-document references resolved' % resolve_files(outputs, label_index), flush=True)
+    return failed
+
+def main(argv: List[str]) -> int:
+    parser : argparse.ArgumentParser = argparse.ArgumentParser(
+        prog='pandoc-math build',
+        description='Convert every LaTeX document in a directory to html.',
+    )
+    parser.add_argument('directory', help='directory searched recursively for .tex documents')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+        help='number of parallel conversions (default: number of CPUs)')
+    parser.add_argument('--no-cache', action='store_true', help='always convert, ignoring the conversion cache')
+    parser.add_argument('--label-index', default=None,
+        help='SQLite label index used to resolve references between the documents')
+    parser.add_argument('--profile', action='store_true',
+        help='write a per-stage profile report next to each html output')
+    parser.add_argument('--settings', default=None,
+        help='amsthm settings bundle from compile-preamble, used instead of each preamble')
+    parser.add_argument('--assets', action='store_true',
+        help='load MathJax from a content-hashed script shared by the pages of each directory')
+    args : argparse.Namespace = parser.parse_args(argv)
+
+    if not Path(args.directory).is_dir():
+        logger.error("No such directory: %s", args.directory)
+        return 2
+
+    return 1 if build(Path(args.directory), args.jobs, not args.no_cache,
+        Path(args.label_index) if args.label_index else None, args.profile,
+        Path(args.settings) if args.settings else None, args.assets) else 0
@@ -0,0 +1,162 @@
+"""
+    Precompiled amsthm settings bundles, for repositories whose documents share one preamble.
+
+        pandoc-math compile-preamble preamble.tex -o settings.json
+
+    parses the preamble once and writes its amsthm settings as versioned JSON, with a checksum of
+    the content and hashes of the preamble files it was read from. Given a bundle (through the
+    `pandoc-math-settings` metadata, PANDOC_MATH_SETTINGS, or `build --settings`), the filter
+    builds its theorem table straight from it. Bundles whose preamble files have changed since
+    they were compiled are rejected as stale.
+"""
+
+from __future__ import annotations
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+
+from typing import Dict, List, Tuple
+
+from pandocmath._version import __version__
+from pandocmath.ams import AMSTHM_STYLES, AmsthmSettings
+from pandocmath.cache import read_json
+
+# Setup logging
+logger : logging.Logger = logging.getLogger(__name__)
+
+BUNDLE_FORMAT : int = 1
+BUNDLE_ENV : str = 'PANDOC_MATH_SETTINGS'
+BUNDLE_METADATA : str = 'pandoc-math-settings'
+
+class InvalidBundle(ValueError):
+    """
+        The settings bundle is unreadable, from another format version, or fails its checksum.
+    """
+
+class StaleBundle(InvalidBundle):
+    """
+        A preamble file the bundle was compiled from has changed since.
+    """
+
+# path -> (mtime_ns, bundle)
+_bundle_cache : Dict[str, Tuple[int, dict]] = {}
+
+def file_hash(path: str) -> str:
+
+    with open(path, 'rb') as file:
+        return hashlib.sha256(file.read()).hexdigest()
+
+def checksum(bundle: dict) -> str:
+    """
+        sha256 of the bundle's canonical JSON, leaving out the checksum itself.
+    """
+
+    content : dict = {key: value for key, value in bundle.items() if key != 'checksum'}
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode('utf-8')).hexdigest()
+
+def validate_settings(amsthm_settings: dict) -> None:
+    """
+        Check that the settings describe well-formed theorems and that AmsthmSettings accepts them.
+    """
+
+    for style in AMSTHM_STYLES:
+        for theorem in amsthm_settings.get(style) or []:
+            if not theorem.get('env_name') or not theorem.get('text'):
+                raise InvalidBundle('Theorem without an environment name or text: %r' % theorem)
+    unknown : List[str] = [key for key in amsthm_settings
+        if key not in AMSTHM_STYLES and key not in ('number_within', 'counter_parents')]
+    if unknown:
+        logger.warning('Theorems with unsupported styles are ignored: %s', ', '.join(unknown))
+
+    AmsthmSettings(settings=amsthm_settings)
+
+def compile_preamble(source: Path) -> dict:
+    """
+        Read the amsthm settings from the preamble of `source` into a bundle.
+    """
+
+    # Imported here: loading a bundle, which the filter does, needs no LaTeX parser
+    from pandocmath.latex_reader import read_metadata_from_file, read_preamble
+
+    source = Path(source).resolve()
+    metadata : dict = read_metadata_from_file(str(source))
+    _, dependencies = read_preamble(str(source))
+    validate_settings(metadata['amsthm_settings'])
+
+    bundle : dict = {
+        'format': BUNDLE_FORMAT,
+        'pandoc_math_version': __version__,
+        'sources': {path: file_hash(path) for path, mtime in dependencies if mtime >= 0},
+        'amsthm_settings': metadata['amsthm_settings'],
+    }
+    bundle['checksum'] = checksum(bundle)
+    return bundle
+
+def check_bundle(bundle: dict, check_sources: bool = True) -> None:
+    """
+        Raise InvalidBundle if the bundle is malformed or corrupted, or StaleBundle if out of date.
+    """
+
+    if not isinstance(bundle, dict) or bundle.get('format') != BUNDLE_FORMAT:
+        raise InvalidBundle('Unsupported settings bundle format, recompile it with this version of pandoc-math.')
+    if bundle.get('checksum') != checksum(bundle):
+        raise InvalidBundle('Settings bundle checksum does not match its content.')
+
+    if check_sources:
+        for path, digest in bundle.get('sources', {}).items():
+            try:
+                current : str = file_hash(path)
+            except OSError:
+                raise StaleBundle('Preamble file %s of the settings bundle is missing.' % path)
+            if current != digest:
+                raise StaleBundle('Preamble file %s changed since the settings bundle was compiled.' % path)
+
+def load_bundle(path: str | Path, check_sources: bool = True) -> dict:
+    """
+        Load and check a settings bundle, memoised in this process while the file is unchanged.
+    """
+
+    key : str = str(Path(path).resolve())
+    mtime : int = os.stat(key).st_mtime_ns
+    cached = _bundle_cache.get(key)
+    if cached is not None and cached[0] == mtime:
+        bundle : dict = cached[1]
+    else:
+        # Unreadable files come back empty and fail the format check
+        bundle = read_json(Path(key))
+
+    check_bundle(bundle, check_sources)
+    _bundle_cache[key] = (mtime, bundle)
+    return bundle
+
+def main(argv: List[str]) -> int:
+    parser : argparse.ArgumentParser = argparse.ArgumentParser(
+        prog='pandoc-math compile-preamble',
+        description='Compile the amsthm settings of a LaTeX preamble into a bundle shared by many documents.',
+    )
+    parser.add_argument('file', help='TeX file (or preamble) declaring the theorems')
+    parser.add_argument('-o', '--output', default=None,
+        help='bundle to write (default: pandoc-math-settings.json next to the TeX file)')
+    args : argparse.Namespace = parser.parse_args(argv)
+
+    source : Path = Path(args.file)
+    if not source.is_file():
+        logger.error("No such file: %s", args.file)
+        return 2
+
+    try:
+        bundle : dict = compile_preamble(source)
+    except InvalidBundle as error:
+        logger.error('%s', error)
+        return 1
+
+    output : Path = Path(args.output) if args.output else source.parent / 'pandoc-math-settings.json'
+    with open(output, 'w', encoding='utf-8') as file:
+        json.dump(bundle, file, indent=2)
+    print('Wrote settings for %d theorem environments to %s' % (
+        sum(len(bundle['amsthm_settings'].get(style) or []) for style in AMSTHM_STYLES), output))
+    return 0
@@ -0,0 +1,149 @@
+from __future__ import annotations
+
+import json
+import logging
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+from typing import Dict, List, Tuple
+
+# Setup logging
+logger : logging.Logger = logging.getLogger(__name__)
+
+CACHE_DIR_ENV : str = 'PANDOC_MATH_CACHE_DIR'
+
+def cache_dir() -> Path:
+    """
+        Return the directory pandoc-math keeps its on-disk caches in.
+
+        Uses $PANDOC_MATH_CACHE_DIR if set, otherwise the platform's user cache directory.
+    """
+
+    override : str | None = os.environ.get(CACHE_DIR_ENV)
+    if override:
+        return Path(override)
+
+    if sys.platform == 'win32':
+        base : str = os.environ.get('LOCALAPPDATA') or str(Path.home() / 'AppData' / 'Local')
+    else:
+        base = os.environ.get('XDG_CACHE_HOME') or str(Path.home() / '.cache')
+
+    return Path(base) / 'pandoc-math'
+
+def read_json(path: Path) -> dict:
+    """
+        Read a JSON cache file, returning an empty dict if it is missing or unreadable.
+    """
+
+    try:
+        with open(path, 'r', encoding='utf-8') as file:
+            data = json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+    return data if isinstance(data, dict) else {}
+
+def write_json(path: Path, data: dict) -> None:
+    """
+        Atomically replace a JSON cache file. Failures are logged and otherwise ignored.
+    """
+
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_name = tempfile.mkstemp(dir=str(path.parent), prefix=path.name, suffix='.tmp')
+        with os.fdopen(fd, 'w', encoding='utf-8') as file:
+            json.dump(data, file)
+        os.replace(tmp_name, path)
+    except OSError as error:
+        logger.debug('Could not write cache file %s: %s', path, error)
+
+class LRUCache:
+    """
+        Directory of content-addressed blobs, bounded to `max_bytes` by evicting the least
+        recently used entries. Reading an entry marks it as used by touching its mtime.
+    """
+
+    directory : Path
+    max_bytes : int
+
+    def __init__(self, directory: Path, max_bytes: int) -> None:
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+
+    def _path(self, key: str) -> Path:
+        return self.directory / key
+
+    def get(self, key: str) -> bytes | None:
+
+        path : Path = self._path(key)
+        try:
+            with open(path, 'rb') as file:
+                data : bytes = file.read()
+        except OSError:
+            return None
+
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return data
+
+    def _write(self, key: str, data: bytes) -> None:
+
+        path : Path = self._path(key)
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            fd, tmp_name = tempfile.mkstemp(dir=str(self.directory), prefix='.' + key, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as file:
+                file.write(data)
+            os.replace(tmp_name, path)
+        except OSError as error:
+            logger.debug('Could not write cache entry %s: %s', path, error)
+
+    def put(self, key: str, data: bytes) -> None:
+
+        self._write(key, data)
+        self.evict()
+
+    def put_many(self, entries: Dict[str, bytes]) -> None:
+        """
+            Store several entries, evicting once at the end.
+        """
+
+        if not entries:
+            return
+        for key, data in entries.items():
+            self._write(key, data)
+        self.evict()
+
+    def evict(self) -> None:
+        """
+            Remove least recently used entries until the cache fits in `max_bytes`.
+        """
+
+        entries : List[Tuple[float, int, str]] = []
+        total : int = 0
+        try:
+            with os.scandir(self.directory) as it:
+                for entry in it:
+                    if entry.is_file() and not entry.name.startswith('.'):
+                        stat : os.stat_result = entry.stat()
+                        entries.append((stat.st_mtime, stat.st_size, entry.path))
+                        total += stat.st_size
+        except OSError:
+            return
+
+        if total <= self.max_bytes:
+            return
+
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
@@ -0,0 +1,111 @@
+"""
+    Minimal pandoc filter that forwards documents to a running `pandoc-math serve` daemon.
+
+    Use it in place of the regular filter:
+
+        pandoc main.tex -o output.html -s --mathjax --filter pandoc-math-client
+
+    If no daemon is listening, the document is filtered in-process instead. This module
+    deliberately imports nothing beyond the standard library until that fallback is needed.
+
+    Each request carries the client's working directory and PANDOC_MATH_* environment, which the
+    daemon filters the document with, so that the output is the same as the filter's own.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import socket
+import struct
+import sys
+import tempfile
+
+SOCKET_ENV : str = 'PANDOC_MATH_SOCKET'
+ENVIRONMENT_PREFIX : str = 'PANDOC_MATH_'
+
+STATUS_OK : bytes = b'ok'
+STATUS_ERROR : bytes = b'error'
+
+_LENGTH : struct.Struct = struct.Struct('>Q')
+
+def socket_path() -> str:
+    """
+        Path of the daemon's Unix socket: $PANDOC_MATH_SOCKET, else a per-user runtime path.
+    """
+
+    override : str | None = os.environ.get(SOCKET_ENV)
+    if override:
+        return override
+
+    runtime_dir : str = os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir()
+    user : str = str(os.getuid()) if hasattr(os, 'getuid') else os.environ.get('USERNAME', 'user')
+    return os.path.join(runtime_dir, 'pandoc-math-%s.sock' % user)
+
+def send_frame(sock: socket.socket, data: bytes) -> None:
+
+    sock.sendall(_LENGTH.pack(len(data)) + data)
+
+def _recv_exactly(sock: socket.socket, size: int) -> bytes:
+
+    chunks : list = []
+    while size:
+        chunk : bytes = sock.recv(min(size, 1 << 20))
+        if not chunk:
+            raise ConnectionError('connection closed by peer')
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+def recv_frame(sock: socket.socket) -> bytes:
+
+    (size,) = _LENGTH.unpack(_recv_exactly(sock, _LENGTH.size))
+    return _recv_exactly(sock, size)
+
+def request_context() -> dict:
+    """
+        The working directory and pandoc-math settings from the environment the filter would run with.
+    """
+
+    return {
+        'cwd': os.getcwd(),
+        'environment': {key: value for key, value in os.environ.items()
+            if key.startswith(ENVIRONMENT_PREFIX) and key != SOCKET_ENV},
+    }
+
+def request(target_format: str, document: bytes, path: str | None = None,
+        context: dict | None = None) -> tuple[bytes, bytes, bytes]:
+    """
+        Send one document to the daemon, to be filtered in `context` (by default this process's
+        `request_context`), and return its (status, output, log) frames.
+    """
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(path or socket_path())
+        send_frame(sock, target_format.encode('utf-8'))
+        send_frame(sock, json.dumps(request_context() if context is None else context).encode('utf-8'))
+        send_frame(sock, document)
+        return recv_frame(sock), recv_frame(sock), recv_frame(sock)
+
+def main() -> None:
+
+    target_format : str = sys.argv[1] if len(sys.argv) > 1 else 'html'
+    document : bytes = sys.stdin.buffer.read()
+
+    try:
+        if not hasattr(socket, 'AF_UNIX'):
+            raise OSError('Unix sockets are not available')
+        status, output, log = request(target_format, document)
+    except OSError:
+        # No daemon running: filter in this process
+        from pandocmath.filter import filter_json
+        output = filter_json(document.decode('utf-8'), target_format).encode('utf-8')
+        status, log = STATUS_OK, b''
+
+    sys.stderr.buffer.write(log)
+    if status != STATUS_OK:
+        sys.exit(1)
+    sys.stdout.buffer.write(output)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,262 @@
+from __future__ import annotations
+
+import hashlib
+import io
+import json
+import logging
+import os
+import subprocess
+from dataclasses import dataclass
+from pathlib import Path
+
+import yaml
+
+from typing import List, Sequence
+
+from pandocmath._version import __version__
+from pandocmath.assets import ASSETS_ENV, ASSETS_METADATA, ASSETS_URL_METADATA, DEFAULT_DIRECTORY, MATHJAX_ENV, XYJAX_ENV
+from pandocmath.bundle import BUNDLE_ENV, BUNDLE_METADATA, load_bundle
+from pandocmath.cache import LRUCache, cache_dir
+from pandocmath.filter import filter_document
+from pandocmath.label_index import DOCUMENT_METADATA, LABEL_INDEX_METADATA, LabelIndex, document_name
+from pandocmath.latex_reader import find_included_files, read_metadata_from_file, read_preamble
+from pandocmath.logs import captured_logs
+from pandocmath.pandoc_info import pandoc_version
+from pandocmath.parallel import filter_parallel, parallel_jobs
+from pandocmath.prerender import PRERENDER_ENV
+from pandocmath.profiling import PROFILE_METADATA
+
+# Setup logging
+logger : logging.Logger = logging.getLogger(__name__)
+
+CACHE_SIZE_ENV : str = 'PANDOC_MATH_CACHE_SIZE_MB'
+DEFAULT_CACHE_SIZE_MB : int = 256
+
+# Environment options the filter reads while converting, and those naming files whose content it reads
+FILTER_ENVIRONMENT : List[str] = [PRERENDER_ENV, ASSETS_ENV, BUNDLE_ENV, MATHJAX_ENV, XYJAX_ENV]
+FILE_ENVIRONMENT : List[str] = [BUNDLE_ENV, MATHJAX_ENV, XYJAX_ENV]
+
+# Exit status of a conversion that could not start pandoc, as from a shell
+PANDOC_NOT_FOUND : int = 127
+
+def conversion_cache() -> LRUCache:
+    """
+        The cache of converted html documents, bounded by $PANDOC_MATH_CACHE_SIZE_MB (default 256).
+    """
+
+    size_mb : int = int(os.environ.get(CACHE_SIZE_ENV) or DEFAULT_CACHE_SIZE_MB)
+    return LRUCache(cache_dir() / 'conversions', size_mb * 1024 * 1024)
+
+def source_files(source: Path) -> List[str]:
+    """
+        The source and the local files it pulls in: the .tex and .sty files read by its
+        preamble, and those pulled in by \\input and \\include.
+    """
+
+    names : List[str] = [name for name, _ in read_preamble(str(source))[1]]
+    return names + [name for name in find_included_files(str(source)) if name not in names]
+
+def conversion_key(source: Path, metadata: dict) -> str:
+    """
+        Hash everything the html output depends on: the source and the files it pulls in,
+        the extracted amsthm_settings, the PANDOC_MATH_* options the filter reads, and the
+        pandoc and pandoc-math versions.
+    """
+
+    digest = hashlib.sha256()
+    for name in source_files(source):
+        with open(name, 'rb') as file:
+            digest.update(hashlib.sha256(file.read()).digest())
+
+    digest.update(json.dumps(metadata, sort_keys=True).encode('utf-8'))
+    for variable in FILTER_ENVIRONMENT:
+        value : str = os.environ.get(variable, '')
+        digest.update(('%s=%s\0' % (variable, value)).encode('utf-8'))
+        if variable in FILE_ENVIRONMENT and value and os.path.isfile(value):
+            with open(value, 'rb') as file:
+                digest.update(hashlib.sha256(file.read()).digest())
+    digest.update(pandoc_version().encode('utf-8'))
+    digest.update(__version__.encode('utf-8'))
+    return digest.hexdigest()
+
+@dataclass
+class ConversionResult:
+    source: Path
+    output: Path
+    returncode: int
+    stdout: str = ''
+    stderr: str = ''
+    cached: bool = False
+
+    @property
+    def ok(self) -> bool:
+        return self.returncode == 0
+
+def pandoc_failed(source: Path, output: Path, error: Exception) -> ConversionResult:
+    """
+        The result of a conversion that could not run pandoc at all.
+    """
+
+    return ConversionResult(source, output, PANDOC_NOT_FOUND,
+        stderr='Cannot run pandoc, is it installed and on PATH? %s\n' % error)
+
+def pandoc_prefix(pandoc: str | Sequence[str]) -> List[str]:
+    """
+        The command that runs pandoc: an executable, or a command prefix such as [python, script].
+    """
+
+    return [pandoc] if isinstance(pandoc, str) else list(pandoc)
+
+def reader_command(source: Path, pandoc: str | Sequence[str] = 'pandoc') -> List[str]:
+
+    return pandoc_prefix(pandoc) + [str(source), "-f", "latex", "-t", "json"]
+
+def writer_command(output: Path, pandoc: str | Sequence[str] = 'pandoc') -> List[str]:
+
+    return pandoc_prefix(pandoc) + ["-f", "json", "-t", "html", "-o", str(output), "-s", "--mathjax", "--number-sections"]
+
+def conversion_metadata(source: Path, metadata: dict | None = None, metadata_file: Path | None = None) -> dict:
+    """
+        The metadata given to the filter: `metadata`, defaulting to the amsthm settings from the
+        LaTeX preamble, with the entries of the YAML `metadata_file` added on top.
+    """
+
+    if metadata is None:
+        metadata = read_metadata_from_file(str(source))
+    if metadata_file is not None:
+        with open(metadata_file, 'r', encoding='utf-8') as file:
+            metadata = dict(metadata, **(yaml.safe_load(file) or {}))
+    return metadata
+
+def filter_latex_json(json_text: str, metadata: dict) -> bytes:
+    """
+        Filter pandoc's JSON for a LaTeX document in this process, returning the filtered JSON.
+    """
+
+    with io.StringIO() as filtered:
+        if parallel_jobs(metadata) > 1:
+            filter_parallel(io.StringIO(json_text), filtered, 'html', metadata=metadata)
+        else:
+            filter_document(io.StringIO(json_text), filtered, 'html', metadata)
+        return filtered.getvalue().encode('utf-8')
+
+def convert(source: Path, output: Path | None = None, metadata: dict | None = None,
+        metadata_file: Path | None = None, pandoc: str | Sequence[str] = 'pandoc') -> ConversionResult:
+    """
+        Convert a .tex file to html, running the pandoc-math filter in this process.
+
+        pandoc is run twice, reading the LaTeX to JSON and writing the filtered JSON to html, with
+        no filter subprocess in between and no temporary files. `metadata` is passed to the filter
+        in memory and defaults to the amsthm settings read from the LaTeX preamble; entries from
+        the YAML `metadata_file` are added on top. The output defaults to `<stem>.html` in the
+        current directory.
+    """
+
+    source = Path(source).resolve()
+    if output is None:
+        output = Path(source.stem + '.html')
+    output = Path(output).resolve()
+
+    metadata = conversion_metadata(source, metadata, metadata_file)
+
+    # pandoc reads in the directory of the source file so that \\input paths resolve relative to it
+    try:
+        read : subprocess.CompletedProcess = subprocess.run(reader_command(source, pandoc), cwd=str(source.parent),
+            capture_output=True)
+    except OSError as error:
+        return pandoc_failed(source, output, error)
+    stderr : str = read.stderr.decode('utf-8')
+    if read.returncode != 0:
+        return ConversionResult(source, output, read.returncode, stderr=stderr.replace("\r\n", "\n"))
+
+    with captured_logs() as log:
+        document : bytes = filter_latex_json(read.stdout.decode('utf-8'), metadata)
+    stderr += log.getvalue()
+
+    write : subprocess.CompletedProcess = subprocess.run(writer_command(output, pandoc), cwd=str(source.parent),
+        input=document, capture_output=True)
+    stderr += write.stderr.decode('utf-8')
+
+    return ConversionResult(source, output, write.returncode, write.stdout.decode('utf-8').replace("\r\n", "\n"),
+        stderr.replace("\r\n", "\n"))
+
+def convert_file(source: Path, output: Path | None = None, use_cache: bool = True,
+        label_index: Path | None = None, profile: bool = False, metadata_file: Path | None = None,
+        settings_bundle: Path | None = None, assets: bool = False) -> ConversionResult:
+    """
+        Convert a single .tex file to html with `convert`, through the conversion cache.
+
+        The output defaults to `<stem>.html` in the current directory. Unless `use_cache` is False,
+        unchanged inputs are served from the conversion cache without running pandoc.
+        If `label_index` is given, the document's theorem numbers are recorded in it.
+        With `profile`, the filter writes a profile report to `<output stem>.profile.json`.
+        Entries from the YAML `metadata_file` are added to the metadata read from the preamble.
+        With a `settings_bundle` from `compile-preamble`, the preamble isn't read at all; a stale
+        bundle raises StaleBundle.
+        With `assets`, the page loads MathJax through a script shared with the other pages of
+        its directory, in `pandoc-math-assets` (see pandocmath.assets).
+    """
+
+    source = Path(source).resolve()
+    if output is None:
+        output = Path(source.stem + '.html')
+    output = Path(output).resolve()
+
+    if settings_bundle is not None:
+        # The filter reads the amsthm settings from the bundle, so only its checksum goes in the cache key
+        settings_bundle = Path(settings_bundle).resolve()
+        bundle : dict = load_bundle(settings_bundle)
+        metadata : dict = conversion_metadata(source, {BUNDLE_METADATA: str(settings_bundle)}, metadata_file)
+        key_metadata : dict = dict(metadata, **{BUNDLE_METADATA: bundle['checksum']})
+    else:
+        # Read metadata in from the LaTeX preamble
+        metadata = conversion_metadata(source, metadata_file=metadata_file)
+        key_metadata = metadata
+
+    cache : LRUCache | None = conversion_cache() if use_cache else None
+    # A profiled run has to actually run the filter
+    read_cache : bool = use_cache and not profile
+    extra_metadata : dict = {}
+    if label_index is not None:
+        label_index = Path(label_index).resolve()
+        extra_metadata = {LABEL_INDEX_METADATA: str(label_index), DOCUMENT_METADATA: document_name(output, label_index)}
+        with LabelIndex(label_index) as index:
+            # A cached conversion would not record the labels again
+            if not index.has_document(extra_metadata[DOCUMENT_METADATA]):
+                read_cache = False
+    if assets:
+        directory : Path = output.parent / DEFAULT_DIRECTORY
+        extra_metadata[ASSETS_METADATA] = str(directory)
+        extra_metadata[ASSETS_URL_METADATA] = DEFAULT_DIRECTORY
+        key_metadata = dict(key_metadata, **{ASSETS_URL_METADATA: DEFAULT_DIRECTORY})
+        # A cached page would not write its MathJax script again
+        if not directory.is_dir():
+            read_cache = False
+    if profile:
+        extra_metadata[PROFILE_METADATA] = str(output.with_suffix('.profile.json'))
+
+    if os.environ.get(ASSETS_ENV) and not Path(os.environ[ASSETS_ENV]).is_dir():
+        # Nor would it write the scripts to the assets directory from the environment
+        read_cache = False
+
+    if cache is not None:
+        try:
+            # The key holds the pandoc version, so this is where a missing pandoc first shows
+            pandoc_version()
+        except (OSError, subprocess.CalledProcessError) as error:
+            return pandoc_failed(source, output, error)
+        key : str = conversion_key(source, key_metadata)
+    if cache is not None and read_cache:
+        html : bytes | None = cache.get(key)
+        if html is not None:
+            with open(output, 'wb') as file:
+                file.write(html)
+            return ConversionResult(source, output, 0, cached=True)
+
+    result : ConversionResult = convert(source, output, dict(metadata, **extra_metadata))
+
+    if cache is not None and result.ok:
+        with open(output, 'rb') as file:
+            cache.put(key, file.read())
+
+    return result
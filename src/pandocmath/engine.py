@@ -0,0 +1,51 @@
+from __future__ import annotations
+
+import panflute as pf
+
+from typing import Callable, Dict, List, Tuple
+
+# Type Aliases
+ACTION = Callable[[pf.Element, pf.Doc], object]
+
+class Dispatcher:
+    """
+        Panflute action that routes every element of a single walk to the handlers
+        registered for its type, so several passes can share one traversal.
+
+        Handlers are looked up by the exact element class; the resolution through the
+        class hierarchy is done once per class and cached.
+    """
+
+    def __init__(self) -> None:
+        self._handlers : Dict[type, List[ACTION]] = {}
+        self._resolved : Dict[type, Tuple[ACTION, ...]] = {}
+
+    def register(self, elem_type: type, handler: ACTION) -> None:
+        """
+            Call `handler(elem, doc)` for every element that is an instance of `elem_type`.
+        """
+
+        self._handlers.setdefault(elem_type, []).append(handler)
+        self._resolved.clear()
+
+    def handlers_for(self, elem_type: type) -> Tuple[ACTION, ...]:
+
+        handlers : Tuple[ACTION, ...] | None = self._resolved.get(elem_type)
+        if handlers is None:
+            handlers = tuple(handler for klass in elem_type.__mro__
+                for handler in self._handlers.get(klass, ()))
+            self._resolved[elem_type] = handlers
+        return handlers
+
+    def __call__(self, elem: pf.Element, doc: pf.Doc) -> object:
+
+        handlers : Tuple[ACTION, ...] | None = self._resolved.get(type(elem))
+        if handlers is None:
+            handlers = self.handlers_for(type(elem))
+
+        for handler in handlers:
+            # A handler that replaces or deletes the element ends the dispatch
+            altered = handler(elem, doc)
+            if altered is not None and altered is not elem:
+                return altered
+        return None
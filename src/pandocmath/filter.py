@@ -1,29 +1,221 @@
+from __future__ import annotations
 
+import io
 import logging
+import os
 import sys
 import panflute as pf
 
-from pandocmath.ams import AmsthmSettings, AmsTheorem, amsthm_numbering, resolve_ref
+from typing import Dict, TextIO
+
+from pandocmath.ams import AmsthmSettings, amsthm_numbering, number_equations, resolve_ref
+from pandocmath.assets import assets_directory, use_mathjax_bundle, uses_xypic
+from pandocmath.bundle import BUNDLE_ENV, BUNDLE_METADATA, InvalidBundle, load_bundle
+from pandocmath.engine import Dispatcher
+from pandocmath.label_index import DOCUMENT_METADATA, LABEL_INDEX_METADATA, write_labels
+from pandocmath.prerender import prerender_enabled, prerender_math
+from pandocmath.profiling import Profiler, report_path
 
 logging.basicConfig(stream=sys.stderr, level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Unresolved references reported one by one before only their number is
+MAX_REFERENCE_WARNINGS : int = 5
+
 MATHJAX_CONFIG = "<script> MathJax = {   loader: {     load: [\'[custom]/xypic.js\'],     paths: {custom: \'https://cdn.jsdelivr.net/gh/sonoisa/XyJax-v3@3.0.1/build/\'}   },   tex: {     packages: {\'[+]\': [\'xypic\']},     macros : { relax: ''},     tags: 'ams'   } }; </script>\n\n"
 
+def queue_link(elem: pf.Link, doc: pf.Doc) -> None:
+
+    # Ordinary links are left alone, so resolution only visits references
+    if 'reference' in elem.attributes:
+        doc._amsthm_settings.links.append(elem)
+
+def queue_math(elem: pf.Math, doc: pf.Doc) -> None:
+
+    maths : list | None = doc._amsthm_settings.maths
+    if maths is not None:
+        maths.append(elem)
+
+def find_xypic(elem: pf.Math, doc: pf.Doc) -> None:
+
+    amsthm_settings : AmsthmSettings = doc._amsthm_settings
+    if not amsthm_settings.xypic and uses_xypic(elem.text, amsthm_settings.regex_calls):
+        amsthm_settings.xypic = True
+
+# Single traversal: numbering runs during the walk, Links are resolved afterwards in finalize
+dispatcher : Dispatcher = Dispatcher()
+dispatcher.register(pf.Header, amsthm_numbering)
+dispatcher.register(pf.Math, amsthm_numbering)
+dispatcher.register(pf.Math, queue_math)
+dispatcher.register(pf.Math, find_xypic)
+dispatcher.register(pf.Div, amsthm_numbering)
+dispatcher.register(pf.Link, queue_link)
+
+def action(elem: pf.Element, doc: pf.Doc) -> None:
+
+    return dispatcher(elem, doc)
+
 def action1(elem: pf.Element, doc: pf.Doc) -> None:
 
     amsthm_numbering(elem, doc)
 
 def action2(elem: pf.Element, doc: pf.Doc) -> None:
 
+    # The equations of the last section are still queued after the first walk
+    number_equations(doc._amsthm_settings)
     resolve_ref(elem, doc)
 
+def bundled_settings(doc: pf.Doc) -> dict | None:
+    """
+        The amsthm settings from a precompiled settings bundle, if one is given and up to date.
+    """
+
+    path : str | None = os.environ.get(BUNDLE_ENV) or doc.get_metadata(BUNDLE_METADATA, None)
+    if not path:
+        return None
+    try:
+        return load_bundle(path)['amsthm_settings']
+    except (OSError, InvalidBundle) as error:
+        logger.warning('Ignoring settings bundle %s: %s', path, error)
+        return None
+
 def prepare(doc: pf.Doc) -> None:
 
-    doc._amsthm_settings = AmsthmSettings(doc)
+    doc._amsthm_settings = AmsthmSettings(doc, bundled_settings(doc))
+    if prerender_enabled(doc):
+        doc._amsthm_settings.maths = []
+
+def is_placeholder(link: pf.Link, reference: str) -> bool:
+    """
+        Whether the Link still has the `[label]` text pandoc gives references it can't resolve.
+        References pandoc resolves itself, e.g. to sections, keep their attributes but not this text.
+    """
+
+    content = link.content
+    return len(content) == 1 and isinstance(content[0], pf.Str) and content[0].text == '[%s]' % reference
+
+def resolve_links(doc: pf.Doc) -> None:
+    """
+        Fix-up pass over the reference Links queued during the walk, once all identifiers are known.
+
+        Equations still queued are numbered first, so that every \\eqref can be resolved.
+        The first few unresolved references are reported, then only how many there were. With a
+        label index they are expected, since `pandoc-math resolve-refs` resolves them later.
+    """
+
+    number_equations(doc._amsthm_settings)
+    identifiers : Dict[str, str] = doc._amsthm_settings.identifiers
+    equations : Dict[str, str] = doc._amsthm_settings.equations
+    cross_document : bool = bool(doc.get_metadata(LABEL_INDEX_METADATA, None))
+    unresolved : int = 0
+    for link in doc._amsthm_settings.links:
+        resolve_ref(link, doc)
+        reference : str = link.attributes['reference']
+        if link.attributes.get('reference-type') == 'ref' and reference not in identifiers \
+                and reference not in equations and is_placeholder(link, reference):
+            unresolved += 1
+            if unresolved <= MAX_REFERENCE_WARNINGS and not cross_document:
+                logger.warning('Unresolved reference to %s.', reference)
+
+    if cross_document and unresolved:
+        logger.info('%d references left for pandoc-math resolve-refs.', unresolved)
+    elif unresolved > MAX_REFERENCE_WARNINGS:
+        logger.warning('%d unresolved references, %d not shown.', unresolved, unresolved - MAX_REFERENCE_WARNINGS)
+
+def record_labels(doc: pf.Doc) -> None:
+    """
+        Record this document's theorem numbers in the cross-document label index, if one is given.
+    """
+
+    index_path : str | None = doc.get_metadata(LABEL_INDEX_METADATA, None)
+    if not index_path:
+        return
+
+    document : str | None = doc.get_metadata(DOCUMENT_METADATA, None)
+    if not document:
+        logger.warning('%s is set but %s is not, so labels are not recorded.', LABEL_INDEX_METADATA, DOCUMENT_METADATA)
+        return
+
+    write_labels(index_path, document, doc._amsthm_settings.identifiers)
+    write_labels(index_path, document, doc._amsthm_settings.equations, kind='eqref')
 
 def finalize(doc : pf.Doc) -> None:
 
-    raw_HEADER : pf.RawBlock = pf.RawBlock(MATHJAX_CONFIG, format='html')
-    doc.metadata.content['header-includes'] = pf.MetaBlocks(raw_HEADER)
+    resolve_links(doc)
+    finish_document(doc)
+
+def finish_document(doc: pf.Doc) -> None:
+    """
+        Everything finalize does after resolving links: pre-rendering, MathJax and the label index.
+    """
+
+    # Pre-rendered maths don't need MathJax, unless \eqref links are left for it to resolve
+    amsthm_settings : AmsthmSettings = doc._amsthm_settings
+    needs_mathjax : bool = True
+    if amsthm_settings.maths is not None:
+        needs_mathjax = not prerender_math(amsthm_settings.maths, amsthm_settings.regex_calls) or \
+            any(link.attributes.get('reference-type') == 'eqref' and link.attributes['reference']
+                not in amsthm_settings.equations for link in amsthm_settings.links)
+
+    # A shared MathJax bundle in the assets directory, if enabled, or the configuration inline
+    directory : str | None = assets_directory(doc) if needs_mathjax else None
+    if directory is not None and use_mathjax_bundle(doc, directory, amsthm_settings.xypic):
+        needs_mathjax = False
+    if needs_mathjax:
+        raw_HEADER : pf.RawBlock = pf.RawBlock(MATHJAX_CONFIG, format='html')
+        doc.metadata.content['header-includes'] = pf.MetaBlocks(raw_HEADER)
+
+    record_labels(doc)
     del doc._amsthm_settings
+
+def filter_json(json_text: str, target_format: str = 'html') -> str:
+    """
+        Run the pandoc-math filter on a JSON-encoded pandoc document and return the result as JSON.
+    """
+
+    if target_format != 'html':
+        logger.error('The filter pandoc-math is only intended for converting with output to html.')
+        return json_text
+
+    with io.StringIO() as output:
+        filter_document(io.StringIO(json_text), output, target_format)
+        return output.getvalue()
+
+def filter_document(input_stream: TextIO, output_stream: TextIO, target_format: str = 'html',
+        metadata: dict | None = None) -> None:
+    """
+        Load a JSON-encoded pandoc document, run the filter on it and dump the result.
+
+        Entries of `metadata` are added to the document's metadata unless it already sets them,
+        like pandoc's --metadata-file. When profiling is enabled (see pandocmath.profiling)
+        each stage is timed and a report is written.
+    """
+
+    profiler : Profiler = Profiler()
+    with profiler.stage('load'):
+        doc : pf.Doc = pf.load(input_stream)
+        doc.format = target_format
+        for key, value in (metadata or {}).items():
+            if key not in doc.metadata:
+                doc.metadata[key] = value
+
+    path : str | None = report_path(doc)
+    if path is None:
+        pf.run_filter(action, prepare=prepare, finalize=finalize, doc=doc)
+        pf.dump(doc, output_stream)
+        output_stream.flush()
+        return
+
+    with profiler.stage('prepare'):
+        prepare(doc)
+    doc._amsthm_settings.regex_calls = profiler.regex_calls
+    with profiler.stage('walk'):
+        doc = doc.walk(profiler.count_elements(action), doc)
+    with profiler.stage('resolve'):
+        resolve_links(doc)
+    with profiler.stage('finalize'):
+        finish_document(doc)
+    with profiler.stage('dump'):
+        pf.dump(doc, output_stream)
+        output_stream.flush()
+    profiler.write(path)
@@ -0,0 +1,182 @@
+"""
+    Cross-document references for books split into one html file per chapter.
+
+    Each chapter build records its theorem (and equation) numbers in a shared SQLite label index.
+    References that could not be resolved within a chapter are left by pandoc as
+    `<a href="#label" data-reference-type="ref" data-reference="label">[label]</a>`, and
+    `pandoc-math resolve-refs` rewrites those in the html output from the index, without
+    running pandoc or the filter again.
+"""
+
+from __future__ import annotations
+
+import argparse
+import html
+import logging
+import os
+import re
+from pathlib import Path
+
+from typing import Dict, Iterable, List, Tuple
+
+from pandocmath.ams import equation_anchor
+
+# Setup logging
+logger : logging.Logger = logging.getLogger(__name__)
+
+LABEL_INDEX_METADATA : str = 'pandoc-math-label-index'
+DOCUMENT_METADATA : str = 'pandoc-math-document'
+
+# An unresolved reference as written by pandoc's html writer
+UNRESOLVED_LINK : re.Pattern = re.compile(
+    r'<a href="#[^"]*" data-reference-type="(ref|eqref)" data-reference="([^"]*)"([^>]*)>'
+    r'(\[[^<]*\]|<span class="math inline">\\\(\\eqref\{[^<]*\}\\\)</span>)</a>')
+
+class LabelIndex:
+    """
+        SQLite table of the labels each document defines, with their number and kind: 'ref' for
+        theorems, 'eqref' for equations. Sections are not recorded, since pandoc numbers them.
+        Every document written is listed in a second table, even if it defines no labels.
+    """
+
+    path : Path
+
+    def __init__(self, path: str | Path) -> None:
+        # Imported here: the filter imports this module on every run, but rarely opens an index
+        import sqlite3
+
+        self.path = Path(path)
+        self.connection : sqlite3.Connection = sqlite3.connect(str(self.path), timeout=30)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS labels (document TEXT NOT NULL, label TEXT NOT NULL, '
+            'number TEXT NOT NULL, kind TEXT NOT NULL, PRIMARY KEY (document, label, kind))')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS documents (document TEXT PRIMARY KEY)')
+
+    def __enter__(self) -> LabelIndex:
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def write_document(self, document: str, labels: Dict[str, str], kind: str = 'ref') -> None:
+        """
+            Replace the labels of kind `kind` recorded for `document`, warning about labels
+            other documents define too.
+        """
+
+        with self.connection:
+            self.connection.execute('INSERT OR IGNORE INTO documents (document) VALUES (?)', (document,))
+            self.connection.execute('DELETE FROM labels WHERE document = ? AND kind = ?', (document, kind))
+            self.connection.executemany('INSERT INTO labels (document, label, number, kind) VALUES (?, ?, ?, ?)',
+                [(document, label, number, kind) for label, number in labels.items()])
+            duplicates : list = self.connection.execute('SELECT own.label, other.document FROM labels AS own '
+                'JOIN labels AS other ON other.label = own.label AND other.document != own.document '
+                'WHERE own.document = ? AND own.kind = ? ORDER BY own.label, other.document', (document, kind)).fetchall()
+
+        for label, other in duplicates:
+            logger.warning('Label %s of %s is also defined in %s.', label, document, other)
+
+    def has_document(self, document: str) -> bool:
+        """
+            Whether the labels of `document` were written, even if it has none.
+        """
+
+        return self.connection.execute('SELECT 1 FROM documents WHERE document = ?',
+            (document,)).fetchone() is not None
+
+    def lookup(self, label: str, document: str | None = None) -> Tuple[str, str, str] | None:
+        """
+            Return (document, number, kind) for a label, or None if no document defines it. A
+            label defined in several documents is looked up in `document` first, then in the
+            first document by name.
+        """
+
+        row = self.connection.execute('SELECT document, number, kind FROM labels WHERE label = ? '
+            'ORDER BY document = ? DESC, document, kind LIMIT 1', (label, document)).fetchone()
+        return (row[0], row[1], row[2]) if row else None
+
+def document_name(output: Path, index_path: Path) -> str:
+    """
+        Name a document by its output path relative to the directory of the label index.
+    """
+
+    return Path(os.path.relpath(Path(output).resolve(), Path(index_path).resolve().parent)).as_posix()
+
+def write_labels(index_path: str, document: str, labels: Dict[str, str], kind: str = 'ref') -> None:
+
+    with LabelIndex(index_path) as index:
+        index.write_document(document, labels, kind)
+
+def resolve_html(path: Path, index: LabelIndex) -> int:
+    """
+        Rewrite unresolved references in an html file from the label index. Returns the number resolved.
+    """
+
+    path = Path(path)
+    document_dir : Path = path.resolve().parent
+    index_dir : Path = index.path.resolve().parent
+    document : str = document_name(path, index.path)
+    resolved : int = 0
+
+    def replace(match: re.Match) -> str:
+        nonlocal resolved
+        reference_type, label = match.group(1), html.unescape(match.group(2))
+        found : Tuple[str, str, str] | None = index.lookup(label, document)
+        if found is None:
+            return match.group(0)
+
+        target, number, kind = found
+        anchor : str = equation_anchor(label) if kind == 'eqref' else label
+        href : str = Path(os.path.relpath(index_dir / target, document_dir)).as_posix() + '#' + anchor
+        text : str = '(%s)' % number if reference_type == 'eqref' else number
+        resolved += 1
+        return '<a href="%s" data-reference-type="%s" data-reference="%s"%s>%s</a>' % (
+            html.escape(href), reference_type, match.group(2), match.group(3), html.escape(text))
+
+    with open(path, 'r', encoding='utf-8') as file:
+        text : str = file.read()
+    new_text : str = UNRESOLVED_LINK.sub(replace, text)
+    if resolved:
+        with open(path, 'w', encoding='utf-8') as file:
+            file.write(new_text)
+    return resolved
+
+def html_files(paths: Iterable[Path]) -> List[Path]:
+
+    files : List[Path] = []
+    for path in paths:
+        path = Path(path)
+        if path.is_dir():
+            files.extend(sorted(p for p in path.rglob('*.html') if p.is_file()))
+        else:
+            files.append(path)
+    return files
+
+def resolve_files(paths: Iterable[Path], index_path: str | Path) -> int:
+
+    total : int = 0
+    with LabelIndex(index_path) as index:
+        for path in html_files(paths):
+            count : int = resolve_html(path, index)
+            if count:
+                logger.info('Resolved %d cross-document references in %s', count, path)
+            total += count
+    return total
+
+def main(argv: List[str]) -> int:
+    parser : argparse.ArgumentParser = argparse.ArgumentParser(
+        prog='pandoc-math resolve-refs',
+        description='Resolve references between separately built html documents from a label index.',
+    )
+    parser.add_argument('paths', nargs='+', help='html files or directories searched recursively for them')
+    parser.add_argument('--index', required=True, help='label index written by the chapter builds')
+    args : argparse.Namespace = parser.parse_args(argv)
+
+    if not Path(args.index).is_file():
+        logger.error("No such label index: %s", args.index)
+        return 2
+
+    resolve_files([Path(path) for path in args.paths], args.index)
+    return 0
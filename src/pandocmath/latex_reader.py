@@ -1,5 +1,12 @@
+from __future__ import annotations
+
+import copy
+import io
 import logging
-from typing import List
+import os
+import re
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Tuple
 
 from pylatexenc.latexwalker import *
 from pylatexenc.macrospec import *
@@ -9,81 +16,295 @@ logger : logging.Logger = logging.getLogger(__name__)
 
 THEOREM_SETTINGS : List[str] = ['numbered','env_name','shared_counter','text','parent_counter']
 
+# amsthm's style for theorems declared before any \theoremstyle
+DEFAULT_STYLE : str = 'plain'
+
 newtheorem : MacroSpec = MacroSpec("newtheorem", args_parser='*{[{[')
 theoremstyle : MacroSpec = MacroSpec("theoremstyle", args_parser='{')
 numberwithin : MacroSpec = MacroSpec("numberwithin", args_parser='{{')
+declaretheorem : MacroSpec = MacroSpec("declaretheorem", args_parser='[{[')
 
 db : LatexContextDb = get_default_latex_context_db()
-db.add_context_category("amsthm", [newtheorem, theoremstyle, numberwithin])
+db.add_context_category("amsthm", [newtheorem, theoremstyle, numberwithin, declaretheorem])
 
-def extract_text_from_argument(node : LatexNode) -> str:
-    text : str = ''
+def _collect_text(node : LatexNode, pieces : List[str]) -> None:
     if node.isNodeType(LatexGroupNode):
         child_node : LatexNode
         for child_node in node.nodelist:
-            text += extract_text_from_argument(child_node)
+            _collect_text(child_node, pieces)
     elif node.isNodeType(LatexCharsNode):
-        text += node.chars
+        pieces.append(node.chars)
     else:
         logger.error("Incorrect Node Type found in argument")
 
-    return text
+def extract_text_from_argument(node : LatexNode) -> str:
+    pieces : List[str] = []
+    _collect_text(node, pieces)
+    return ''.join(pieces)
+
+# All amsthm settings live in the preamble, so scanning stops at \begin{document}
+COMMENT : re.Pattern = re.compile(r'(?<!\\)%.*')
+BEGIN_DOCUMENT : re.Pattern = re.compile(r'\\begin\s*\{document\}')
+PREAMBLE_INCLUDE : re.Pattern = re.compile(
+    r'\\(input|include|usepackage|RequirePackage)\s*(?:\[[^\]]*\])?\s*\{([^}]*)\}')
+
+# path -> (files the preamble was read from with their mtimes, preamble text)
+_preamble_cache : Dict[str, Tuple[List[Tuple[str, int]], str]] = {}
+_metadata_cache : Dict[str, Tuple[List[Tuple[str, int]], dict]] = {}
+
+def _mtime(path : str) -> int:
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return -1
+
+def _is_fresh(dependencies : List[Tuple[str, int]]) -> bool:
+    return all(_mtime(path) == mtime for path, mtime in dependencies)
+
+def _local_file(directory : Path, command : str, name : str) -> Path | None:
+    # \usepackage only pulls in local .sty files, \input and \include pull in .tex files
+    suffix : str = '.sty' if command in ('usepackage', 'RequirePackage') else '.tex'
+    path : Path = directory / name.strip()
+    if not path.suffix:
+        path = path.with_suffix(suffix)
+    return path if path.is_file() else None
+
+def scan_preamble(lines : Iterable[str], directory : Path, dependencies : List[Tuple[str, int]],
+    seen : set | None = None) -> str:
+    """
+        Collect the lines before \\begin{document}, splicing in local files pulled in by
+        \\input, \\include and \\usepackage. Reading stops as soon as the document body starts.
+        Every file read is appended to `dependencies` with its mtime.
+    """
+
+    if seen is None:
+        seen = set()
+    preamble : List[str] = []
+
+    for line in lines:
+        line = COMMENT.sub('', line)
+
+        begin = BEGIN_DOCUMENT.search(line)
+        if begin:
+            preamble.append(line[:begin.start()])
+            break
+
+        preamble.append(line)
+        for match in PREAMBLE_INCLUDE.finditer(line):
+            command : str = match.group(1)
+            for name in match.group(2).split(','):
+                path : Path | None = _local_file(directory, command, name)
+                if path is None:
+                    continue
+                key : str = str(path.resolve())
+                if key in seen:
+                    continue
+                seen.add(key)
+                dependencies.append((key, _mtime(key)))
+                with open(key, "r", encoding="utf-8", errors="replace") as file:
+                    preamble.append(scan_preamble(file, directory, dependencies, seen))
+                    preamble.append('\n')
+
+    return ''.join(preamble)
+
+def read_preamble(filename : str) -> Tuple[str, List[Tuple[str, int]]]:
+    """
+        Return the preamble of a LaTeX file and the files it was read from, memoised by mtime.
+    """
+
+    key : str = str(Path(filename).resolve())
+    cached = _preamble_cache.get(key)
+    if cached is not None and _is_fresh(cached[0]):
+        return cached[1], cached[0]
+
+    dependencies : List[Tuple[str, int]] = [(key, _mtime(key))]
+    with open(key, "r", encoding="utf-8", errors="replace") as file:
+        preamble : str = scan_preamble(file, Path(key).parent, dependencies, {key})
+
+    _preamble_cache[key] = (dependencies, preamble)
+    return preamble, dependencies
 
 def get_metadata_from_latex(latex_source : str) -> dict:
 
+    # Only parse the preamble; a standalone fragment without \begin{document} is parsed whole
+    latex_source = scan_preamble(io.StringIO(latex_source), Path('.'), [])
+
     w : latexwalker.LatexWalker = LatexWalker(latex_source, latex_context=db)
     nodelist : List[LatexNode]
     (nodelist, pos, len_) = w.get_latex_nodes(pos=0)
 
-    amsthm_settings : dict = {}
-    current_style : str = ''
+    return metadata_from_nodes(nodelist)
+
+class PreambleState:
+    """
+        The amsthm settings read so far and the current \\theoremstyle.
+    """
+
+    def __init__(self) -> None:
+        self.amsthm_settings : dict = {}
+        self.style : str = DEFAULT_STYLE
+
+    def add_theorem(self, theorem_dict : dict) -> None:
+        self.amsthm_settings.setdefault(self.style, []).append(theorem_dict)
+
+def argument_texts(node : LatexMacroNode) -> List[str | None]:
+    """
+        The text of each argument of a macro, extracted once. Missing optional arguments are None.
+    """
+
+    return [extract_text_from_argument(arg) if arg else None for arg in node.nodeargd.argnlist]
+
+def read_theoremstyle(node : LatexMacroNode, state : PreambleState) -> None:
+
+    if len(node.nodeargs) == 1:
+        state.style = extract_text_from_argument(node.nodeargs[0])
+    else:
+        logger.error("Could not extract style from \\theoremstyle command.")
+
+def read_newtheorem(node : LatexMacroNode, state : PreambleState) -> None:
+
+    theorem_dict : dict = {}
+    for setting, text in zip(THEOREM_SETTINGS, argument_texts(node)):
+        if text is None:
+            continue
+        if setting == 'numbered':
+            # \newtheorem* environments are not numbered
+            if text == '*':
+                theorem_dict['numbered'] = False
+        else:
+            theorem_dict[setting] = text
+
+    state.add_theorem(theorem_dict)
+
+def read_numberwithin(node : LatexMacroNode, state : PreambleState) -> None:
+
+    texts : List[str | None] = argument_texts(node)
+    if len(texts) != 2 or None in texts:
+        logger.error("Cannot read latex macro \\numberwithin")
+        return
+
+    counter, parent = (text.strip() for text in texts)
+    if counter == 'equation':
+        if parent == 'section':
+            state.amsthm_settings['number_within'] = True
+        else:
+            logger.warning("pandoc-math only supports numbering equations within sections.")
+    else:
+        # Theorem counters, e.g. \numberwithin{theorem}{section}
+        state.amsthm_settings.setdefault('counter_parents', {})[counter] = parent
+
+# thmtools \declaretheorem option names, mapped to amsthm settings
+DECLARETHEOREM_KEYS : Dict[str, str] = {
+    'name': 'text', 'title': 'text',
+    'numberwithin': 'parent_counter', 'parent': 'parent_counter', 'within': 'parent_counter',
+    'sibling': 'shared_counter', 'sharenumber': 'shared_counter', 'numberlike': 'shared_counter',
+}
+
+def parse_options(text : str) -> Dict[str, str]:
+    """
+        Parse a key=value option list such as `style=definition, numberwithin=section`.
+    """
+
+    options : Dict[str, str] = {}
+    for item in text.split(','):
+        key, _, value = item.partition('=')
+        if key.strip():
+            options[key.strip()] = value.strip().strip('{}')
+    return options
+
+def read_declaretheorem(node : LatexMacroNode, state : PreambleState) -> None:
+
+    before, env_name, after = argument_texts(node)
+    if not env_name:
+        logger.error("Cannot read latex macro \\declaretheorem")
+        return
+
+    # Options come before the name, or after it in newer thmtools versions
+    options : Dict[str, str] = parse_options(before or after or '')
+    theorem_dict : dict = {'env_name': env_name.strip()}
+    for key, value in options.items():
+        if key in DECLARETHEOREM_KEYS:
+            theorem_dict[DECLARETHEOREM_KEYS[key]] = value
+        elif key == 'numbered' and value == 'no':
+            theorem_dict['numbered'] = False
+        elif key != 'style':
+            logger.warning("Ignoring \\declaretheorem option %s for %s.", key, env_name)
+    theorem_dict.setdefault('text', theorem_dict['env_name'].capitalize())
+
+    style : str = state.style
+    state.style = options.get('style', style)
+    state.add_theorem(theorem_dict)
+    state.style = style
+
+# Macro name -> handler updating the preamble state
+MACRO_HANDLERS : Dict[str, Callable[[LatexMacroNode, PreambleState], None]] = {
+    'theoremstyle': read_theoremstyle,
+    'newtheorem': read_newtheorem,
+    'numberwithin': read_numberwithin,
+    'declaretheorem': read_declaretheorem,
+}
+
+def metadata_from_nodes(nodelist : List[LatexNode]) -> dict:
+
+    state : PreambleState = PreambleState()
 
     node : LatexNode
     for node in nodelist:
         if node.isNodeType(LatexMacroNode):
+            handler : Callable[[LatexMacroNode, PreambleState], None] | None = MACRO_HANDLERS.get(node.macroname)
+            if handler is not None:
+                handler(node, state)
 
-            if node.macroname == 'theoremstyle':
-                if len(node.nodeargs) == 1:
-                    current_style = extract_text_from_argument(node.nodeargs[0])
-                else:
-                    logger.error("Could not extract style from \theoremstyle command.")
-
-            if node.macroname == 'newtheorem':
-
-                theorem_dict : dict = {}
-                args : ParsedMacroArgs = node.nodeargd
-                for i, arg in enumerate(args.argnlist):
-                    if arg:
-                        if extract_text_from_argument(arg) == '*':
-                            # If theorem environment is not numbered, set 'numbered' to False in `theorem_dict`
-                            theorem_dict[THEOREM_SETTINGS[i]] = False
-                        else:
-                            # Otherwise set the theorem setting to the argument value
-                            theorem_dict[THEOREM_SETTINGS[i]] = extract_text_from_argument(arg)
-
-                if current_style in amsthm_settings:
-                    amsthm_settings[current_style].append(theorem_dict)
-                else:
-                    amsthm_settings[current_style] = [theorem_dict]
-
-            if node.macroname == 'numberwithin':
-
-                # Only support numbering equations within section currently,
-                # this could be extended to many more counters
-                args : List[LatexNode] = node.nodeargd.argnlist
-                if len(args) == 2:
-                    if extract_text_from_argument(args[0]) == 'equation' and \
-                        extract_text_from_argument(args[1]) == 'section':
-                            amsthm_settings['number_within'] = True
-                    else:
-                        logger.warning("pandoc-math only supports \\numberwithin{equation}{section}.")
-                else:
-                    logger.error("Cannot read latex macro \\numberwithin")
-
-    metadata_dictionary : dict = {'amsthm_settings':amsthm_settings}
+    metadata_dictionary : dict = {'amsthm_settings':state.amsthm_settings}
     return metadata_dictionary
 
 def read_metadata_from_file(filename : str) -> dict:
 
-    with open(filename, "r") as file:
-        return get_metadata_from_latex(file.read())
+    key : str = str(Path(filename).resolve())
+    cached = _metadata_cache.get(key)
+    if cached is not None and _is_fresh(cached[0]):
+        return copy.deepcopy(cached[1])
+
+    preamble, dependencies = read_preamble(key)
+    w : latexwalker.LatexWalker = LatexWalker(preamble, latex_context=db)
+    metadata : dict = metadata_from_nodes(w.get_latex_nodes(pos=0)[0])
+
+    _metadata_cache[key] = (dependencies, metadata)
+    return copy.deepcopy(metadata)
+
+INCLUDE_COMMAND : re.Pattern = re.compile(r'(?<!\\)%.*|\\(?:input|include)\s*\{([^}]*)\}')
+
+def find_included_files(filename : str) -> List[str]:
+    """
+        Return the files pulled in by \\input and \\include, recursively, resolved relative
+        to the directory of `filename`. Missing files are skipped.
+    """
+
+    root : Path = Path(filename).resolve()
+    found : List[str] = []
+    seen : set = {root}
+    pending : List[Path] = [root]
+
+    while pending:
+        path : Path = pending.pop()
+        try:
+            with open(path, "r", encoding="utf-8", errors="replace") as file:
+                source : str = file.read()
+        except OSError:
+            continue
+
+        for match in INCLUDE_COMMAND.finditer(source):
+            name : str | None = match.group(1)
+            if not name:
+                # Comment
+                continue
+            included : Path = root.parent / name.strip()
+            if not included.suffix:
+                included = included.with_suffix('.tex')
+            included = included.resolve()
+            if included not in seen and included.is_file():
+                seen.add(included)
+                found.append(str(included))
+                pending.append(included)
+
+    return found
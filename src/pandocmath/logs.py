@@ -0,0 +1,59 @@
+"""
+    Collecting what the filter logs while it runs in this process, as pandoc would collect a
+    filter's stderr.
+
+    `captured_logs` adds a handler to the root logger for as long as it runs, so the handlers
+    already installed keep receiving every record. Only records from the capturing thread are
+    collected, so conversions running on other threads don't mix their logs. An application
+    that prints the collected log itself adds `NotCaptured` to its own handlers, so that those
+    records aren't shown twice.
+"""
+
+from __future__ import annotations
+
+import io
+import logging
+import threading
+from contextlib import contextmanager
+
+from typing import Iterator, Set
+
+# Threads whose records are being collected
+_capturing : Set[int] = set()
+
+class NotCaptured(logging.Filter):
+    """
+        Drops the records of threads whose logs are being collected by `captured_logs`.
+    """
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.thread not in _capturing
+
+@contextmanager
+def captured_logs() -> Iterator[io.StringIO]:
+    """
+        Collect everything this thread logs until the block ends.
+    """
+
+    log : io.StringIO = io.StringIO()
+    handler : logging.Handler = logging.StreamHandler(log)
+    handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+    thread : int = threading.get_ident()
+    handler.addFilter(lambda record: record.thread == thread)
+
+    root : logging.Logger = logging.getLogger()
+    root.addHandler(handler)
+    _capturing.add(thread)
+    try:
+        yield log
+    finally:
+        _capturing.discard(thread)
+        root.removeHandler(handler)
+
+def hide_captured(logger: logging.Logger | None = None) -> None:
+    """
+        Add `NotCaptured` to the handlers of `logger`, by default the root logger.
+    """
+
+    for handler in (logger or logging.getLogger()).handlers:
+        handler.addFilter(NotCaptured())
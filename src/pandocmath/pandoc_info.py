@@ -0,0 +1,112 @@
+from __future__ import annotations
+
+import logging
+import os
+import shutil
+import subprocess
+from pathlib import Path
+
+from typing import Dict, List
+
+from pandocmath.cache import cache_dir, read_json, write_json
+
+# Setup logging
+logger : logging.Logger = logging.getLogger(__name__)
+
+PANDOC_INFO_CACHE : str = 'pandoc-info.json'
+
+# Output formats that are always accepted without asking pandoc
+COMMON_OUTPUT_FORMATS : List[str] = ['html', 'html4', 'html5', 'latex', 'json', 'markdown', 'native', 'plain']
+
+_pandoc_info : Dict[str, dict] = {}
+
+def pandoc_path() -> str | None:
+    """
+        Return the resolved path to the pandoc executable on PATH.
+    """
+
+    path : str | None = shutil.which('pandoc')
+    return os.path.realpath(path) if path else None
+
+def _run_pandoc(path: str, args: List[str]) -> str:
+    res : subprocess.CompletedProcess = subprocess.run([path] + args, capture_output=True, check=True)
+    return res.stdout.decode('utf-8')
+
+def get_pandoc_info(path: str | None = None) -> dict:
+    """
+        Return the version and output formats of a pandoc executable.
+
+        Results are memoised in-process and kept in an on-disk cache keyed by the pandoc path,
+        so pandoc is only run again when the executable at that path changes.
+    """
+
+    if path is None:
+        path = pandoc_path()
+        if path is None:
+            raise OSError("Path to pandoc executable does not exist")
+
+    if path in _pandoc_info:
+        return _pandoc_info[path]
+
+    stat : os.stat_result = os.stat(path)
+    stamp : List[int] = [stat.st_mtime_ns, stat.st_size]
+
+    cache_file : Path = cache_dir() / PANDOC_INFO_CACHE
+    cache : dict = read_json(cache_file)
+    info : dict | None = cache.get(path)
+
+    # pandoc exports its version to filters, so a stale entry is detected without running it
+    env_version : str | None = os.environ.get('PANDOC_VERSION')
+    if info is None or info.get('stamp') != stamp or \
+        (env_version and info.get('version') != env_version):
+
+        logger.debug('Querying pandoc at %s', path)
+        # First line of `pandoc --version` is e.g. 'pandoc 3.1.6.1'
+        version_words : List[str] = _run_pandoc(path, ['--version']).split()
+        version : str = version_words[1] if len(version_words) > 1 else ''
+        formats : List[str] = _run_pandoc(path, ['--list-output-formats']).split()
+
+        info = {'stamp': stamp, 'version': version, 'output_formats': formats}
+        cache[path] = info
+        write_json(cache_file, cache)
+
+    _pandoc_info[path] = info
+    return info
+
+def pandoc_version() -> str:
+    """
+        Return the version string of the pandoc on PATH, e.g. '3.1.6.1'.
+    """
+
+    return get_pandoc_info()['version']
+
+def get_output_formats() -> List[str]:
+    """
+        Return the output formats supported by the pandoc on PATH.
+    """
+
+    return get_pandoc_info()['output_formats']
+
+def is_filter_invocation(arg: str) -> bool:
+    """
+        Decide whether the positional argument means pandoc is running us as a JSON filter.
+
+        pandoc calls filters as `FILTER FORMAT` with $PANDOC_VERSION set, so the common case
+        is answered without starting pandoc, even if a file is named like the format. Without
+        it, .tex and existing files are documents, and only ambiguous arguments fall back to
+        the (cached) list of pandoc output formats.
+    """
+
+    if os.environ.get('PANDOC_VERSION'):
+        return True
+
+    if Path(arg).suffix.lower() == '.tex' or os.path.isfile(arg):
+        return False
+
+    if arg in COMMON_OUTPUT_FORMATS:
+        return True
+
+    try:
+        return arg in get_output_formats()
+    except (OSError, subprocess.CalledProcessError):
+        return False
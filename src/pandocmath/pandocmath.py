@@ -24,60 +24,103 @@ SOFTWARE.
 
 from __future__ import annotations
 
+import time
+_IMPORT_START : float = time.perf_counter()
+
+import io
 import logging
 import sys
-import panflute as pf
 import argparse
+import importlib
 import os
-import tempfile
-import subprocess
-import yaml
 from pathlib import Path
 
-from typing import Dict, List
+from typing import Callable, Dict, List
 
 from pandocmath._version import __version__
-from pandocmath.filter import action1, action2, prepare, finalize
-from pandocmath.latex_reader import read_metadata_from_file
-
-# Setup logging
+from pandocmath.filter import filter_document
+from pandocmath.logs import hide_captured
+from pandocmath.pandoc_info import is_filter_invocation
+from pandocmath.profiling import PROFILE_ENV
+from pandocmath.parallel import filter_parallel, parallel_jobs
+from pandocmath.streaming import STREAMING_ENV, filter_stream
+
+# Setup logging. Conversions print what the filter logged with their result, so it isn't shown as it happens
 logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+hide_captured()
 logger : logging.Logger = logging.getLogger(__name__)
 
 # CONSTANTS
-PANDOC_OUTPUT_FORMATS : List[str] = pf.run_pandoc(args=['--list-output-formats']).split('\r\n')
+PROFILE_STARTUP_ENV : str = 'PANDOC_MATH_PROFILE_STARTUP'
+
+# Sub-commands, e.g. `pandoc-math build DIR`, and the modules providing their `main`. They are
+# imported only when run, so that starting the filter doesn't load them
+COMMANDS : Dict[str, str] = {
+    'build': 'pandocmath.build',
+    'compile-preamble': 'pandocmath.bundle',
+    'resolve-refs': 'pandocmath.label_index',
+    'serve': 'pandocmath.server',
+    'watch': 'pandocmath.watch',
+}
+
+_IMPORT_TIME : float = time.perf_counter() - _IMPORT_START
+
+def report_startup_time() -> None:
+    """
+        Write module import time and total startup time (until work begins) to stderr.
+    """
+
+    startup_time : float = time.perf_counter() - _IMPORT_START
+    sys.stderr.write('pandoc-math startup: import %.1f ms, startup %.1f ms\n'
+        % (_IMPORT_TIME * 1000, startup_time * 1000))
 
 def main() -> None:
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        command : Callable[[List[str]], int] = importlib.import_module(COMMANDS[sys.argv[1]]).main
+        sys.exit(command(sys.argv[2:]))
+
     parser : argparse.ArgumentParser = argparse.ArgumentParser(
         prog='pandoc-math',
         description='A pandoc filter for converting LaTeX to html for mathematics documents.',
-        epilog='For more help, see the documentation at https://gavinmcwhinnie.github.io/pandoc-math/'
+        epilog='Other commands: ' + ', '.join(COMMANDS) + '. '
+            'For more help, see the documentation at https://gavinmcwhinnie.github.io/pandoc-math/'
     )
     parser.add_argument('file', help='TeX file to be converted')
     parser.add_argument('--version', action='version', version=__version__)
+    parser.add_argument('--profile-startup', action='store_true',
+        help='report import and startup time to stderr (set %s=1 when run as a filter)' % PROFILE_STARTUP_ENV)
+    parser.add_argument('--no-cache', action='store_true', help='always convert, ignoring the conversion cache')
+    parser.add_argument('--profile', action='store_true',
+        help='write a per-stage profile report of the filter next to the output (set %s=path when run as a filter)'
+            % PROFILE_ENV)
     #parser.add_argument('-o', default='output.html', help='output file')
     args : argparse.Namespace = parser.parse_args()
 
-    if args.file in PANDOC_OUTPUT_FORMATS:
+    if args.profile_startup or os.environ.get(PROFILE_STARTUP_ENV):
+        report_startup_time()
+
+    if is_filter_invocation(args.file):
 
         #### pandoc-math is being called by Pandoc, run as a json filter
 
         target_format : str = args.file
-        if target_format == 'html':
+        if target_format == 'html' and os.environ.get(STREAMING_ENV):
+
+            # Filter the document block by block without loading it whole
+            filter_stream(io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8'),
+                io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8'), target_format)
 
-            # Read JSON-encoded document from stdin
-            doc : pf.Doc = pf.load()
+        elif target_format == 'html' and parallel_jobs() > 1:
 
-            # Run panflute filters
-            pf.run_filters(
-                (action1, action2),
-                prepare=prepare,
-                finalize=finalize,
-                doc=doc,
-            )
+            # Number the sections of the document in worker processes
+            filter_parallel(io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8'),
+                io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8'), target_format)
 
-            # Dump JSON-encoded text string to stdout
-            pf.dump(doc)
+        elif target_format == 'html':
+
+            # Read JSON-encoded document from stdin, filter it and write it to stdout
+            filter_document(io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8'),
+                io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8'), target_format)
 
         else:
             logger.error('The filter pandoc-math is only intended for converting with output to html.')
@@ -88,31 +131,17 @@ def main() -> None:
         path : Path = Path(args.file)
 
         if path.is_file():
+            from pandocmath.conversion import ConversionResult, convert_file
+
             filetype : str = path.suffix.lower()
             if filetype == '.tex':
 
-                ####### TODO: finish here
-                metadata_file : tempfile.NamedTemporaryFile = tempfile.NamedTemporaryFile(delete=False)
+                result : ConversionResult = convert_file(path, use_cache=not args.no_cache, profile=args.profile)
 
-                # Read metadata in from
-                metadata : dict = read_metadata_from_file(str(path))
-                yaml.dump(metadata, metadata_file, encoding = 'utf-8')
-
-                command : List[str] = ["pandoc", str(path), "-o", path.stem+'.html', "-s", "--mathjax", "--filter", "pandoc-math",
-                    "--metadata-file", metadata_file.name, "--number-sections"]
-                res : subprocess.CompletedProcess = subprocess.run(command, shell=True, capture_output=True)
-
-                # pandoc-math logging goes to stderr
-                stdout : str = res.stdout.decode('utf-8').replace(r"\r\n", r"\n")
-                stderr : str = res.stderr.decode('utf-8').replace(r"\r\n", r"\n")
                 # Print logging and errors to stdout
-                if stdout:
-                    print(stdout)
-                print(stderr)
-
-                # Close the temporary metadata file
-                metadata_file.close()
-                os.remove(metadata_file.name)
+                if result.stdout:
+                    print(result.stdout)
+                print(result.stderr)
 
             else:
                 logger.error("Please input a .tex file only.")
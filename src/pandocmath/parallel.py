@@ -0,0 +1,237 @@
+"""
+    Parallel filter mode for very large documents.
+
+    The blocks are split at level-1 Headers into runs of whole sections, which are numbered in a
+    process pool. Each worker starts from the counter state at the start of its sections, found
+    beforehand by a scan of the plain JSON that only steps the counters (section numbers, theorem
+    counters that run across sections and the equation counter), without building panflute
+    elements. The workers' identifiers are then merged, in document order, and references are
+    resolved in this process. The output is identical to the serial filter's.
+
+    Enable it with PANDOC_MATH_JOBS set to the number of worker processes (or `auto` for one per
+    CPU), or with `pandoc-math-jobs` in the metadata given to `pandocmath.convert`. Documents
+    with too few sections, and runs that pre-render maths or are profiled, use the serial filter.
+"""
+
+from __future__ import annotations
+
+import io
+import json
+import logging
+import os
+
+import panflute as pf
+from panflute.elements import from_json
+
+from typing import Dict, List, TextIO, Tuple
+
+from pandocmath.ams import AmsthmSettings, AmsTheorem, MAX_SECTION_DEPTH, QED_TAG, labelled_equations, number_equations
+from pandocmath.filter import action, filter_document, finish_document, prepare, queue_link, resolve_links
+from pandocmath.profiling import report_path
+from pandocmath.streaming import _dumps
+
+# Setup logging
+logger : logging.Logger = logging.getLogger(__name__)
+
+JOBS_ENV : str = 'PANDOC_MATH_JOBS'
+JOBS_METADATA : str = 'pandoc-math-jobs'
+
+# Runs of sections handed to each worker, so that uneven sections balance out
+SHARDS_PER_JOB : int = 4
+
+# (section_counters, counter_values, equation_counter)
+CounterState = Tuple[List[int], List[int], int]
+
+def parallel_jobs(metadata: dict | None = None) -> int:
+    """
+        Number of worker processes asked for by PANDOC_MATH_JOBS or `pandoc-math-jobs`, 1 if none.
+    """
+
+    jobs = os.environ.get(JOBS_ENV) or (metadata or {}).get(JOBS_METADATA)
+    if not jobs:
+        return 1
+    if jobs == 'auto':
+        return os.cpu_count() or 1
+    try:
+        return max(int(jobs), 1)
+    except ValueError:
+        logger.warning('Ignoring invalid number of jobs: %s', jobs)
+        return 1
+
+def split_sections(blocks: List[dict], shards: int) -> List[List[dict]]:
+    """
+        Split top-level JSON blocks at level-1 Headers into at most `shards` runs of whole
+        sections with similar numbers of blocks.
+    """
+
+    sections : List[List[dict]] = [[]]
+    for block in blocks:
+        if block.get('t') == 'Header' and block['c'][0] == 1 and sections[-1]:
+            sections.append([])
+        sections[-1].append(block)
+
+    size : float = len(blocks) / max(shards, 1)
+    runs : List[List[dict]] = [[]]
+    for section in sections:
+        if runs[-1] and len(runs[-1]) + len(section) / 2 > size:
+            runs.append([])
+        runs[-1].extend(section)
+    return runs
+
+def scan_counters(value: object, amsthm_settings: AmsthmSettings, in_proof: bool = False) -> None:
+    """
+        Step the counters the way amsthm_numbering would while walking a plain JSON value.
+        `in_proof` is set below a proof Div, where \\qedhere leaves an equation unnumbered.
+    """
+
+    if isinstance(value, list):
+        for item in value:
+            if isinstance(item, list):
+                scan_counters(item, amsthm_settings, in_proof)
+            elif isinstance(item, dict) and (isinstance(item.get('c'), list) or 't' not in item):
+                # Skip leaves like Str and Space without a call
+                scan_counters(item, amsthm_settings, in_proof)
+        return
+    if not isinstance(value, dict):
+        return
+
+    kind : str | None = value.get('t')
+    if kind is None:
+        # Not an element, e.g. a Citation, whose prefix and suffix are walked
+        for item in value.values():
+            scan_counters(item, amsthm_settings, in_proof)
+        return
+
+    # Children first, like the post-order walk
+    content = value.get('c')
+    if kind == 'Div' and 'proof' in content[0][1]:
+        in_proof = True
+    if isinstance(content, (list, dict)):
+        scan_counters(content, amsthm_settings, in_proof)
+
+    if kind == 'Header':
+        if content[0] <= MAX_SECTION_DEPTH:
+            amsthm_settings.start_section(content[0])
+    elif kind == 'Math':
+        text : str = content[1]
+        if in_proof and '\\qedhere' in text:
+            # As replace_qed_here rewrites it during the walk
+            text = text.replace('\\qedhere', QED_TAG)
+        amsthm_settings.equation_counter += labelled_equations(text)
+    elif kind == 'Div':
+        theorem_type : AmsTheorem | None = amsthm_settings.classify(content[0][1], warn=False)
+        if theorem_type is not None and theorem_type.counter is not None:
+            amsthm_settings.step_counter(theorem_type.counter)
+
+def counter_state(amsthm_settings: AmsthmSettings) -> CounterState:
+
+    return (list(amsthm_settings.section_counters), list(amsthm_settings.counter_values),
+        amsthm_settings.equation_counter)
+
+def number_sections(meta: str, api_version: List[int], target_format: str, blocks: str,
+        state: CounterState) -> Tuple[List[str], Dict[str, str], Dict[str, str], List[int], bool]:
+    """
+        Worker: number a run of sections starting from `state`. Returns the blocks as JSON, the
+        theorem and equation numbers found, the indices of the blocks holding Links and whether
+        XyJax is used.
+    """
+
+    doc : pf.Doc = pf.Doc(*json.loads(blocks, object_hook=from_json),
+        metadata=json.loads(meta, object_hook=from_json), api_version=tuple(api_version))
+    doc.format = target_format
+
+    # The settings were already read, and any problems reported, by the parent process
+    logging.disable(logging.WARNING)
+    try:
+        prepare(doc)
+    finally:
+        logging.disable(logging.NOTSET)
+
+    amsthm_settings : AmsthmSettings = doc._amsthm_settings
+    section_counters, counter_values, equation_counter = state
+    amsthm_settings.section_counters = list(section_counters)
+    amsthm_settings.counter_values = list(counter_values)
+    amsthm_settings.equation_counter = equation_counter
+
+    # Only the blocks: the metadata was walked by the parent
+    doc.content = doc.content.walk(action, doc)
+    number_equations(amsthm_settings)
+
+    link_blocks : set = set()
+    for link in amsthm_settings.links:
+        elem : pf.Element = link
+        while not isinstance(elem.parent, pf.Doc):
+            elem = elem.parent
+        link_blocks.add(elem.index)
+
+    return [_dumps(block) for block in doc.content], amsthm_settings.identifiers, \
+        amsthm_settings.equations, sorted(link_blocks), amsthm_settings.xypic
+
+def filter_parallel(input_stream: TextIO, output_stream: TextIO, target_format: str = 'html',
+        jobs: int | None = None, metadata: dict | None = None) -> None:
+    """
+        Filter a JSON-encoded pandoc document with `jobs` worker processes.
+    """
+
+    jobs = jobs or parallel_jobs(metadata)
+    json_text : str = input_stream.read()
+    document : dict = json.loads(json_text)
+    runs : List[List[dict]] = split_sections(document['blocks'], jobs * SHARDS_PER_JOB)
+
+    doc : pf.Doc = pf.Doc(metadata=json.loads(json.dumps(document['meta']), object_hook=from_json),
+        api_version=tuple(document['pandoc-api-version']))
+    doc.format = target_format
+    for key, value in (metadata or {}).items():
+        if key not in doc.metadata:
+            doc.metadata[key] = value
+
+    if jobs < 2 or len(runs) < 2 or report_path(doc) is not None:
+        filter_document(io.StringIO(json_text), output_stream, target_format, metadata)
+        return
+
+    prepare(doc)
+    amsthm_settings : AmsthmSettings = doc._amsthm_settings
+    if amsthm_settings.maths is not None:
+        # Pre-rendering batches every Math of the document
+        filter_document(io.StringIO(json_text), output_stream, target_format, metadata)
+        return
+
+    meta : str = _dumps(doc.metadata.content.to_json())
+
+    # The serial walk visits the metadata before the blocks
+    doc.metadata = doc.metadata.walk(action, doc)
+    number_equations(amsthm_settings)
+
+    states : List[CounterState] = []
+    for run in runs:
+        states.append(counter_state(amsthm_settings))
+        scan_counters(run, amsthm_settings)
+
+    # Imported here: the filter imports this module on every run, to check parallel_jobs
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor(max_workers=min(jobs, len(runs))) as executor:
+        results : list = list(executor.map(number_sections, [meta] * len(runs),
+            [document['pandoc-api-version']] * len(runs), [target_format] * len(runs),
+            [json.dumps(run, ensure_ascii=False) for run in runs], states))
+
+    blocks : List[str] = []
+    held : List[Tuple[int, pf.Element]] = []
+    for run_blocks, identifiers, equations, link_blocks, xypic in results:
+        amsthm_settings.identifiers.update(identifiers)
+        amsthm_settings.equations.update(equations)
+        amsthm_settings.xypic = amsthm_settings.xypic or xypic
+        for index in link_blocks:
+            elem : pf.Element = json.loads(run_blocks[index], object_hook=from_json)
+            elem.walk(lambda link, doc: queue_link(link, doc) if isinstance(link, pf.Link) else None, doc)
+            held.append((len(blocks) + index, elem))
+        blocks.extend(run_blocks)
+
+    resolve_links(doc)
+    for position, elem in held:
+        blocks[position] = _dumps(elem)
+    finish_document(doc)
+
+    output_stream.write('{"pandoc-api-version":%s,"meta":%s,"blocks":[%s]}' % (
+        _dumps(document['pandoc-api-version']), _dumps(doc.metadata.content.to_json()), ','.join(blocks)))
+    output_stream.flush()
@@ -0,0 +1,125 @@
+"""
+    Opt-in pre-rendering of maths to static MathML at build time, so pages don't need MathJax
+    to typeset every equation when they load.
+
+    Rendering uses the local pandoc (its texmath MathML writer), so no network access is needed.
+    Rendered equations are kept in a persistent cache keyed by the TeX source, shared by all
+    documents built on the machine. Enable with `pandoc-math-prerender: true` in the metadata or
+    PANDOC_MATH_PRERENDER=1 in the environment.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import html as html_escape
+import logging
+import os
+import re
+import subprocess
+from collections import Counter
+
+import panflute as pf
+
+from typing import Dict, List, Tuple
+
+from pandocmath.ams import LABEL, equation_anchor
+from pandocmath.cache import LRUCache, cache_dir
+from pandocmath.pandoc_info import pandoc_version
+from pandocmath.profiling import counting
+
+# Setup logging
+logger : logging.Logger = logging.getLogger(__name__)
+
+PRERENDER_ENV : str = 'PANDOC_MATH_PRERENDER'
+PRERENDER_METADATA : str = 'pandoc-math-prerender'
+MATH_CACHE_SIZE_MB : int = 64
+
+RENDERED_DIV : re.Pattern = re.compile(r'<div id="pandoc-math-(\d+)">\s*(.*?)\s*</div>', re.DOTALL)
+
+def prerender_enabled(doc: pf.Doc) -> bool:
+
+    return bool(os.environ.get(PRERENDER_ENV)) or bool(doc.get_metadata(PRERENDER_METADATA, False))
+
+def math_cache() -> LRUCache:
+
+    return LRUCache(cache_dir() / 'math', MATH_CACHE_SIZE_MB * 1024 * 1024)
+
+def math_key(format: str, text: str, renderer: str) -> str:
+
+    return hashlib.sha256('\0'.join([renderer, format, text]).encode('utf-8')).hexdigest()
+
+def render_math(maths: List[Tuple[str, str]], regex_calls: Counter | None = None) -> List[str]:
+    """
+        Render (format, TeX) pairs to MathML with a single pandoc run.
+    """
+
+    doc : pf.Doc = pf.Doc(*[pf.Div(pf.Plain(pf.Math(text, format=format)), identifier='pandoc-math-%d' % i)
+        for i, (format, text) in enumerate(maths)])
+    html : str = pf.convert_text(doc, input_format='panflute', output_format='html', extra_args=['--mathml'])
+
+    rendered : Dict[int, str] = {int(match.group(1)): match.group(2)
+        for match in counting(RENDERED_DIV, __name__ + '.RENDERED_DIV', regex_calls).finditer(html)}
+    return [rendered.get(i, '') for i in range(len(maths))]
+
+def prerender_math(maths: List[pf.Math], regex_calls: Counter | None = None) -> bool:
+    """
+        Replace Math elements by pre-rendered MathML, rendering only equations missing from the cache.
+
+        Maths texmath can't parse, which pandoc writes out as TeX, is left as Math for MathJax
+        and not cached. Labelled equations keep the ids MathJax would give them, so that \\eqref
+        links still lead to them. Returns True if every element was replaced.
+    """
+
+    if not maths:
+        return True
+
+    try:
+        renderer : str = 'mathml:' + pandoc_version()
+    except (OSError, subprocess.CalledProcessError) as error:
+        logger.warning("Cannot pre-render maths without pandoc, leaving it to MathJax: %s", error)
+        return False
+
+    cache : LRUCache = math_cache()
+    rendered : Dict[str, str] = {}
+    missing : Dict[str, Tuple[str, str]] = {}
+
+    for elem in maths:
+        key : str = math_key(elem.format, elem.text, renderer)
+        if key in rendered or key in missing:
+            continue
+        cached : bytes | None = cache.get(key)
+        if cached is not None:
+            rendered[key] = cached.decode('utf-8')
+        else:
+            missing[key] = (elem.format, elem.text)
+
+    if missing:
+        try:
+            results : List[str] = render_math(list(missing.values()), regex_calls)
+        except (OSError, subprocess.CalledProcessError) as error:
+            logger.warning("Pre-rendering maths failed, leaving it to MathJax: %s", error)
+            results = [''] * len(missing)
+
+        new_entries : Dict[str, bytes] = {}
+        for key, html in zip(missing, results):
+            if '<math' in html:
+                rendered[key] = html
+                new_entries[key] = html.encode('utf-8')
+        cache.put_many(new_entries)
+        logger.info('Pre-rendered %d new equations (%d from cache).', len(new_entries), len(rendered) - len(new_entries))
+        if len(new_entries) < len(missing):
+            logger.info('%d equations could not be pre-rendered and are left to MathJax.', len(missing) - len(new_entries))
+
+    label = counting(LABEL, 'pandocmath.ams.LABEL', regex_calls)
+    complete : bool = True
+    for elem in maths:
+        html = rendered.get(math_key(elem.format, elem.text, renderer))
+        if html is None or elem.parent is None:
+            complete = False
+            continue
+        if '\\label' in elem.text:
+            html = ''.join('<span id="%s"></span>' % html_escape.escape(equation_anchor(match.group(1)))
+                for match in label.finditer(elem.text)) + html
+        elem.container[elem.index] = pf.RawInline(html, format='html')
+
+    return complete
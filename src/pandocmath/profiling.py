@@ -0,0 +1,147 @@
+"""
+    Opt-in per-stage profiling of filter runs.
+
+    Set PANDOC_MATH_PROFILE to the path of a report file (or `pandoc-math-profile` in the metadata
+    to a path, or true for `pandoc-math-profile.json`) and the filter writes a JSON report with the
+    wall time after each stage (load, walk, resolve, finalize, dump), the number of elements of
+    each type visited and the number of calls to each of the filter's regexes. Each stage records
+    the counts made during it, and the top of the report the totals for the run. The peak RSS
+    recorded with each stage is the whole process's so far, not the stage's own.
+
+    Regex calls are counted into the run's AmsthmSettings.regex_calls, which the filter's
+    functions check through `counting`, so concurrent filter runs in other threads are neither
+    counted nor slowed down.
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+import os
+import re
+import sys
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+import panflute as pf
+
+from typing import Callable, Dict, Iterator
+
+from pandocmath._version import __version__
+
+# Setup logging
+logger : logging.Logger = logging.getLogger(__name__)
+
+PROFILE_ENV : str = 'PANDOC_MATH_PROFILE'
+PROFILE_METADATA : str = 'pandoc-math-profile'
+DEFAULT_REPORT : str = 'pandoc-math-profile.json'
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+def peak_rss() -> int | None:
+    """
+        Peak resident set size of this process in bytes, or None where it can't be measured.
+    """
+
+    if resource is None:
+        return None
+    maxrss : int = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+def report_path(doc: pf.Doc | None = None) -> str | None:
+    """
+        Where to write the profile report, from the environment or the document metadata. None if not profiling.
+    """
+
+    path : str | None = os.environ.get(PROFILE_ENV)
+    if not path and doc is not None:
+        path = doc.get_metadata(PROFILE_METADATA, None)
+    if path is True or path in ('1', 'true'):
+        return DEFAULT_REPORT
+    return path or None
+
+class CountingPattern:
+    """
+        Stands in for a compiled regex, counting calls to its matching methods.
+    """
+
+    def __init__(self, pattern: re.Pattern, name: str, counter: Counter) -> None:
+        self.pattern = pattern
+        self.name = name
+        self.counter = counter
+
+    def __getattr__(self, attr: str):
+        method = getattr(self.pattern, attr)
+        if attr not in ('search', 'match', 'fullmatch', 'finditer', 'findall', 'sub', 'subn', 'split'):
+            return method
+
+        def counted(*args, **kwargs):
+            self.counter[self.name] += 1
+            return method(*args, **kwargs)
+        return counted
+
+def counting(pattern: re.Pattern, name: str, counter: Counter | None) -> re.Pattern | CountingPattern:
+    """
+        `pattern` itself, or when a run is profiled, a stand-in counting calls into its `counter`.
+    """
+
+    return pattern if counter is None else CountingPattern(pattern, name, counter)
+
+class Profiler:
+    """
+        Collects stage timings and counts for one filter run.
+    """
+
+    def __init__(self) -> None:
+        self.stages : Dict[str, dict] = {}
+        self.elements : Counter = Counter()
+        self.regex_calls : Counter = Counter()
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+
+        elements : Counter = self.elements.copy()
+        regex_calls : Counter = self.regex_calls.copy()
+        start : float = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = {
+                'seconds': time.perf_counter() - start,
+                'process_peak_rss_bytes': peak_rss(),
+                'elements': dict((self.elements - elements).most_common()),
+                'regex_calls': dict((self.regex_calls - regex_calls).most_common()),
+            }
+
+    def count_elements(self, action: Callable) -> Callable:
+        """
+            Wrap a panflute action so that every element it visits is counted by type.
+        """
+
+        def counted(elem: pf.Element, doc: pf.Doc):
+            self.elements[type(elem).__name__] += 1
+            return action(elem, doc)
+        return counted
+
+    def report(self) -> dict:
+
+        return {
+            'pandoc_math_version': __version__,
+            'stages': self.stages,
+            'total_seconds': sum(stage['seconds'] for stage in self.stages.values()),
+            'process_peak_rss_bytes': peak_rss(),
+            'elements': dict(self.elements.most_common()),
+            'regex_calls': dict(self.regex_calls.most_common()),
+        }
+
+    def write(self, path: str) -> None:
+
+        with open(path, 'w', encoding='utf-8') as file:
+            json.dump(self.report(), file, indent=2)
+        logger.info('Wrote profile report to %s', path)
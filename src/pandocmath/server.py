@@ -0,0 +1,141 @@
+"""
+    `pandoc-math serve`: a daemon that keeps Python, panflute and the filter loaded and
+    filters documents sent by `pandoc-math-client` over a Unix socket.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import os
+import signal
+import socket
+import socketserver
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+from typing import Dict, List, Tuple
+
+from pandocmath.client import ENVIRONMENT_PREFIX, STATUS_ERROR, STATUS_OK, recv_frame, send_frame, socket_path
+from pandocmath.logs import captured_logs
+
+# Setup logging
+logger : logging.Logger = logging.getLogger(__name__)
+
+def _warm_up() -> None:
+    # Import the filter once per worker process, before the first request arrives
+    import pandocmath.filter
+
+def apply_context(context: dict) -> None:
+    """
+        Take on the client's working directory and pandoc-math settings, replacing the daemon's own.
+    """
+
+    for key in [key for key in os.environ if key.startswith(ENVIRONMENT_PREFIX)]:
+        del os.environ[key]
+    os.environ.update(context.get('environment', {}))
+    os.chdir(context['cwd'])
+
+def filter_request(target_format: str, json_text: str, context: dict) -> Tuple[bytes, str, str]:
+    """
+        Run the filter in a worker process as the client would have run it, capturing its log
+        output for the client. Workers handle one request at a time, so changing the process's
+        environment and directory for the request is safe.
+    """
+
+    from pandocmath.filter import filter_json
+
+    saved_environment : Dict[str, str] = {key: value for key, value in os.environ.items()
+        if key.startswith(ENVIRONMENT_PREFIX)}
+    saved_cwd : str = os.getcwd()
+    with captured_logs() as log:
+        try:
+            apply_context(context)
+            return STATUS_OK, filter_json(json_text, target_format), log.getvalue()
+        except Exception:
+            return STATUS_ERROR, '', log.getvalue() + traceback.format_exc()
+        finally:
+            apply_context({'cwd': saved_cwd, 'environment': saved_environment})
+
+# Unix domain sockets don't exist on every platform, e.g. Windows: there the module must still
+# import, and main refuses to serve
+_UnixStreamServer : type = getattr(socketserver, 'UnixStreamServer', socketserver.TCPServer)
+
+class FilterServer(socketserver.ThreadingMixIn, _UnixStreamServer):
+    """
+        Accepts connections on a thread each and hands the filtering to a pool of warm workers.
+    """
+
+    daemon_threads = True
+    executor : ProcessPoolExecutor
+
+    def __init__(self, path: str, workers: int | None = None) -> None:
+        self.executor = ProcessPoolExecutor(max_workers=workers, initializer=_warm_up)
+        super().__init__(path, FilterRequestHandler)
+
+    def server_close(self) -> None:
+        super().server_close()
+        self.executor.shutdown(wait=False)
+
+class FilterRequestHandler(socketserver.BaseRequestHandler):
+
+    def handle(self) -> None:
+        try:
+            target_format : str = recv_frame(self.request).decode('utf-8')
+            context : dict = json.loads(recv_frame(self.request))
+            document : str = recv_frame(self.request).decode('utf-8')
+        except (ConnectionError, OSError, ValueError) as error:
+            logger.warning('Dropped malformed request: %s', error)
+            return
+
+        status, output, log = self.server.executor.submit(filter_request, target_format, document, context).result()
+
+        send_frame(self.request, status)
+        send_frame(self.request, output.encode('utf-8'))
+        send_frame(self.request, log.encode('utf-8'))
+
+def serve(path: str, workers: int | None = None) -> None:
+    """
+        Serve filter requests on the Unix socket at `path` until interrupted.
+    """
+
+    # Replace a socket left behind by a daemon that didn't shut down cleanly
+    if os.path.exists(path):
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+                probe.connect(path)
+            raise OSError('pandoc-math serve is already running on %s' % path)
+        except ConnectionRefusedError:
+            os.remove(path)
+
+    def terminate(signum, frame) -> None:
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, terminate)
+
+    with FilterServer(path, workers) as server:
+        logger.info('pandoc-math serving on %s', path)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.remove(path)
+
+def main(argv: List[str]) -> int:
+    parser : argparse.ArgumentParser = argparse.ArgumentParser(
+        prog='pandoc-math serve',
+        description='Keep the pandoc-math filter loaded and serve pandoc-math-client over a Unix socket.',
+    )
+    parser.add_argument('--socket', default=None, help='socket path (default: $PANDOC_MATH_SOCKET or a per-user runtime path)')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+        help='number of worker processes (default: number of CPUs)')
+    args : argparse.Namespace = parser.parse_args(argv)
+
+    if not hasattr(socket, 'AF_UNIX'):
+        logger.error('pandoc-math serve needs Unix domain sockets, which this platform does not provide.')
+        return 2
+
+    serve(args.socket or socket_path(), args.jobs)
+    return 0
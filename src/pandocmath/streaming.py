@@ -0,0 +1,280 @@
+"""
+    Streaming filter mode for very large documents.
+
+    Instead of loading the whole pandoc JSON into a panflute tree, top-level blocks are read one
+    at a time. Blocks that contain no Header, Math, Div or Link are copied through as raw JSON
+    text without being parsed; the others are converted, filtered and serialised on their own.
+    Blocks holding Links (or maths to pre-render) are kept until the end so their references can
+    be resolved once every identifier is known. Output is spooled to a temporary file until then.
+
+    Enable it with PANDOC_MATH_STREAMING=1 when running pandoc-math as a filter.
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+import re
+import tempfile
+
+import panflute as pf
+from panflute.elements import from_json
+
+from typing import BinaryIO, List, TextIO, Tuple
+
+from pandocmath.ams import AmsthmSettings, number_equations
+from pandocmath.filter import action, finalize, prepare
+
+# Setup logging
+logger : logging.Logger = logging.getLogger(__name__)
+
+STREAMING_ENV : str = 'PANDOC_MATH_STREAMING'
+
+# Raw blocks without any of these element types are passed through untouched
+FILTERED_ELEMENT : re.Pattern = re.compile(r'"t"\s*:\s*"(?:Header|Math|Div|Link)"')
+
+_STRUCTURE : re.Pattern = re.compile(r'["\[\]{}]')
+_STRING_END : re.Pattern = re.compile(r'["\\]')
+_NOT_WHITESPACE : re.Pattern = re.compile(r'\S')
+_SCALAR_END : re.Pattern = re.compile(r'[,\]}\s]')
+
+class JSONStreamReader:
+    """
+        Reads raw JSON values from a text stream without decoding them, keeping only a
+        small window of the input in memory.
+    """
+
+    def __init__(self, stream: TextIO, chunk_size: int = 1 << 16) -> None:
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.buffer = ''
+        self.pos = 0
+
+    def _fill(self) -> bool:
+        # Read at least as much as is already buffered, so long values are copied O(log n) times
+        chunk : str = self.stream.read(max(self.chunk_size, len(self.buffer) - self.pos))
+        if not chunk:
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self) -> str:
+        """
+            Skip whitespace and return the next character without consuming it.
+        """
+
+        while True:
+            match = _NOT_WHITESPACE.search(self.buffer, self.pos)
+            if match:
+                self.pos = match.start()
+                return self.buffer[self.pos]
+            self.pos = len(self.buffer)
+            if not self._fill():
+                raise ValueError('Unexpected end of JSON input')
+
+    def expect(self, char: str) -> None:
+
+        if self.peek() != char:
+            raise ValueError('Expected %r at JSON position, found %r' % (char, self.buffer[self.pos]))
+        self.pos += 1
+
+    def read_raw(self) -> str:
+        """
+            Consume the next JSON value and return its text.
+        """
+
+        self.peek()
+        start : int = self.pos
+        depth : int = 0
+        i : int = self.pos
+        first : str = self.buffer[i]
+
+        if first not in '[{"':
+            # Number, true, false or null: runs until the next delimiter
+            while True:
+                match = _SCALAR_END.search(self.buffer, i)
+                if match:
+                    self.pos = match.start()
+                    return self.buffer[start:self.pos]
+                offset : int = len(self.buffer) - start
+                self.pos = start
+                if not self._fill():
+                    self.pos = len(self.buffer)
+                    return self.buffer[start:]
+                start, i = 0, offset
+
+        while True:
+            match = _STRUCTURE.search(self.buffer, i)
+            if match is None:
+                # Keep the partial value and read more
+                offset = len(self.buffer) - start
+                self.pos = start
+                if not self._fill():
+                    raise ValueError('Unexpected end of JSON input')
+                start, i = 0, offset
+                continue
+
+            char : str = match.group()
+            i = match.end()
+            if char == '"':
+                # Skip to the end of the string, honouring escapes
+                while True:
+                    end = _STRING_END.search(self.buffer, i)
+                    if end is None or (end.group() == '\\' and end.end() >= len(self.buffer)):
+                        offset = (end.start() if end else len(self.buffer)) - start
+                        self.pos = start
+                        if not self._fill():
+                            raise ValueError('Unterminated JSON string')
+                        start, i = 0, offset
+                        continue
+                    if end.group() == '\\':
+                        i = end.end() + 1
+                        continue
+                    i = end.end()
+                    break
+                if depth == 0:
+                    self.pos = i
+                    return self.buffer[start:i]
+            elif char in '[{':
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    self.pos = i
+                    return self.buffer[start:i]
+
+    def read_key(self) -> str:
+
+        return json.loads(self.read_raw())
+
+def _dumps(obj: object) -> str:
+    # Compact separators and raw unicode, like pandoc and panflute.dump
+    return json.dumps(obj, default=lambda elem: elem.to_json(), check_circular=False,
+        separators=(',', ':'), ensure_ascii=False)
+
+class BlockSpool:
+    """
+        Filtered output blocks in document order: serialised blocks go to a temporary file,
+        blocks that still need reference resolution stay in memory.
+    """
+
+    def __init__(self) -> None:
+        self.file : BinaryIO = tempfile.TemporaryFile()
+        self.segments : List[Tuple[int, int] | pf.Element] = []
+
+    def write_raw(self, text: str) -> None:
+
+        data : bytes = text.encode('utf-8')
+        start : int = self.file.tell()
+        self.file.write(data)
+        self.segments.append((start, start + len(data)))
+
+    def hold(self, elem: pf.Element) -> None:
+
+        self.segments.append(elem)
+
+    def copy_to(self, output: TextIO) -> None:
+
+        self.file.flush()
+        for i, segment in enumerate(self.segments):
+            if i:
+                output.write(',')
+            if isinstance(segment, tuple):
+                start, end = segment
+                self.file.seek(start)
+                output.write(self.file.read(end - start).decode('utf-8'))
+            else:
+                output.write(_dumps(segment))
+
+    def close(self) -> None:
+        self.file.close()
+
+def filter_block(raw: str, doc: pf.Doc, spool: BlockSpool) -> None:
+    """
+        Filter one raw top-level block and append the result to the spool.
+    """
+
+    if FILTERED_ELEMENT.search(raw) is None:
+        spool.write_raw(raw)
+        return
+
+    amsthm_settings : AmsthmSettings = doc._amsthm_settings
+    queued_before : int = len(amsthm_settings.links) + len(amsthm_settings.maths or ())
+    elem : pf.Element = json.loads(raw, object_hook=from_json)
+    altered = elem.walk(action, doc)
+    # Rewrite the block's equations before it is written out
+    number_equations(amsthm_settings)
+    if isinstance(altered, list):
+        # Deleted by the filter
+        return
+
+    if len(amsthm_settings.links) + len(amsthm_settings.maths or ()) > queued_before:
+        # Contains references or maths to pre-render, which are handled in finalize
+        spool.hold(altered)
+    else:
+        spool.write_raw(_dumps(altered))
+
+def filter_stream(input_stream: TextIO, output_stream: TextIO, target_format: str = 'html') -> None:
+    """
+        Filter a JSON-encoded pandoc document from `input_stream` to `output_stream` block by block.
+    """
+
+    reader : JSONStreamReader = JSONStreamReader(input_stream)
+    spool : BlockSpool = BlockSpool()
+    api_version : list = [1, 23]
+    meta : str | None = None
+    pending : List[str] = []
+    doc : pf.Doc | None = None
+
+    def start_document() -> pf.Doc:
+        metadata : dict = json.loads(meta or '{}', object_hook=from_json)
+        new_doc : pf.Doc = pf.Doc(metadata=metadata, api_version=tuple(api_version))
+        new_doc.format = target_format
+        prepare(new_doc)
+        return new_doc
+
+    try:
+        reader.expect('{')
+        while reader.peek() != '}':
+            key : str = reader.read_key()
+            reader.expect(':')
+
+            if key == 'blocks':
+                reader.expect('[')
+                while reader.peek() != ']':
+                    raw : str = reader.read_raw()
+                    if meta is None:
+                        # Blocks before metadata can only be filtered once the metadata is known
+                        pending.append(raw)
+                    else:
+                        filter_block(raw, doc, spool)
+                    if reader.peek() == ',':
+                        reader.expect(',')
+                reader.expect(']')
+            elif key == 'meta':
+                meta = reader.read_raw()
+                doc = start_document()
+            elif key == 'pandoc-api-version':
+                api_version = json.loads(reader.read_raw())
+            else:
+                logger.warning('Ignoring unknown top-level key %s in JSON input.', key)
+                reader.read_raw()
+
+            if reader.peek() == ',':
+                reader.expect(',')
+
+        if doc is None:
+            doc = start_document()
+        for raw in pending:
+            filter_block(raw, doc, spool)
+
+        finalize(doc)
+
+        output_stream.write('{"pandoc-api-version":%s,"meta":%s,"blocks":['
+            % (_dumps(api_version), _dumps(doc.metadata.content.to_json())))
+        spool.copy_to(output_stream)
+        output_stream.write(']}')
+        output_stream.flush()
+    finally:
+        spool.close()
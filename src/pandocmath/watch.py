@@ -0,0 +1,359 @@
+"""
+    `pandoc-math watch DIR`: rebuild documents as their sources change.
+
+    Changes to .tex, .sty and .bib files and metadata.yaml are picked up with inotify on Linux and by
+    polling elsewhere. Bursts of saves are debounced into one rebuild, and only the documents
+    depending on a changed file are converted again, in this process.
+"""
+
+from __future__ import annotations
+
+import argparse
+import ctypes
+import ctypes.util
+import logging
+import os
+import re
+import select
+import struct
+import sys
+import time
+from pathlib import Path
+
+from typing import Dict, Iterable, List, Set, Tuple
+
+from pandocmath.build import discover_documents, is_root_document
+from pandocmath.conversion import ConversionResult, convert_file
+from pandocmath.latex_reader import find_included_files, read_preamble
+
+# Setup logging
+logger : logging.Logger = logging.getLogger(__name__)
+
+WATCHED_SUFFIXES : Set[str] = {'.tex', '.sty', '.bib'}
+METADATA_NAME : str = 'metadata.yaml'
+
+BIBLIOGRAPHY : re.Pattern = re.compile(r'(?<!\\)%.*|\\(?:bibliography|addbibresource)\s*(?:\[[^\]]*\])?\s*\{([^}]*)\}')
+
+def is_watched(path: Path) -> bool:
+
+    return path.suffix.lower() in WATCHED_SUFFIXES or path.name == METADATA_NAME
+
+def metadata_file(document: Path) -> Path | None:
+    """
+        The metadata.yaml next to a document, if there is one.
+    """
+
+    path : Path = document.parent / METADATA_NAME
+    return path if path.is_file() else None
+
+def bibliography_files(document: Path, sources: Iterable[Path]) -> List[Path]:
+
+    found : List[Path] = []
+    for source in sources:
+        try:
+            text : str = source.read_text(encoding='utf-8', errors='replace')
+        except OSError:
+            continue
+        for match in BIBLIOGRAPHY.finditer(text):
+            if not match.group(1):
+                # Comment
+                continue
+            for name in match.group(1).split(','):
+                path : Path = document.parent / name.strip()
+                if not path.suffix:
+                    path = path.with_suffix('.bib')
+                found.append(path.resolve())
+    return found
+
+def dependencies(document: Path) -> Set[Path]:
+    """
+        Every file the html output of `document` depends on, whether or not it exists yet.
+    """
+
+    sources : List[Path] = [document] + [Path(name) for name in find_included_files(str(document))]
+    found : Set[Path] = set(sources)
+    found.update(bibliography_files(document, sources))
+    try:
+        # Local packages the theorem declarations are read from, including missing ones
+        found.update(Path(path) for path, mtime in read_preamble(str(document))[1])
+    except OSError:
+        pass
+    found.add((document.parent / METADATA_NAME).resolve())
+    return found
+
+class DependencyGraph:
+    """
+        Maps each watched file to the documents that need rebuilding when it changes.
+    """
+
+    def __init__(self, root: Path) -> None:
+        self.root = root
+        self.documents : Dict[Path, Set[Path]] = {}
+        self.dependents : Dict[Path, Set[Path]] = {}
+        for document in discover_documents(root):
+            self.update(document.resolve())
+
+    def update(self, document: Path) -> None:
+        """
+            (Re)compute the dependencies of a document, e.g. after it changed its \\input commands.
+        """
+
+        self.remove(document)
+        self.documents[document] = dependencies(document)
+        for path in self.documents[document]:
+            self.dependents.setdefault(path, set()).add(document)
+
+    def remove(self, document: Path) -> None:
+
+        for path in self.documents.pop(document, ()):
+            self.dependents[path].discard(document)
+            if not self.dependents[path]:
+                del self.dependents[path]
+
+    def affected(self, changed: Iterable[Path]) -> Set[Path]:
+        """
+            The documents to rebuild after `changed` files were written, created or deleted.
+        """
+
+        documents : Set[Path] = set()
+        for path in changed:
+            if path.is_dir():
+                # Changes were lost (inotify queue overflow): rescan everything below the directory
+                for document in discover_documents(path):
+                    self.update(document.resolve())
+                documents.update(document for document in self.documents if path in document.parents)
+                continue
+
+            if path.suffix.lower() == '.tex':
+                if path.is_file() and is_root_document(path):
+                    if path not in self.documents:
+                        documents.add(path)
+                elif path in self.documents:
+                    # Deleted, or no longer a document
+                    self.remove(path)
+            documents.update(self.dependents.get(path, ()))
+
+        # The \input commands of a changed document may have changed too
+        documents = {document for document in documents if document.is_file()}
+        for document in documents:
+            self.update(document)
+        return documents
+
+    def stale(self) -> Set[Path]:
+        """
+            Documents whose html output is missing or older than one of their dependencies.
+        """
+
+        found : Set[Path] = set()
+        for document, paths in self.documents.items():
+            output : Path = document.with_suffix('.html')
+            try:
+                built : float = output.stat().st_mtime
+            except OSError:
+                found.add(document)
+                continue
+            if any(path.is_file() and path.stat().st_mtime > built for path in paths):
+                found.add(document)
+        return found
+
+class PollingWatcher:
+    """
+        Finds changed files by comparing modification times between scans.
+    """
+
+    def __init__(self, root: Path, interval: float = 0.5) -> None:
+        self.root = root
+        self.interval = interval
+        self.snapshot : Dict[Path, Tuple[int, int]] = self.scan()
+
+    def scan(self) -> Dict[Path, Tuple[int, int]]:
+
+        snapshot : Dict[Path, Tuple[int, int]] = {}
+        for directory, dirnames, filenames in os.walk(self.root):
+            dirnames[:] = [name for name in dirnames if not name.startswith('.')]
+            for name in filenames:
+                path : Path = Path(directory, name)
+                if is_watched(path):
+                    try:
+                        stat : os.stat_result = path.stat()
+                    except OSError:
+                        continue
+                    snapshot[path.resolve()] = (stat.st_mtime_ns, stat.st_size)
+        return snapshot
+
+    def wait(self, timeout: float | None = None) -> Set[Path]:
+        """
+            Block until files change or `timeout` seconds pass, returning the changed paths.
+        """
+
+        deadline : float | None = None if timeout is None else time.monotonic() + timeout
+        while True:
+            snapshot : Dict[Path, Tuple[int, int]] = self.scan()
+            changed : Set[Path] = {path for path in snapshot.keys() | self.snapshot.keys()
+                if snapshot.get(path) != self.snapshot.get(path)}
+            self.snapshot = snapshot
+            if changed:
+                return changed
+            if deadline is not None and time.monotonic() >= deadline:
+                return set()
+            time.sleep(self.interval if deadline is None else max(0, min(self.interval, deadline - time.monotonic())))
+
+    def close(self) -> None:
+        pass
+
+# inotify(7) constants
+IN_CLOSE_WRITE : int = 0x00000008
+IN_MOVED_FROM : int = 0x00000040
+IN_MOVED_TO : int = 0x00000080
+IN_CREATE : int = 0x00000100
+IN_DELETE : int = 0x00000200
+IN_Q_OVERFLOW : int = 0x00004000
+IN_ISDIR : int = 0x40000000
+IN_CLOEXEC : int = 0o2000000
+WATCH_MASK : int = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+_EVENT : struct.Struct = struct.Struct('iIII')
+
+class InotifyWatcher:
+    """
+        Receives file change events from the Linux kernel, watching every directory below `root`.
+    """
+
+    def __init__(self, root: Path) -> None:
+        library : str | None = ctypes.util.find_library('c')
+        self.libc = ctypes.CDLL(library, use_errno=True)
+        self.libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.root = root
+        self.fd : int = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.directories : Dict[int, Path] = {}
+        self.add_tree(root)
+
+    def add_tree(self, directory: Path) -> None:
+
+        for path, dirnames, _ in os.walk(directory):
+            dirnames[:] = [name for name in dirnames if not name.startswith('.')]
+            wd : int = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+            if wd < 0:
+                logger.warning('Cannot watch %s: %s', path, os.strerror(ctypes.get_errno()))
+                continue
+            self.directories[wd] = Path(path).resolve()
+
+    def read_events(self) -> Set[Path]:
+
+        changed : Set[Path] = set()
+        data : bytes = os.read(self.fd, 1 << 16)
+        offset : int = 0
+        while offset < len(data):
+            wd, mask, _, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name : str = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                changed.add(self.root.resolve())
+                continue
+            directory : Path | None = self.directories.get(wd)
+            if directory is None or not name:
+                continue
+            path : Path = directory / name
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO) and not name.startswith('.'):
+                    self.add_tree(path)
+                    changed.add(path)
+            elif is_watched(path):
+                changed.add(path)
+        return changed
+
+    def wait(self, timeout: float | None = None) -> Set[Path]:
+        """
+            Block until files change or `timeout` seconds pass, returning the changed paths.
+        """
+
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        return self.read_events() if readable else set()
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+def make_watcher(root: Path, poll: bool = False, interval: float = 0.5) -> InotifyWatcher | PollingWatcher:
+
+    if not poll and sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(root)
+        except (OSError, AttributeError) as error:
+            logger.warning('inotify is not available, polling instead: %s', error)
+    return PollingWatcher(root, interval)
+
+def rebuild(documents: Iterable[Path], use_cache: bool = True) -> None:
+    """
+        Convert each document next to its source, printing its status.
+        Without `use_cache`, every document is converted again.
+    """
+
+    for document in sorted(documents):
+        start : float = time.perf_counter()
+        try:
+            result : ConversionResult = convert_file(document, document.with_suffix('.html'), use_cache=use_cache,
+                metadata_file=metadata_file(document))
+        except Exception as error:
+            print('[failed] %s: %s: %s' % (document, type(error).__name__, error), flush=True)
+            continue
+
+        elapsed : float = time.perf_counter() - start
+        if result.ok:
+            print('[%s] %s (%.2fs)' % ('cached' if result.cached else 'ok', document, elapsed), flush=True)
+        else:
+            print('[failed] %s (%.2fs)' % (document, elapsed), flush=True)
+            if result.stderr.strip():
+                print('    ' + result.stderr.strip().replace('\n', '\n    '), flush=True)
+
+def watch(root: Path, poll: bool = False, interval: float = 0.5, debounce: float = 0.1) -> None:
+    """
+        Rebuild out of date documents below `root`, then keep rebuilding them as their files change.
+    """
+
+    root = Path(root).resolve()
+    watcher : InotifyWatcher | PollingWatcher = make_watcher(root, poll, interval)
+    graph : DependencyGraph = DependencyGraph(root)
+    rebuild(graph.stale())
+    print('Watching %s (%d documents), press Ctrl+C to stop' % (root, len(graph.documents)), flush=True)
+
+    try:
+        while True:
+            changed : Set[Path] = watcher.wait()
+            # Wait for a burst of saves to settle before rebuilding
+            while True:
+                more : Set[Path] = watcher.wait(debounce)
+                if not more:
+                    break
+                changed |= more
+
+            documents : Set[Path] = graph.affected(changed)
+            if documents:
+                # A file changed under them, which need not be one the cache key covers
+                rebuild(documents, use_cache=False)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+
+def main(argv: List[str]) -> int:
+    parser : argparse.ArgumentParser = argparse.ArgumentParser(
+        prog='pandoc-math watch',
+        description='Rebuild the LaTeX documents in a directory whenever they or the files they include change.',
+    )
+    parser.add_argument('directory', help='directory searched recursively for .tex documents')
+    parser.add_argument('--poll', action='store_true', help='poll for changes instead of using inotify')
+    parser.add_argument('--interval', type=float, default=0.5, help='polling interval in seconds (default: 0.5)')
+    parser.add_argument('--debounce', type=float, default=0.1,
+        help='seconds without further changes before rebuilding (default: 0.1)')
+    args : argparse.Namespace = parser.parse_args(argv)
+
+    if not Path(args.directory).is_dir():
+        logger.error("No such directory: %s", args.directory)
+        return 2
+
+    watch(Path(args.directory), args.poll, args.interval, args.debounce)
+    return 0
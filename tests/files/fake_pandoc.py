@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+"""
+    Stand-in for pandoc in tests: `-t json` prints a small fixed document, any other output
+    format copies the JSON from stdin to the -o file. FAKE_PANDOC_SLEEP=seconds makes it slow.
+"""
+
+import json
+import os
+import sys
+import time
+
+DOCUMENT = {
+    'pandoc-api-version': [1, 23, 1],
+    'meta': {},
+    'blocks': [
+        {'t': 'Header', 'c': [1, ['intro', [], []], [{'t': 'Str', 'c': 'Intro'}]]},
+        {'t': 'Div', 'c': [['thm', ['theorem'], []], [{'t': 'Para', 'c': [
+            {'t': 'Strong', 'c': [{'t': 'Str', 'c': 'Theorem'}]}, {'t': 'Space'}, {'t': 'Str', 'c': 'Statement.'}]}]]},
+        {'t': 'Para', 'c': [{'t': 'Str', 'c': 'By'}, {'t': 'Space'},
+            {'t': 'Link', 'c': [['', [], [['reference-type', 'ref'], ['reference', 'thm']]],
+                [{'t': 'Str', 'c': '[thm]'}], ['#thm', '']]}]},
+    ],
+}
+
+def main() -> None:
+
+    time.sleep(float(os.environ.get('FAKE_PANDOC_SLEEP') or 0))
+    args = sys.argv[1:]
+    if args[args.index('-t') + 1] == 'json':
+        sys.stdout.write(json.dumps(DOCUMENT))
+    else:
+        with open(args[args.index('-o') + 1], 'w', encoding='utf-8') as file:
+            file.write(sys.stdin.read())
+
+if __name__ == '__main__':
+    main()
@@ -63,3 +63,727 @@ def test_read_metadata():
     assert theorems['ackn'].shared_counter == 'remarks'
 
     assert amsthm_settings.number_within == True
+
+from pandocmath.pandoc_info import is_filter_invocation
+
+def test_filter_invocation_without_pandoc(tmp_path, monkeypatch):
+
+    monkeypatch.delenv('PANDOC_VERSION', raising=False)
+    assert is_filter_invocation('html')
+    assert not is_filter_invocation('main.tex')
+
+    # pandoc sets PANDOC_VERSION for filters, even when a file is named like the format
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'html').write_text('')
+    assert not is_filter_invocation('html')
+    monkeypatch.setenv('PANDOC_VERSION', '3.1.6.1')
+    assert is_filter_invocation('html5')
+    assert is_filter_invocation('html')
+
+from pandocmath.filter import action, action1, action2, prepare, finalize
+
+def make_doc():
+
+    doc = pf.Doc(
+        pf.Header(pf.Str('Intro'), level=1),
+        pf.Para(pf.Str('See'), pf.Space(), pf.Link(pf.Str('[thm]'), url='#thm',
+            attributes={'reference-type': 'ref', 'reference': 'thm'})),
+        pf.Div(pf.Para(pf.Strong(pf.Str('Theorem')), pf.Space(), pf.Str('Statement.')),
+            identifier='thm', classes=['theorem']),
+        pf.Para(pf.Math('x = y \\label{eq}', format='DisplayMath')),
+        metadata=SAMPLE_METADATA,
+    )
+    doc.format = 'html'
+    return doc
+
+def test_single_pass_matches_two_walks():
+
+    single = pf.run_filter(action, prepare=prepare, finalize=finalize, doc=make_doc())
+    double = pf.run_filters((action1, action2), prepare=prepare, finalize=finalize, doc=make_doc())
+
+    assert single.to_json() == double.to_json()
+    # Forward reference is resolved by the fix-up pass
+    assert pf.stringify(single.content[1]).strip() == 'See 1.1'
+
+from pandocmath.build import discover_documents
+
+def test_discover_documents(tmp_path):
+
+    (tmp_path / 'notes').mkdir()
+    (tmp_path / 'notes' / 'main.tex').write_text('\\documentclass{article}\n\\begin{document}\\input{chapter}\\end{document}')
+    (tmp_path / 'notes' / 'chapter.tex').write_text('Some text.')
+    (tmp_path / 'other.TEX').write_text('  \\documentclass{amsart}')
+    (tmp_path / 'readme.md').write_text('\\documentclass{article}')
+
+    assert discover_documents(tmp_path) == [tmp_path / 'notes' / 'main.tex', tmp_path / 'other.TEX']
+
+import os
+from pandocmath.cache import LRUCache
+
+def test_lru_cache_eviction(tmp_path):
+
+    cache = LRUCache(tmp_path, max_bytes=10)
+    cache.put('a', b'1234')
+    cache.put('b', b'5678')
+    os.utime(tmp_path / 'a', (0, 0))
+    os.utime(tmp_path / 'b', (1, 1))
+
+    # Reading 'a' makes 'b' the least recently used entry
+    assert cache.get('a') == b'1234'
+    cache.put('c', b'90ab')
+
+    assert cache.get('b') is None
+    assert cache.get('a') == b'1234'
+    assert cache.get('c') == b'90ab'
+
+def test_latex_reader_reads_preamble_only(tmp_path):
+
+    (tmp_path / 'thms.sty').write_text('\\newtheorem{lemma}{Lemma}[section]\n')
+    main = tmp_path / 'main.tex'
+    main.write_text('\\documentclass{article}\n\\usepackage{amsthm,thms}\n'
+        '\\theoremstyle{plain}\n\\begin{document}\n\\newtheorem{late}{Late}\n\\end{document}\n')
+
+    assert read_metadata_from_file(str(main)) == \
+        {'amsthm_settings': {'plain': [{'env_name': 'lemma', 'text': 'Lemma', 'parent_counter': 'section'}]}}
+
+    # Memoised results are refreshed when an included file changes
+    (tmp_path / 'thms.sty').write_text('\\newtheorem{lemma}{Lemma}\n')
+    os.utime(tmp_path / 'thms.sty', ns=(0, 0))
+    assert read_metadata_from_file(str(main)) == \
+        {'amsthm_settings': {'plain': [{'env_name': 'lemma', 'text': 'Lemma'}]}}
+
+from pandocmath.latex_reader import get_metadata_from_latex
+
+def test_latex_reader_theorem_variants():
+
+    metadata = get_metadata_from_latex('\\newtheorem{theorem}{Theorem}\n'
+        '\\newtheorem*{claim}{Claim}\n'
+        '\\numberwithin{theorem}{section}\n'
+        '\\theoremstyle{definition}\n'
+        '\\declaretheorem[style=remark, sibling=theorem, name=Remark]{remark}\n'
+        '\\declaretheorem[numberwithin=subsection]{exercise}\n'
+        '\\declaretheorem[numbered=no]{note}\n')
+
+    assert metadata == {'amsthm_settings': {
+        'plain': [{'env_name': 'theorem', 'text': 'Theorem'},
+            {'numbered': False, 'env_name': 'claim', 'text': 'Claim'}],
+        'counter_parents': {'theorem': 'section'},
+        'remark': [{'env_name': 'remark', 'shared_counter': 'theorem', 'text': 'Remark'}],
+        'definition': [{'env_name': 'exercise', 'parent_counter': 'subsection', 'text': 'Exercise'},
+            {'env_name': 'note', 'numbered': False, 'text': 'Note'}],
+    }}
+
+from pandocmath.ams import collect_equation, labelled_equations, number_equation, number_equations
+
+def test_number_equation():
+
+    settings = AmsthmSettings()
+    settings.number_within = True
+    settings.section_counters[0] = 2
+
+    unlabelled = pf.Math('a + b')
+    number_equation(unlabelled, settings)
+    assert unlabelled.text == 'a + b'
+
+    aligned = pf.Math('\\begin{aligned} a &= b \\label{x} \\\\\n c &= d \\label{y}\n\\end{aligned}')
+    number_equation(aligned, settings)
+    assert aligned.text == '\\begin{align} a &= b \\label{x}\\tag{2.1} \\\\\n c &= d \\label{y}\\tag{2.2}\n\\end{align}'
+
+    equation = pf.Math('e = mc^2 \\label{z}')
+    number_equation(equation, settings)
+    assert equation.text == '\\begin{equation}e = mc^2 \\label{z}\\tag{2.3}\\end{equation}'
+    assert settings.equations == {'x': '2.1', 'y': '2.2', 'z': '2.3'}
+
+    # Tags follow each label, even on the last row of an aligned environment
+    settings = AmsthmSettings()
+    aligned = pf.Math('\\begin{aligned} a \\label{a} \\\\ b \\label{b} \\end{aligned}')
+    number_equation(aligned, settings)
+    assert aligned.text == '\\begin{align} a \\label{a}\\tag{1} \\\\ b \\label{b}\\tag{2} \\end{align}'
+
+    # Unlabelled rows are numbered too, except \\notag rows, and nested rows are not split
+    settings = AmsthmSettings()
+    aligned = pf.Math('\\begin{aligned} a \\label{x} \\\\ b \\\\ c \\notag \\\\ '
+        '\\begin{cases} d \\\\ e \\end{cases} \\\\ \\end{aligned}')
+    after = pf.Math('f \\label{y}')
+    assert labelled_equations(aligned.text) == 3
+    collect_equation(aligned, settings)
+    collect_equation(after, settings)
+    number_equations(settings)
+    assert aligned.text == ('\\begin{align} a \\label{x}\\tag{1} \\\\ b \\tag{2}\\\\ c \\notag \\\\ '
+        '\\begin{cases} d \\\\ e \\end{cases} \\tag{3}\\\\ \\end{align}')
+    assert settings.equations == {'x': '1', 'y': '4'}
+
+    # A label outside aligned, as in an equation around it, gives the whole block one number
+    settings = AmsthmSettings()
+    block = pf.Math('\\label{x}\\begin{aligned} a &= b \\\\ c &= d \\end{aligned}')
+    assert labelled_equations(block.text) == 1
+    number_equation(block, settings)
+    assert block.text == '\\begin{equation}\\label{x}\\begin{aligned} a &= b \\\\ c &= d \\end{aligned}\\tag{1}\\end{equation}'
+    assert settings.equations == {'x': '1'}
+
+def test_eqref_static_numbers():
+
+    doc = make_doc()
+    doc.content.insert(1, pf.Para(pf.Link(pf.Str('[eq]'), url='#eq',
+        attributes={'reference-type': 'eqref', 'reference': 'eq'})))
+    doc.content.append(pf.Para(pf.Link(pf.Str('[other]'), url='#other',
+        attributes={'reference-type': 'eqref', 'reference': 'other'})))
+    doc = pf.run_filter(action, prepare=prepare, finalize=finalize, doc=doc)
+
+    # A forward reference gets the equation's number; unknown labels are left to MathJax
+    assert pf.stringify(doc.content[1]).strip() == '(1.1)'
+    assert doc.content[1].content[0].url == '#mjx-eqn:eq'
+    assert doc.content[4].content[0].text == '\\begin{equation}x = y \\label{eq}\\tag{1.1}\\end{equation}'
+    assert isinstance(doc.content[-1].content[0].content[0], pf.Math)
+
+def test_counter_dependency_chains():
+
+    doc = pf.Doc(
+        pf.Header(pf.Str('One'), level=1),
+        pf.Header(pf.Str('One.One'), level=2),
+        pf.Div(pf.Para(pf.Strong(pf.Str('Lemma'))), identifier='l1', classes=['lemma']),
+        pf.Div(pf.Para(pf.Strong(pf.Str('Claim'))), identifier='c1', classes=['claim']),
+        pf.Div(pf.Para(pf.Strong(pf.Str('Claim'))), identifier='c2', classes=['claim']),
+        pf.Div(pf.Para(pf.Strong(pf.Str('Lemma'))), identifier='l2', classes=['lemma']),
+        pf.Div(pf.Para(pf.Strong(pf.Str('Claim'))), identifier='c3', classes=['claim']),
+        pf.Div(pf.Para(pf.Strong(pf.Str('Note'))), identifier='n1', classes=['note']),
+        pf.Header(pf.Str('Two'), level=1),
+        pf.Div(pf.Para(pf.Strong(pf.Str('Lemma'))), identifier='l3', classes=['lemma']),
+        pf.Div(pf.Para(pf.Strong(pf.Str('Note'))), identifier='n2', classes=['note']),
+        metadata={'amsthm_settings': {
+            'plain': [{'env_name': 'lemma', 'text': 'Lemma', 'parent_counter': 'subsection'},
+                {'env_name': 'claim', 'text': 'Claim'},
+                {'env_name': 'note', 'text': 'Note'}],
+            'counter_parents': {'claim': 'lemma'},
+        }},
+    )
+    doc = pf.run_filter(action, prepare=prepare, finalize=finalize, doc=doc)
+
+    settings = AmsthmSettings(doc)
+    ids = settings.counter_ids
+    assert settings.section_resets[1] == (ids['lemma'], ids['claim'])
+    assert settings.counter_resets[ids['lemma']] == (ids['claim'],)
+
+    numbers = {div.identifier: pf.stringify(div.content[0].content[0]) for div in doc.content if isinstance(div, pf.Div)}
+    assert numbers == {'l1': 'Lemma 1.1.1', 'c1': 'Claim 1.1.1.1', 'c2': 'Claim 1.1.1.2',
+        'l2': 'Lemma 1.1.2', 'c3': 'Claim 1.1.2.1', 'n1': 'Note 1', 'l3': 'Lemma 2.0.1', 'n2': 'Note 2'}
+
+def test_qedhere_in_proof():
+
+    qed = '\xa0' + chr(9723)
+    doc = pf.Doc(
+        pf.Div(pf.Para(pf.Emph(pf.Str('Proof.')), pf.Space(), pf.Math('x = y \\qedhere', format='DisplayMath'),
+            pf.Str(qed)), classes=['proof']),
+        pf.Div(pf.Para(pf.Emph(pf.Str('Proof.')), pf.Space(), pf.Str('Clear.'), pf.Str(qed)), classes=['proof']),
+        pf.Para(pf.Math('\\qedhere', format='DisplayMath')),
+        metadata=SAMPLE_METADATA,
+    )
+    doc = pf.run_filter(action, prepare=prepare, finalize=finalize, doc=doc)
+
+    with_qedhere = doc.content[0].content[0].content
+    assert with_qedhere[-1].text == 'x = y \\tag*{' + chr(9723) + '}'
+    assert pf.stringify(doc.content[1]).strip().endswith(qed)
+    # Outside a proof \qedhere is left alone
+    assert doc.content[2].content[0].text == '\\qedhere'
+
+import io
+import threading
+from pandocmath.client import STATUS_OK, request
+from pandocmath.filter import filter_json
+import socket
+import pytest
+from pandocmath.server import FilterServer
+
+@pytest.mark.skipif(not hasattr(socket, 'AF_UNIX'), reason='needs Unix domain sockets')
+def test_filter_server(tmp_path):
+
+    with io.StringIO() as output:
+        pf.dump(make_doc(), output)
+        document = output.getvalue()
+
+    path = str(tmp_path / 'serve.sock')
+    with FilterServer(path, workers=1) as server:
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            status, filtered, log = request('html', document.encode('utf-8'), path)
+            # The client's settings apply, e.g. a profile report relative to its directory
+            profiled = request('html', document.encode('utf-8'), path,
+                {'cwd': str(tmp_path), 'environment': {'PANDOC_MATH_PROFILE': 'report.json'}})
+        finally:
+            server.shutdown()
+            thread.join()
+
+    assert status == STATUS_OK
+    assert filtered.decode('utf-8') == filter_json(document)
+    assert profiled[0] == STATUS_OK
+    assert (tmp_path / 'report.json').is_file()
+
+import json
+from pandocmath.streaming import filter_stream
+
+def test_streaming_matches_load_dump():
+
+    doc = make_doc()
+    doc.content.append(pf.Para(pf.Str('Plain "quoted" text \\ é')))
+    with io.StringIO() as output:
+        pf.dump(doc, output)
+        document = output.getvalue()
+
+    with io.StringIO() as output:
+        filter_stream(io.StringIO(document), output)
+        streamed = output.getvalue()
+
+    assert json.loads(streamed) == json.loads(filter_json(document))
+
+import subprocess
+import pandocmath.prerender
+
+def test_prerender_math_uses_cache(tmp_path, monkeypatch):
+
+    rendered = []
+    def fake_render(maths, regex_calls=None):
+        rendered.extend(maths)
+        return ['<math>%s</math>' % text for format, text in maths]
+
+    monkeypatch.setenv('PANDOC_MATH_CACHE_DIR', str(tmp_path))
+    monkeypatch.setenv('PANDOC_MATH_PRERENDER', '1')
+    monkeypatch.setattr(pandocmath.prerender, 'pandoc_version', lambda: '3.1')
+    monkeypatch.setattr(pandocmath.prerender, 'render_math', fake_render)
+
+    for _ in range(2):
+        doc = pf.Doc(pf.Para(pf.Math('a'), pf.Space(), pf.Math('b'), pf.Space(), pf.Math('a')), metadata=SAMPLE_METADATA)
+        doc = pf.run_filter(action, prepare=prepare, finalize=finalize, doc=doc)
+
+        assert [elem.text for elem in doc.content[0].content if isinstance(elem, pf.RawInline)] == \
+            ['<math>a</math>', '<math>b</math>', '<math>a</math>']
+        assert 'header-includes' not in doc.metadata
+
+    # Each distinct equation is rendered once, the second document comes from the cache
+    assert rendered == [('DisplayMath', 'a'), ('DisplayMath', 'b')]
+
+    # Static \\eqref links lead to the anchor MathJax would have made
+    doc = make_doc()
+    doc.content.insert(1, pf.Para(pf.Link(pf.Str('[eq]'), url='#eq',
+        attributes={'reference-type': 'eqref', 'reference': 'eq'})))
+    doc = pf.run_filter(action, prepare=prepare, finalize=finalize, doc=doc)
+    assert doc.content[1].content[0].url == '#mjx-eqn:eq'
+    assert doc.content[4].content[0].text.startswith('<span id="mjx-eqn:eq"></span><math>')
+    assert 'header-includes' not in doc.metadata
+
+def test_prerender_math_leaves_failures_to_mathjax(tmp_path, monkeypatch):
+
+    rendered = []
+    def fake_render(maths, regex_calls=None):
+        rendered.extend(maths)
+        # texmath's fallback for maths it can't parse is the TeX itself
+        return ['<math>a</math>' if text == 'a' else '<span class="math display">\\[%s\\]</span>' % text
+            for format, text in maths]
+
+    monkeypatch.setenv('PANDOC_MATH_CACHE_DIR', str(tmp_path))
+    monkeypatch.setenv('PANDOC_MATH_PRERENDER', '1')
+    monkeypatch.setattr(pandocmath.prerender, 'pandoc_version', lambda: '3.1')
+    monkeypatch.setattr(pandocmath.prerender, 'render_math', fake_render)
+
+    for _ in range(2):
+        doc = pf.Doc(pf.Para(pf.Math('a'), pf.Space(), pf.Math('\\xymatrix{A}')), metadata=SAMPLE_METADATA)
+        doc = pf.run_filter(action, prepare=prepare, finalize=finalize, doc=doc)
+
+        assert isinstance(doc.content[0].content[0], pf.RawInline)
+        assert isinstance(doc.content[0].content[2], pf.Math)
+        assert 'header-includes' in doc.metadata
+
+    # The failure isn't cached
+    assert rendered == [('DisplayMath', 'a'), ('DisplayMath', '\\xymatrix{A}'), ('DisplayMath', '\\xymatrix{A}')]
+
+    # A broken pandoc leaves all the maths to MathJax
+    def broken_pandoc():
+        raise subprocess.CalledProcessError(1, ['pandoc', '--version'])
+    monkeypatch.setattr(pandocmath.prerender, 'pandoc_version', broken_pandoc)
+    doc = pf.Doc(pf.Para(pf.Math('a')), metadata=SAMPLE_METADATA)
+    doc = pf.run_filter(action, prepare=prepare, finalize=finalize, doc=doc)
+    assert isinstance(doc.content[0].content[0], pf.Math)
+
+from pandocmath.label_index import LabelIndex, resolve_files, write_labels
+
+def test_cross_document_references(tmp_path, caplog):
+
+    index = tmp_path / 'labels.db'
+    doc = make_doc()
+    doc.metadata['pandoc-math-label-index'] = pf.MetaString(str(index))
+    doc.metadata['pandoc-math-document'] = pf.MetaString('part1/chapter1.html')
+    pf.run_filter(action, prepare=prepare, finalize=finalize, doc=doc)
+
+    # Unresolved reference to chapter 1 as written by pandoc's html writer
+    chapter2 = tmp_path / 'chapter2.html'
+    chapter2.write_text('<p>By <a href="#thm" data-reference-type="ref" data-reference="thm">[thm]</a> and '
+        '<a href="#other" data-reference-type="ref" data-reference="other">[other]</a>.</p>', encoding='utf-8')
+
+    assert resolve_files([tmp_path], index) == 1
+    assert chapter2.read_text(encoding='utf-8') == ('<p>By <a href="part1/chapter1.html#thm" data-reference-type="ref" '
+        'data-reference="thm">1.1</a> and <a href="#other" data-reference-type="ref" data-reference="other">[other]</a>.</p>')
+
+    # A plain \\ref to an equation links to the equation's anchor
+    chapter2.write_text('<a href="#eq" data-reference-type="ref" data-reference="eq">[eq]</a>', encoding='utf-8')
+    assert resolve_files([chapter2], index) == 1
+    assert chapter2.read_text(encoding='utf-8') == \
+        '<a href="part1/chapter1.html#mjx-eqn:eq" data-reference-type="ref" data-reference="eq">1.1</a>'
+
+    # Rebuilding another chapter that reuses a label doesn't take over references to it
+    caplog.set_level('WARNING')
+    write_labels(str(index), 'part2/chapter3.html', {'thm': '3.1'})
+    assert 'Label thm of part2/chapter3.html is also defined in part1/chapter1.html.' in caplog.text
+    chapter2.write_text('<a href="#thm" data-reference-type="ref" data-reference="thm">[thm]</a>', encoding='utf-8')
+    assert resolve_files([chapter2], index) == 1
+    assert 'chapter1.html#thm' in chapter2.read_text(encoding='utf-8')
+
+    # A chapter without theorems or equations is recorded too, so its cached conversion is reused
+    doc = pf.Doc(pf.Para(pf.Str('Prose')), metadata=SAMPLE_METADATA)
+    doc.metadata['pandoc-math-label-index'] = pf.MetaString(str(index))
+    doc.metadata['pandoc-math-document'] = pf.MetaString('preface.html')
+    pf.run_filter(action, prepare=prepare, finalize=finalize, doc=doc)
+    with LabelIndex(index) as label_index:
+        assert label_index.has_document('preface.html') and not label_index.has_document('appendix.html')
+
+import re
+import pandocmath.ams
+
+def test_profile_report(tmp_path, monkeypatch):
+
+    with io.StringIO() as output:
+        pf.dump(make_doc(), output)
+        document = output.getvalue()
+    expected = filter_json(document)
+
+    report = tmp_path / 'report.json'
+    monkeypatch.setenv('PANDOC_MATH_PROFILE', str(report))
+    assert filter_json(document) == expected
+
+    profile = json.loads(report.read_text())
+    assert list(profile['stages']) == ['load', 'prepare', 'walk', 'resolve', 'finalize', 'dump']
+    assert profile['elements']['Div'] == 1 and profile['elements']['Link'] == 1
+    assert profile['regex_calls']['pandocmath.ams.LABEL'] >= 1
+    assert 'process_peak_rss_bytes' in profile['stages']['walk']
+    # Stages count their own elements, the run totals are at the top
+    assert profile['stages']['walk']['elements'] == profile['elements']
+    assert profile['stages']['load']['elements'] == {} and profile['stages']['dump']['regex_calls'] == {}
+    # Calls are counted for the run, without replacing the module's patterns
+    assert isinstance(pandocmath.ams.LABEL, re.Pattern)
+
+def test_div_classification():
+
+    doc = pf.Doc(
+        pf.Header(pf.Str('One'), level=1),
+        pf.Div(pf.Para(pf.Strong(pf.Str('Theorem'))), identifier='a', classes=['columns', 'theorem', 'wide']),
+        pf.Div(pf.Para(pf.Strong(pf.Str('Theorem'))), identifier='b', classes=['definition', 'theorem']),
+        pf.Div(pf.Para(pf.Str('Callout')), classes=['callout']),
+        metadata=SAMPLE_METADATA,
+    )
+    doc = pf.run_filter(action, prepare=prepare, finalize=finalize, doc=doc)
+
+    assert pf.stringify(doc.content[1].content[0].content[0]) == 'Theorem 1.1'
+    # Ambiguous Divs are left alone
+    assert pf.stringify(doc.content[2].content[0].content[0]) == 'Theorem'
+    assert not hasattr(AmsTheorem('plain', 'lemma', 'Lemma'), '__dict__')
+
+from pandocmath import convert
+
+def test_convert_in_process(tmp_path, caplog):
+
+    caplog.set_level('INFO')
+
+    source = tmp_path / 'paper.tex'
+    source.write_text('\\documentclass{article}\n\\begin{document}\n\\end{document}\n')
+    fake_pandoc = [sys.executable, str(Path(__file__).parent / 'files' / 'fake_pandoc.py')]
+
+    result = convert(source, tmp_path / 'paper.html', metadata=SAMPLE_METADATA, pandoc=fake_pandoc)
+    assert result.ok, result.stderr
+
+    doc = pf.load(io.StringIO((tmp_path / 'paper.html').read_text(encoding='utf-8')))
+    assert pf.stringify(doc.content[1].content[0].content[0]) == 'Theorem 1.1'
+    assert pf.stringify(doc.content[2]).strip() == 'By 1.1'
+    assert 'Added new AmsTheorem: Theorem.' in result.stderr
+
+import logging
+from pandocmath.logs import captured_logs
+
+def test_captured_logs(caplog):
+
+    caplog.set_level('INFO')
+    logger = logging.getLogger('pandocmath.test')
+    with captured_logs() as log:
+        logger.info('in this thread')
+        thread = threading.Thread(target=logger.info, args=('in another thread',))
+        thread.start()
+        thread.join()
+
+    assert log.getvalue() == 'INFO:pandocmath.test:in this thread\n'
+    # Handlers installed by the caller still receive every record
+    assert [record.getMessage() for record in caplog.records] == ['in this thread', 'in another thread']
+
+import pandocmath.conversion
+from pandocmath.conversion import conversion_key, convert_file
+
+def test_conversion_key(tmp_path, monkeypatch):
+
+    monkeypatch.setattr(pandocmath.conversion, 'pandoc_version', lambda: '3.1.6.1')
+    source = tmp_path / 'paper.tex'
+    source.write_text('\\documentclass{article}\n\\usepackage{macros}\n\\begin{document}\n\\end{document}\n')
+    (tmp_path / 'macros.sty').write_text('\\newcommand{\\R}{\\mathbb{R}}\n')
+    mathjax = tmp_path / 'tex-svg.js'
+    mathjax.write_text('/* MathJax */\n')
+
+    # Local packages and each option the filter reads from the environment change the key
+    keys = [conversion_key(source, {})]
+    (tmp_path / 'macros.sty').write_text('\\newcommand{\\R}{\\mathbf{R}}\n')
+    keys.append(conversion_key(source, {}))
+    for variable, value in [('PANDOC_MATH_PRERENDER', '1'), ('PANDOC_MATH_ASSETS', str(tmp_path / 'assets')),
+            ('PANDOC_MATH_SETTINGS', str(tmp_path / 'settings.json')), ('PANDOC_MATH_MATHJAX', str(mathjax)),
+            ('PANDOC_MATH_XYJAX', str(tmp_path / 'xypic.js'))]:
+        monkeypatch.setenv(variable, value)
+        keys.append(conversion_key(source, {}))
+    mathjax.write_text('/* Another MathJax */\n')
+    keys.append(conversion_key(source, {}))
+    assert len(set(keys)) == len(keys)
+
+    # Without pandoc the conversion fails with a message rather than a traceback
+    def missing_pandoc():
+        raise OSError('Path to pandoc executable does not exist')
+    monkeypatch.setattr(pandocmath.conversion, 'pandoc_version', missing_pandoc)
+    monkeypatch.setenv('PANDOC_MATH_CACHE_DIR', str(tmp_path / 'cache'))
+    result = convert_file(source, tmp_path / 'paper.html')
+    assert not result.ok and 'Cannot run pandoc' in result.stderr
+
+from pandocmath.watch import DependencyGraph
+
+def test_watch_dependency_graph(tmp_path):
+
+    (tmp_path / 'notes').mkdir()
+    (tmp_path / 'main.tex').write_text('\\documentclass{article}\n\\usepackage{theorems}\n\\begin{document}\n'
+        '\\input{notes/week1}\n\\bibliography{refs}\n\\end{document}\n')
+    (tmp_path / 'notes' / 'week1.tex').write_text('Week 1.\n')
+    (tmp_path / 'theorems.sty').write_text('\\newtheorem{theorem}{Theorem}\n')
+    (tmp_path / 'other.tex').write_text('\\documentclass{article}\n\\begin{document}\n\\end{document}\n')
+    root = tmp_path.resolve()
+    graph = DependencyGraph(root)
+
+    assert graph.affected([root / 'notes' / 'week1.tex']) == {root / 'main.tex'}
+    assert graph.affected([root / 'refs.bib']) == {root / 'main.tex'}
+    assert graph.affected([root / 'theorems.sty']) == {root / 'main.tex'}
+    assert graph.affected([root / 'metadata.yaml']) == {root / 'main.tex', root / 'other.tex'}
+    assert graph.affected([root / 'notes' / 'unused.tex']) == set()
+
+    # A new document is picked up, a deleted one is dropped
+    (tmp_path / 'new.tex').write_text('\\documentclass{article}\n')
+    assert graph.affected([root / 'new.tex']) == {root / 'new.tex'}
+    (tmp_path / 'other.tex').unlink()
+    assert graph.affected([root / 'other.tex']) == set()
+    assert root / 'other.tex' not in graph.documents
+
+import asyncio
+import time
+import sys
+import pandocmath.aio
+from pandocmath.aio import Scheduler, SchedulerFull, filter_job
+
+FAKE_PANDOC = [sys.executable, str(Path(__file__).parent / 'files' / 'fake_pandoc.py')]
+
+def test_async_scheduler(tmp_path, monkeypatch):
+
+    sources = []
+    for i in range(5):
+        source = tmp_path / ('doc%d.tex' % i)
+        source.write_text('\\documentclass{article}\n')
+        sources.append(source)
+
+    async def convert_all():
+        scheduler = Scheduler(max_concurrency=2, pandoc=FAKE_PANDOC)
+        return await asyncio.gather(*[scheduler.submit(source, source.with_suffix('.html'), SAMPLE_METADATA)
+            for source in sources])
+
+    assert all(result.ok for result in asyncio.run(convert_all()))
+    doc = pf.load(io.StringIO(sources[4].with_suffix('.html').read_text(encoding='utf-8')))
+    assert pf.stringify(doc.content[1].content[0].content[0]) == 'Theorem 1.1'
+
+    # A slow pandoc is killed on timeout, and a full queue rejects new jobs
+    monkeypatch.setenv('FAKE_PANDOC_SLEEP', '30')
+
+    async def overload():
+        scheduler = Scheduler(max_concurrency=1, max_pending=0, pandoc=FAKE_PANDOC, timeout=0.5)
+        running = asyncio.ensure_future(scheduler.submit(sources[0], metadata=SAMPLE_METADATA))
+        await asyncio.sleep(0.1)
+        try:
+            await scheduler.submit(sources[1], metadata=SAMPLE_METADATA, wait=False)
+        except SchedulerFull:
+            pass
+        else:
+            raise AssertionError('SchedulerFull not raised')
+        try:
+            await running
+        except asyncio.TimeoutError:
+            await scheduler.cancel_all()
+            return scheduler.running
+        raise AssertionError('TimeoutError not raised')
+
+    start = time.perf_counter()
+    assert asyncio.run(overload()) == 0
+    assert time.perf_counter() - start < 10
+
+def test_async_filter_keeps_slot(tmp_path, monkeypatch, caplog):
+
+    caplog.set_level('INFO')
+    source = tmp_path / 'paper.tex'
+    source.write_text('\\documentclass{article}\n')
+
+    def slow_filter(json_text, metadata):
+        time.sleep(1)
+        return filter_job(json_text, metadata)
+
+    async def timeout_then_convert():
+        scheduler = Scheduler(max_concurrency=1, pandoc=FAKE_PANDOC)
+        monkeypatch.setattr(pandocmath.aio, 'filter_job', slow_filter)
+        try:
+            await scheduler.submit(source, tmp_path / 'paper.html', SAMPLE_METADATA, timeout=0.3)
+        except asyncio.TimeoutError:
+            pass
+        else:
+            raise AssertionError('TimeoutError not raised')
+        # The timed-out filter is still running in its thread, and keeps the only slot
+        held = scheduler.running
+        monkeypatch.setattr(pandocmath.aio, 'filter_job', filter_job)
+        start = time.perf_counter()
+        result = await scheduler.submit(source, tmp_path / 'paper.html', SAMPLE_METADATA)
+        return held, time.perf_counter() - start, result
+
+    held, waited, result = asyncio.run(timeout_then_convert())
+    assert held == 1
+    assert waited > 0.3
+    assert result.ok
+    # The job's filter log is collected, as by pandocmath.convert
+    assert 'Added new AmsTheorem: Theorem.' in result.stderr
+
+import pytest
+from pandocmath.bundle import InvalidBundle, StaleBundle, compile_preamble, load_bundle
+
+def test_settings_bundle(tmp_path, monkeypatch):
+
+    source = tmp_path / 'preamble.tex'
+    source.write_text((Path(__file__).parent / 'files' / 'latex_reader_test.tex').read_text())
+    bundle_path = tmp_path / 'settings.json'
+    bundle = compile_preamble(source)
+    assert bundle['amsthm_settings'] == SAMPLE_METADATA['amsthm_settings']
+    bundle_path.write_text(json.dumps(bundle))
+
+    # The filter takes its settings from the bundle, without any metadata in the document
+    monkeypatch.setenv('PANDOC_MATH_SETTINGS', str(bundle_path))
+    doc = make_doc()
+    doc.metadata = {}
+    doc = pf.run_filter(action, prepare=prepare, finalize=finalize, doc=doc)
+    assert pf.stringify(doc.content[1]).strip() == 'See 1.1'
+
+    bundle_path.write_text(json.dumps(dict(bundle, amsthm_settings={})))
+    with pytest.raises(InvalidBundle):
+        load_bundle(bundle_path)
+
+    bundle_path.write_text(json.dumps(bundle))
+    source.write_text('\\newtheorem{lemma}{Lemma}\n')
+    with pytest.raises(StaleBundle):
+        load_bundle(bundle_path)
+
+from pandocmath.parallel import filter_parallel
+
+def make_sections_doc(sections):
+
+    blocks = []
+    for s in range(sections):
+        blocks.append(pf.Header(pf.Str('Section'), pf.Space(), pf.Str(str(s)), level=1))
+        for t, env_name in enumerate(('theorem', 'definition', 'remarks')):
+            blocks.append(pf.Div(pf.Para(pf.Strong(pf.Str('Theorem')), pf.Space(), pf.Str('Statement.')),
+                identifier='thm-%d-%d' % (s, t), classes=[env_name]))
+            blocks.append(pf.Div(pf.Para(pf.Emph(pf.Str('Proof.')), pf.Space(), pf.Str('Trivial.')),
+                classes=['proof']))
+            blocks.append(pf.Para(pf.Math('x_{%d} = y \\label{eq-%d-%d}' % (t, s, t), format='DisplayMath')))
+            blocks.append(pf.Para(pf.Str('By'), pf.Space(), pf.Link(pf.Str('[thm-%d-%d]' % (s, t)),
+                url='#thm-%d-%d' % (s, t), attributes={'reference-type': 'ref', 'reference': 'thm-%d-%d' % (s, t)})))
+    doc = pf.Doc(*blocks, metadata=SAMPLE_METADATA)
+    doc.format = 'html'
+    return doc
+
+def test_parallel_matches_serial():
+
+    doc = make_sections_doc(12)
+    # A counter running across sections, and maths numbered before the section they start
+    doc.metadata['amsthm_settings']['plain'].content.append(
+        pf.MetaMap(env_name=pf.MetaString('note'), text=pf.MetaString('Note')))
+    doc.content.insert(0, pf.Div(pf.Para(pf.Strong(pf.Str('Note'))), identifier='note-0', classes=['note']))
+    for i in range(len(doc.content) - 1, 0, -7):
+        doc.content.insert(i, pf.Header(pf.Str('Part'), pf.Math('h \\label{h-%d}' % i, format='InlineMath'),
+            level=1 + i % 3))
+        doc.content.insert(i, pf.Div(pf.Para(pf.Strong(pf.Str('Note'))), identifier='note-%d' % i, classes=['note']))
+        doc.content.insert(i, pf.Para(pf.Math('\\begin{aligned} a \\label{a-%d} \\\\ b \\label{b-%d} \\end{aligned}'
+            % (i, i), format='DisplayMath'), pf.Link(pf.Str('[a]'), url='#a-%d' % i,
+            attributes={'reference-type': 'eqref', 'reference': 'a-%d' % i})))
+        # \\qedhere leaves a labelled equation in a proof unnumbered
+        doc.content.insert(i, pf.Div(pf.Para(pf.Math('q \\label{q-%d} \\qedhere' % i, format='DisplayMath')),
+            classes=['proof']))
+
+    for number_within in (True, False):
+        doc.metadata['amsthm_settings']['number_within'] = number_within
+        with io.StringIO() as output:
+            pf.dump(doc, output)
+            document = output.getvalue()
+
+        with io.StringIO() as output:
+            filter_parallel(io.StringIO(document), output, jobs=3)
+            assert output.getvalue() == filter_json(document)
+
+def test_mathjax_assets(tmp_path, monkeypatch):
+
+    assets = tmp_path / 'assets'
+    mathjax = tmp_path / 'tex-svg.js'
+    mathjax.write_text('/* MathJax */\n')
+    monkeypatch.setenv('PANDOC_MATH_ASSETS', str(assets))
+    monkeypatch.setenv('PANDOC_MATH_MATHJAX', str(mathjax))
+
+    def scripts(doc):
+        doc = pf.run_filter(action, prepare=prepare, finalize=finalize, doc=doc)
+        assert 'header-includes' not in doc.metadata
+        return re.findall(r'src="([^"]*)"', pf.stringify(doc.metadata['math']))
+
+    # Pages with the same needs share one script, with XyJax only loaded where it is used
+    first, second = scripts(make_doc()), scripts(make_doc())
+    assert first == second and len(first) == 1
+    diagram = make_doc()
+    diagram.content.append(pf.Para(pf.Math('\\xymatrix{A \\ar[r] & B}', format='DisplayMath')))
+    [with_xypic] = scripts(diagram)
+    assert with_xypic != first[0]
+
+    names = sorted(path.name for path in assets.iterdir())
+    assert len(names) == 2 and all(re.fullmatch(r'mathjax-[0-9a-f]{16}\.js', name) for name in names)
+    plain = (assets / Path(first[0]).name).read_text()
+    assert 'xypic' not in plain and plain.endswith('/* MathJax */\n')
+    assert 'xypic' in (assets / Path(with_xypic).name).read_text()
+
+def test_resolve_links(caplog):
+
+    doc = make_doc()
+    doc.content.append(pf.Para(pf.Link(pf.Str('home'), url='https://example.com')))
+    doc.content.append(pf.Para(pf.Link(pf.Str('[eq]'), url='#eq', attributes={'reference-type': 'ref', 'reference': 'eq'})))
+    for i in range(20):
+        doc.content.append(pf.Para(pf.Link(pf.Str('[sec-%d]' % i), url='#sec-%d' % i,
+            attributes={'reference-type': 'ref', 'reference': 'sec-%d' % i})))
+    # pandoc resolves references to sections itself, keeping their attributes
+    doc.content.append(pf.Para(pf.Link(pf.Str('1'), url='#intro', attributes={'reference-type': 'ref', 'reference': 'intro'})))
+
+    caplog.set_level('INFO')
+    doc = pf.run_filter(action, prepare=prepare, finalize=finalize, doc=doc)
+
+    # Ordinary links are skipped; unresolved references are reported a few at a time
+    assert pf.stringify(doc.content[4]).strip() == 'home'
+    assert pf.stringify(doc.content[1]).strip() == 'See 1.1'
+    # A \\ref to an equation is resolved to its number
+    assert pf.stringify(doc.content[5]).strip() == '1.1'
+    assert doc.content[5].content[0].url == '#mjx-eqn:eq'
+    warnings = [record.getMessage() for record in caplog.records if record.levelname == 'WARNING']
+    assert len(warnings) == 6
+    assert warnings[-1] == '20 unresolved references, 15 not shown.'